@@ -1,28 +1,39 @@
-from mysql.connector import connect, Error
+from mysql.connector import Error
 from sys import argv
+import DB_Pool
+import DB_Migrations
+import Query_Cache
 
 
+# borrow a connection to the database from the app's connection pool.
+# hand it back with DB_Pool.getPool().giveBack(connection) when done.
 def connectDB():
-    # establish connection to the database using the user account established for the app.
-    connection = connect(
-        host="localhost",
-        user="serv-rem-dev",
-        password="password",
-        database="service_reminders_app"
-    )
+    connection = DB_Pool.getPool().borrow()
 
     c1 = connection.cursor()
     return connection, c1
 
 
 def dropAllTables(connection, cursor):
+    cursor.execute("DROP TABLE IF EXISTS processedMessages")
+    cursor.execute("DROP TABLE IF EXISTS smsOutbox")
+    cursor.execute("DROP TABLE IF EXISTS serviceTemplateItems")
+    cursor.execute("DROP TABLE IF EXISTS serviceTemplates")
     cursor.execute("DROP TABLE IF EXISTS serviceSchedule")
+    cursor.execute("DROP TABLE IF EXISTS serviceCatalog")
     cursor.execute("DROP TABLE IF EXISTS vehicles")
     cursor.execute("DROP TABLE IF EXISTS users")
+    cursor.execute("DROP TABLE IF EXISTS schemaVersion")
     connection.commit()
+    invalidateSchemaCache()
+    # results cached from the old tables must not outlive them.
+    if Query_Cache.getCache() is not None:
+        Query_Cache.getCache().clear()
 
 
 # *** Table Creation ***#
+# the baseline schema, as it was before DB_Migrations existed, brought up to date by
+# the migrations. Change the schema with a new migration, never by editing these tables.
 def createTables(connection, cursor):
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS users (
@@ -75,6 +86,45 @@ def createTables(connection, cursor):
     """)
 
     connection.commit()
+    DB_Migrations.migrate(connection, cursor)
+    invalidateSchemaCache()
+
+
+# *** Schema metadata cache ***#
+# precision and scale of every DECIMAL column in these tables, keyed by (table, column).
+# read from information_schema once and served from memory until the schema changes.
+SCHEMACACHETABLES = ('vehicles', 'serviceSchedule')
+_decimalColumns = None
+
+
+def loadSchemaCache():
+    global _decimalColumns
+    with DBConnection() as db:
+        db.cursor.execute(f"""
+            SELECT table_name, column_name, numeric_precision, numeric_scale
+            FROM information_schema.columns
+            WHERE table_schema = DATABASE()
+            AND table_name IN ({', '.join(['%s'] * len(SCHEMACACHETABLES))})
+            AND data_type = "decimal"
+        """, SCHEMACACHETABLES)
+        rows = db.cursor.fetchall()
+
+    _decimalColumns = {(table, column): (precision, scale)
+                       for (table, column, precision, scale) in rows}
+
+
+# must be called after anything that changes the tables' columns.
+def invalidateSchemaCache():
+    global _decimalColumns
+    _decimalColumns = None
+
+
+# returns (precision, scale) for a DECIMAL column, or None if the column
+# isn't a DECIMAL in one of SCHEMACACHETABLES.
+def getDecimalColumn(tableName="", columnName=""):
+    if _decimalColumns is None:
+        loadSchemaCache()
+    return _decimalColumns.get((tableName, columnName))
 
 
 # *** Sample Data ***#
@@ -97,69 +147,83 @@ def loadSampleData(connection, cursor):
     cursor.executemany(sampleUsersStatement, sampleUsers)
 
     sampleVehiclesStatement = """
-        INSERT INTO vehicles (userID, vehNickname, make, model, year, miles, dateLastODO, milesPerDay, estMiles)
-        VALUES ( %s, %s, %s, %s, %s, %s, %s, %s, %s )
+        INSERT INTO vehicles (userID, vehNickname, make, model, year, miles, dateLastODO, milesPerDay)
+        VALUES ( %s, %s, %s, %s, %s, %s, %s, %s )
     """
     sampleVehicles = [
         (1, "Moose", "Lexus", "Rx350", "2015",
-         "110000", "2025-9-13", "20.3", "110020.3"),
-        (1, "Yoda", "Toyota", "Rav4", "2011", "125920", "2025-9-14", "100.4", "0"),
+         "110000", "2025-9-13", "20.3"),
+        (1, "Yoda", "Toyota", "Rav4", "2011", "125920", "2025-9-14", "100.4"),
         (2, None, "Subaru", "Crosstrek", "2019",
-         "10", "2025-9-05", "200.1", "210.1"),
-        (3, None, "Subaru", "Outback", "2025", None, None, None, None),
+         "10", "2025-9-05", "200.1"),
+        (3, None, "Subaru", "Outback", "2025", None, None, None),
         (3, None, "Subaru", "Loyale",
-         "1991", "1234124.5", "2010-12-24", ".1", "2.5"),
+         "1991", "1234124.5", "2010-12-24", ".1"),
         (4, "Grandma", "Volkwagen", "Jetta TDI Sportwagen",
-         "2014", "140020", "2024-7-13", "234", "10"),
+         "2014", "140020", "2024-7-13", "234"),
         (4, "Grandpa", "Subaru", "Forester",
-         "2005", "250120", "2025-09-11", None, "534"),
-        (5, "Mazda", "Mazda", "CX-5", "2021", "214", "2025-9-7", "10", "20"),
-        (6, "Hess Truck", "Hess", "Truck", "2025", "2.4", "2025-9-7", ".1", "2.5"),
-        (6, "truck", "Hess", "Truck", "2025", "2.4", "2025-9-8", ".1", "2.5"),
+         "2005", "250120", "2025-09-11", None),
+        (5, "Mazda", "Mazda", "CX-5", "2021", "214", "2025-9-7", "10"),
+        (6, "Hess Truck", "Hess", "Truck", "2025", "2.4", "2025-9-7", ".1"),
+        (6, "truck", "Hess", "Truck", "2025", "2.4", "2025-9-8", ".1"),
         (7, "millertruck1", "Hess", "Truck",
-         "2025", "2.4", "2025-9-1", ".1", "2.5"),
+         "2025", "2.4", "2025-9-1", ".1"),
         (7, "millertruck2", "Hess", "Truck",
-         "2025", "2.4", "2025-9-1", ".1", "2.5"),
-        (8, "no odo", "make", "model", "1999", None, None, None, None)
+         "2025", "2.4", "2025-9-1", ".1"),
+        (8, "no odo", "make", "model", "1999", None, None, None)
 
     ]
     cursor.executemany(sampleVehiclesStatement, sampleVehicles)
 
-    sampleServSchedStmt = """
-        INSERT INTO serviceSchedule (vehicleID, userID, description, serviceInterval, milesLastDone)
-        VALUES ( %s, %s, %s, %s, %s )
-    """
     sampleServiceSched = [
-        (1, 1, "Change Eng. Oil and Filter", 5000, 110300),
-        (1, 1, "Rotate and Inspect Tires", 5000, 110300),
-        (1, 1, "Re-torque drive shaft bolts", 15000, 120000),
-        (2, 1, "Change Eng. Oil and Filter", 5000, 130000),
-        (2, 1, "Replace Brake Fluid", 10000, 126000),
-        (3, 2, "Change tires", 1, 0),
-        (4, 3, "change oil", 1, 6000),
-        (5, 4, "flush brakes", 2, 100),
-        (6, 4, "set alignmnet", 10, 1029000)
+        (1, 1, "Change Eng. Oil and Filter", 5000, 110300, False),
+        (1, 1, "Rotate and Inspect Tires", 5000, 110300, False),
+        (1, 1, "Re-torque drive shaft bolts", 15000, 120000, False),
+        (2, 1, "Change Eng. Oil and Filter", 5000, 130000, False),
+        (2, 1, "Replace Brake Fluid", 10000, 126000, False),
+        (3, 2, "Change tires", 1, 0, False),
+        (4, 3, "change oil", 1, 6000, False),
+        (5, 4, "flush brakes", 2, 100, False),
+        (6, 4, "set alignmnet", 10, 1029000, False)
     ]
-    cursor.executemany(sampleServSchedStmt, sampleServiceSched)
+    insertServiceItems(cursor, sampleServiceSched)
 
     # commit changes
     connection.commit()
 
 
-# class to handle connecting and disconnecting from the databsase using with...as statements.
+# add service items, storing each description once in serviceCatalog.
+# items are (vehicleID, userID, description, serviceInterval, milesLastDone, servDueFlag).
+def insertServiceItems(cursor, items):
+    if not items:
+        return
+    descriptions = list(dict.fromkeys(item[2] for item in items))
+    cursor.executemany("""
+        INSERT IGNORE INTO serviceCatalog (description) VALUES (%s)
+    """, [(desc, ) for desc in descriptions])
+
+    cursor.execute(f"""
+        SELECT description, catalogID FROM serviceCatalog
+        WHERE descHash IN ({', '.join(['SHA2(%s, 256)'] * len(descriptions))})
+    """, descriptions)
+    catalogIDs = dict(cursor.fetchall())
+
+    cursor.executemany("""
+        INSERT INTO serviceSchedule (vehicleID, userID, catalogID, serviceInterval, milesLastDone, servDueFlag)
+        VALUES (%s, %s, %s, %s, %s, %s)
+    """, [(vehID, usrID, catalogIDs[desc], interval, milesLastDone, dueFlag)
+          for (vehID, usrID, desc, interval, milesLastDone, dueFlag) in items])
+
+
+# class to handle borrowing and returning a pooled database connection using with...as statements.
 class DBConnection:
     def __init__(self):
         self.connection = None
         self.cursor = None
 
     def __enter__(self):
-        # establish connection to the database using the user account established for the app.
-        self.connection = connect(
-            host="localhost",
-            user="serv-rem-dev",
-            password="password",
-            database="service_reminders_app"
-        )
+        # borrow a connection from the app's connection pool.
+        self.connection = DB_Pool.getPool().borrow()
 
         self.cursor = self.connection.cursor()
         return self
@@ -173,7 +237,7 @@ class DBConnection:
             self.connection.commit()
 
         self.cursor.close()
-        self.connection.close()
+        DB_Pool.getPool().giveBack(self.connection)
 
 
 def newDBWithData():
@@ -0,0 +1,219 @@
+# Versioned changes to the database schema.
+# DB_Builder.createTables builds the baseline schema. Every change after that is a
+# migration here, so a live database can be brought up to date without dropAllTables.
+# The versions applied to a database are recorded in its schemaVersion table.
+# To change the schema, append a migration with the next version number. Never edit
+# one that has already been applied somewhere.
+# MySQL commits DDL statements as it runs them, so a migration that fails part way
+# is not rolled back: keep each one small and re-runnable by hand if it breaks.
+# usage: python DB_Migrations.py [status]
+from sys import argv
+import DB_Pool
+import Query_Cache
+
+MIGRATIONLOCK = 'service_reminders_app.migrations'  # named lock held while migrating
+MIGRATIONLOCKTIMEOUT = 60  # seconds to wait for another process's migration to finish
+
+
+class MigrationLockError(Exception):
+    pass
+
+
+# (version, description, statements), in version order.
+MIGRATIONS = [
+    (1, 'changes made to the tables before migrations existed: smsOutbox, notification settings and history, no stored estMiles', [
+        # outgoing text messages waiting to be sent (or already sent) by the SMS_Outbox workers.
+        """
+        CREATE TABLE smsOutbox (
+            outboxID BIGINT AUTO_INCREMENT NOT NULL,
+            recip VARCHAR(32) NOT NULL,
+            body TEXT NOT NULL,
+            status ENUM('pending', 'sending', 'sent', 'failed') NOT NULL DEFAULT 'pending',
+            attempts INT NOT NULL DEFAULT 0,
+            nextAttemptAt DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            providerSid VARCHAR(64) DEFAULT NULL,
+            lastError TEXT DEFAULT NULL,
+            createdAt DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            sentAt DATETIME DEFAULT NULL,
+            PRIMARY KEY (outboxID),
+            INDEX outbox_claim (status, nextAttemptAt)
+        )
+        """,
+        "ALTER TABLE users ADD COLUMN notifyDigest ENUM('off', 'user', 'vehicle') NOT NULL DEFAULT 'off'",
+        """
+        ALTER TABLE serviceSchedule
+            ADD COLUMN lastNotifiedAt DATE DEFAULT NULL,
+            ADD COLUMN lastNotifiedEstMiles DOUBLE DEFAULT NULL,
+            ADD COLUMN notifyCount INT NOT NULL DEFAULT 0
+        """,
+        # estimated miles are worked out when read (main.estMilesSQL).
+        "ALTER TABLE vehicles DROP COLUMN estMiles",
+    ]),
+    (2, 'index the hot lookups: users by phone, vehicles by user and reading date, flagged service items', [
+        "CREATE INDEX users_phone ON users (phone)",
+        "CREATE INDEX vehicles_user_odo ON vehicles (userID, dateLastODO)",
+        "CREATE INDEX servsched_due ON serviceSchedule (servDueFlag)",
+    ]),
+    (3, 'processedMessages: replies already sent for inbound texts, so webhook retries can be replayed', [
+        """
+        CREATE TABLE processedMessages (
+            messageSid VARCHAR(64) NOT NULL,
+            response TEXT NOT NULL,
+            receivedAt DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (messageSid),
+            INDEX processed_received (receivedAt)
+        )
+        """,
+    ]),
+    (4, 'serviceCatalog and service templates: descriptions stored once and referenced by serviceSchedule.catalogID', [
+        # descHash is what makes a description unique: MySQL can't put a unique key on a whole LONGTEXT.
+        """
+        CREATE TABLE serviceCatalog (
+            catalogID INT AUTO_INCREMENT NOT NULL,
+            description LONGTEXT NOT NULL,
+            descHash CHAR(64) GENERATED ALWAYS AS (SHA2(description, 256)) STORED,
+            PRIMARY KEY (catalogID),
+            UNIQUE KEY catalog_desc (descHash)
+        )
+        """,
+        """
+        CREATE TABLE serviceTemplates (
+            templateID INT AUTO_INCREMENT NOT NULL,
+            name VARCHAR(255) NOT NULL,
+            PRIMARY KEY (templateID),
+            UNIQUE KEY template_name (name)
+        )
+        """,
+        """
+        CREATE TABLE serviceTemplateItems (
+            templateID INT NOT NULL,
+            catalogID INT NOT NULL,
+            serviceInterval INT NOT NULL CHECK (serviceInterval > 0),
+            PRIMARY KEY (templateID, catalogID),
+            FOREIGN KEY (templateID) REFERENCES serviceTemplates(templateID) ON DELETE CASCADE,
+            FOREIGN KEY (catalogID) REFERENCES serviceCatalog(catalogID)
+        )
+        """,
+        "INSERT IGNORE INTO serviceCatalog (description) SELECT DISTINCT description FROM serviceSchedule",
+        "ALTER TABLE serviceSchedule ADD COLUMN catalogID INT NULL AFTER userID",
+        """
+        UPDATE serviceSchedule
+        JOIN serviceCatalog ON serviceCatalog.descHash = SHA2(serviceSchedule.description, 256)
+        SET serviceSchedule.catalogID = serviceCatalog.catalogID
+        """,
+        """
+        ALTER TABLE serviceSchedule
+            MODIFY catalogID INT NOT NULL,
+            ADD CONSTRAINT servsched_catalog FOREIGN KEY (catalogID) REFERENCES serviceCatalog(catalogID),
+            ADD INDEX servsched_vehicle_catalog (vehicleID, catalogID),
+            DROP COLUMN description
+        """,
+    ]),
+    (5, 'index the paginated Users list for username prefix search', [
+        # a user's vehicles are paged on vehicles_user_odo (userID leads it): one user has
+        # few enough vehicles that sorting them by vehicleID costs less than another index
+        # would on every vehicle write.
+        "CREATE INDEX users_username ON users (username)",
+    ]),
+    (6, 'updatedAt on users, vehicles and serviceSchedule, for page ETags', [
+        """
+        ALTER TABLE users
+            ADD COLUMN updatedAt TIMESTAMP(6) NOT NULL
+                DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6)
+        """,
+        """
+        ALTER TABLE vehicles
+            ADD COLUMN updatedAt TIMESTAMP(6) NOT NULL
+                DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6),
+            ADD INDEX vehicles_user_updated (userID, updatedAt)
+        """,
+        """
+        ALTER TABLE serviceSchedule
+            ADD COLUMN updatedAt TIMESTAMP(6) NOT NULL
+                DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6),
+            ADD INDEX servsched_vehicle_updated (vehicleID, updatedAt)
+        """,
+    ]),
+]
+
+
+def createVersionTable(connection, cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schemaVersion (
+            version INT NOT NULL,
+            description VARCHAR(255) NOT NULL,
+            appliedAt DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (version)
+        )
+    """)
+    connection.commit()
+
+
+# returns the set of versions already applied to the database.
+def appliedVersions(connection, cursor):
+    createVersionTable(connection, cursor)
+    cursor.execute("SELECT version FROM schemaVersion")
+    return {row[0] for row in cursor.fetchall()}
+
+
+# returns the migrations not yet applied, in version order.
+def pendingMigrations(connection, cursor):
+    applied = appliedVersions(connection, cursor)
+    return [migration for migration in MIGRATIONS if migration[0] not in applied]
+
+
+# apply every pending migration in version order.
+# a named lock stops two processes migrating the same database at once.
+# returns the versions applied.
+# raises MigrationLockError if another migration holds the lock for MIGRATIONLOCKTIMEOUT seconds.
+def migrate(connection, cursor):
+    cursor.execute("SELECT GET_LOCK(%s, %s)", (MIGRATIONLOCK, MIGRATIONLOCKTIMEOUT))
+    if cursor.fetchall()[0][0] != 1:
+        raise MigrationLockError(f'timed out waiting for lock {MIGRATIONLOCK}')
+
+    applied = []
+    try:
+        # checked after taking the lock so migrations another process just ran are skipped.
+        for (version, description, statements) in pendingMigrations(connection, cursor):
+            for stmt in statements:
+                cursor.execute(stmt)
+            cursor.execute("""
+                INSERT INTO schemaVersion (version, description)
+                VALUES (%s, %s)
+            """, (version, description))
+            connection.commit()
+            applied.append(version)
+    finally:
+        cursor.execute("SELECT RELEASE_LOCK(%s)", (MIGRATIONLOCK, ))
+        cursor.fetchall()
+
+    # cached query results may be shaped by the old schema.
+    if applied and Query_Cache.getCache() is not None:
+        Query_Cache.getCache().clear()
+    return applied
+
+
+def migrateDB():
+    with DB_Pool.getPool().connection() as connection:
+        cursor = connection.cursor()
+        applied = migrate(connection, cursor)
+        cursor.close()
+    return applied
+
+
+def printStatus():
+    with DB_Pool.getPool().connection() as connection:
+        cursor = connection.cursor()
+        applied = appliedVersions(connection, cursor)
+        cursor.close()
+
+    for (version, description, statements) in MIGRATIONS:
+        print(f"{version:4d} {'applied' if version in applied else 'pending'}  {description}")
+
+
+if __name__ == "__main__":
+    if len(argv) > 1 and argv[1] == 'status':
+        printStatus()
+    else:
+        applied = migrateDB()
+        print(f"applied migrations: {applied}" if applied else "schema is up to date")
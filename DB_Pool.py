@@ -0,0 +1,213 @@
+import os
+import time
+from threading import Condition, Lock
+from contextlib import contextmanager
+from mysql.connector import connect, Error
+
+# connection settings for the user account established for the app.
+DBCONFIG = {
+    'host': "localhost",
+    'user': "serv-rem-dev",
+    'password': "password",
+    'database': "service_reminders_app"
+}
+
+POOLSIZE = 5  # connections kept open while idle
+POOLMAXOVERFLOW = 10  # extra connections allowed under bursts, closed when returned
+POOLIDLETIMEOUT = 300  # seconds an idle connection may sit in the pool before it is closed
+POOLRECYCLEAFTER = 1000  # number of borrows before a connection is closed and replaced
+POOLBORROWTIMEOUT = 30  # seconds to wait for a free connection before giving up
+
+#error messages
+POOLEXHAUSTED = 'no database connection became free within {timeout} seconds'
+
+
+class PoolExhaustedError(Exception):
+    pass
+
+
+# bookkeeping for one open connection held by the pool.
+class PooledConnection:
+    def __init__(self, connection):
+        self.connection = connection
+        self.uses = 0
+        self.lastReturned = time.monotonic()
+
+
+# A process-wide pool of MySQL connections.
+# borrow() hands out an open connection (opening a new one only when none are idle),
+# giveBack() returns it. Up to size + maxOverflow connections can be out at once;
+# any further borrowers wait until one is given back.
+# the lock only guards the pool's bookkeeping: a borrower reserves a slot under it, then
+# connects, pings or closes outside it, so one slow server round trip never holds up
+# other borrowers.
+class ConnectionPool:
+    def __init__(self, size=POOLSIZE, maxOverflow=POOLMAXOVERFLOW,
+                 idleTimeout=POOLIDLETIMEOUT, recycleAfter=POOLRECYCLEAFTER,
+                 borrowTimeout=POOLBORROWTIMEOUT, connectFunc=None, **connectArgs):
+        self.size = size
+        self.maxOverflow = maxOverflow
+        self.idleTimeout = idleTimeout
+        self.recycleAfter = recycleAfter
+        self.borrowTimeout = borrowTimeout
+        self.connectFunc = connectFunc if connectFunc else connect
+        self.connectArgs = connectArgs if connectArgs else DBCONFIG
+
+        self._lock = Condition()
+        self._idle = []  # PooledConnections ready to be borrowed, most recently returned last.
+        self._out = {}  # id(connection) -> PooledConnection for borrowed connections.
+        self._reserved = 0  # slots taken: connections borrowed, or being opened or checked for a borrower.
+        self._stats = {'borrowed': 0, 'waiting': 0, 'created': 0, 'recycled': 0}
+
+    def _open(self):
+        pooled = PooledConnection(self.connectFunc(**self.connectArgs))
+        with self._lock:
+            self._stats['created'] += 1
+        return pooled
+
+    def _close(self, pooled):
+        try:
+            pooled.connection.close()
+        except Error:
+            # the connection is being thrown away anyway.
+            pass
+
+    # health check on borrow: make sure the server has not dropped the connection.
+    def _isHealthy(self, pooled):
+        try:
+            return pooled.connection.is_connected()
+        except Error:
+            return False
+
+    # take a connection out of the pool, waiting up to borrowTimeout if all are in use.
+    # raises PoolExhaustedError if none became free in time.
+    def borrow(self):
+        deadline = time.monotonic() + self.borrowTimeout
+        with self._lock:
+            while not self._idle and self._reserved >= self.size + self.maxOverflow:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolExhaustedError(POOLEXHAUSTED.format(timeout=self.borrowTimeout))
+                self._stats['waiting'] += 1
+                try:
+                    self._lock.wait(remaining)
+                finally:
+                    self._stats['waiting'] -= 1
+
+            expired = self._takeIdleExpired()
+            pooled = self._idle.pop() if self._idle else None
+            self._reserved += 1
+
+        for stale in expired:
+            self._close(stale)
+
+        try:
+            if pooled is None:
+                pooled = self._open()
+            elif pooled.uses >= self.recycleAfter or not self._isHealthy(pooled):
+                self._close(pooled)
+                with self._lock:
+                    self._stats['recycled'] += 1
+                pooled = self._open()
+        except BaseException:
+            self._release()
+            raise
+
+        with self._lock:
+            pooled.uses += 1
+            self._out[id(pooled.connection)] = pooled
+            self._stats['borrowed'] = len(self._out)
+        return pooled.connection
+
+    # return a borrowed connection. Anything left uncommitted is rolled back so the
+    # next borrower starts with a clean transaction.
+    def giveBack(self, connection):
+        with self._lock:
+            pooled = self._out.pop(id(connection), None)
+            self._stats['borrowed'] = len(self._out)
+        if pooled is None:
+            return
+
+        try:
+            if connection.in_transaction:
+                connection.rollback()
+        except Error:
+            # a broken connection fails the health check on its next borrow.
+            pass
+
+        with self._lock:
+            kept = len(self._idle) < self.size
+            if kept:
+                pooled.lastReturned = time.monotonic()
+                self._idle.append(pooled)
+                self._reserved -= 1
+                self._lock.notify()
+        if not kept:
+            # overflow connection, don't keep it around.
+            self._close(pooled)
+            self._release()
+
+    # free a slot taken by borrow, for a connection that isn't going back in the pool.
+    def _release(self):
+        with self._lock:
+            self._reserved -= 1
+            self._lock.notify()
+
+    # borrow a connection for the length of a with block.
+    @contextmanager
+    def connection(self):
+        connection = self.borrow()
+        try:
+            yield connection
+        finally:
+            self.giveBack(connection)
+
+    # remove and return the idle connections that have been sitting longer than
+    # idleTimeout, for the caller to close once it has let go of the lock.
+    # must be called with the lock held.
+    def _takeIdleExpired(self):
+        now = time.monotonic()
+        expired = [pooled for pooled in self._idle if now - pooled.lastReturned > self.idleTimeout]
+        self._idle = [pooled for pooled in self._idle if now - pooled.lastReturned <= self.idleTimeout]
+        return expired
+
+    # close every idle connection. Borrowed connections are closed when given back.
+    def closeAll(self):
+        with self._lock:
+            idle = self._idle
+            self._idle = []
+        for pooled in idle:
+            self._close(pooled)
+
+    # a snapshot of the pool counters:
+    # borrowed and waiting are current values, created and recycled are running totals.
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['idle'] = len(self._idle)
+            return stats
+
+
+_pool = None
+_poolPid = None
+_poolLock = Lock()
+
+
+# get the process-wide pool, creating it on first use.
+# a forked child (e.g. an outbox worker) gets its own pool rather than sharing sockets
+# with its parent.
+def getPool():
+    global _pool, _poolPid
+    with _poolLock:
+        if _pool is None or _poolPid != os.getpid():
+            _pool = ConnectionPool()
+            _poolPid = os.getpid()
+        return _pool
+
+
+# replace the process-wide pool, e.g. with one using different settings.
+def setPool(pool):
+    global _pool, _poolPid
+    with _poolLock:
+        _pool = pool
+        _poolPid = os.getpid()
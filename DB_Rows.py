@@ -0,0 +1,18 @@
+# Typed rows for the app's main tables, built straight from query results with
+# querySQL(..., rowType=<row type>).
+# They are named tuples, so a row costs no more memory than the plain tuple the cursor
+# returns (no per-row dict), fields are read by name (vehicle.miles) rather than by
+# position, and templates can still write vehicle['miles'].
+# The fields are in the same order as main.py's column lists for each row type
+# (USERCOLUMNS, vehicleColumns(), SERVICEITEMCOLUMNS); change them together.
+from collections import namedtuple
+
+User = namedtuple('User', ('userID', 'username', 'phone', 'notifyDigest'))
+
+# estMiles is the estimated current odometer (main.estMilesSQL), as of the query.
+Vehicle = namedtuple('Vehicle', ('vehicleID', 'userID', 'vehNickname', 'make', 'model', 'year', 'displayName',
+                                 'miles', 'dateLastODO', 'milesPerDay', 'estMiles'))
+
+# description comes from serviceCatalog.
+ServiceItem = namedtuple('ServiceItem', ('itemID', 'vehicleID', 'userID', 'catalogID', 'description',
+                                         'serviceInterval', 'milesLastDone', 'dueAtMiles', 'servDueFlag'))
@@ -0,0 +1,79 @@
+# An in-process least-recently-used cache with expiry, safe to share between threads.
+# Each process (and each forked worker) has its own copy, so anything cached must be
+# dropped with invalidate() by whatever changes the underlying data, and a ttl bounds
+# how long another process can go on serving an old value.
+import time
+from threading import Lock
+from collections import OrderedDict
+
+CACHEMAXSIZE = 10000  # entries kept before the least recently used are evicted
+CACHETTL = 3600  # seconds a found value is served before it is looked up again
+
+
+class LRUCache:
+    # ttl: seconds a value is kept.
+    # negativeTtl: seconds a None result (nothing found) is kept. Short, so a missing
+    # row that gets added isn't hidden for long; 0 doesn't cache None at all.
+    def __init__(self, maxSize=CACHEMAXSIZE, ttl=CACHETTL, negativeTtl=0, clock=time.monotonic):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.negativeTtl = negativeTtl
+        self._clock = clock
+        self._entries = OrderedDict()  # key -> (value, expiresAt), least recently used first.
+        self._lock = Lock()
+        self._stats = {'hits': 0, 'negativeHits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    # return the cached value for key, or call load(key) and cache what it returns.
+    # load runs without the lock held, so two threads missing on the same key at
+    # once may both call it.
+    def get(self, key, load):
+        (found, value) = self._lookup(key)
+        if found:
+            return value
+
+        value = load(key)
+        self.put(key, value)
+        return value
+
+    # the cached value for key, or None if it isn't cached. Never loads anything.
+    def peek(self, key):
+        return self._lookup(key)[1]
+
+    # returns (found, value), counting the hit or miss.
+    def _lookup(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                (value, expiresAt) = entry
+                if self._clock() < expiresAt:
+                    self._entries.move_to_end(key)
+                    self._stats['hits' if value is not None else 'negativeHits'] += 1
+                    return True, value
+                del self._entries[key]
+            self._stats['misses'] += 1
+            return False, None
+
+    def put(self, key, value):
+        ttl = self.ttl if value is not None else self.negativeTtl
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, self._clock() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxSize:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self._stats['invalidations'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    # hits counts found values served from the cache, negativeHits cached "not found"s.
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, size=len(self._entries))
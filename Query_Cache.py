@@ -0,0 +1,184 @@
+# A read-through cache of query results for querySQL. Off unless QUERY_CACHE_URL is set.
+# Results are keyed by the statement (whitespace collapsed), its params, and the
+# generation of every table the statement names. A write bumps the generation of the
+# tables it names, so results read before it are never looked up again and age out of
+# the cache; nothing has to find and delete them.
+# Backends:
+#   QUERY_CACHE_URL=local       LocalBackend: this process only, an LRU of QUERYCACHEMAXSIZE results.
+#   QUERY_CACHE_URL=redis://... RedisBackend: shared by every worker using the same
+#       Redis-compatible server (needs the redis package). Its size is bounded by the
+#       server's maxmemory; run it with maxmemory-policy allkeys-lru. Results are
+#       pickled, so only point it at a server the app alone can write to.
+# Anything that writes to the database without going through querySQL (or that changes
+# the schema) must call invalidate() for the tables it wrote, or clear().
+import os
+import re
+import pickle
+import hashlib
+from threading import Lock
+import LRU_Cache
+
+QUERYCACHEMAXSIZE = 10000  # results kept by LocalBackend
+QUERYCACHETTL = 300  # seconds a result is kept. Bounds how stale a result can get if a write is missed.
+
+# the tables a statement reads or writes: whatever follows FROM, JOIN, UPDATE or INTO.
+TABLEPATTERN = re.compile(r'\b(?:FROM|JOIN|UPDATE|INTO)\s+`?(\w+)', re.IGNORECASE)
+# reads that must always go to the database: locking reads, and ones whose result
+# depends on more than the tables' contents.
+UNCACHEABLE = re.compile(r'\bFOR\s+UPDATE\b|\bLOCK\s+IN\s+SHARE\s+MODE\b|\bCURRENT_(?:DATE|TIME|TIMESTAMP)\b'
+                         r'|\b(?:NOW|RAND|UUID|LAST_INSERT_ID|FOUND_ROWS|DATABASE|GET_LOCK|SLEEP)\s*\(',
+                         re.IGNORECASE)
+
+
+# the tables named in stmt, lower-cased.
+def tablesIn(stmt):
+    return frozenset(table.lower() for table in TABLEPATTERN.findall(stmt))
+
+
+def isRead(stmt):
+    return stmt.lstrip().upper().startswith('SELECT')
+
+
+def isCacheable(stmt):
+    return isRead(stmt) and not UNCACHEABLE.search(stmt)
+
+
+class LocalBackend:
+    errors = ()  # exceptions that mean the backend is unavailable
+
+    def __init__(self, maxSize=QUERYCACHEMAXSIZE, ttl=QUERYCACHETTL):
+        self.results = LRU_Cache.LRUCache(maxSize=maxSize, ttl=ttl)
+        self._generations = {}
+        self._lock = Lock()
+
+    def generations(self, tables):
+        with self._lock:
+            return [self._generations.get(table, 0) for table in tables]
+
+    def bump(self, tables):
+        with self._lock:
+            for table in tables:
+                self._generations[table] = self._generations.get(table, 0) + 1
+
+    # the cached result for key, or None. A copy, so the caller can't change the cached one.
+    def get(self, key):
+        result = self.results.peek(key)
+        return list(result) if result is not None else None
+
+    def put(self, key, result):
+        self.results.put(key, result)
+
+    def clear(self):
+        self.results.clear()
+
+
+class RedisBackend:
+    def __init__(self, url, ttl=QUERYCACHETTL, prefix='queryCache:'):
+        import redis
+        self.errors = (redis.RedisError, )
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def generations(self, tables):
+        values = self.client.mget([f'{self.prefix}gen:{table}' for table in tables])
+        return [int(value or 0) for value in values]
+
+    def bump(self, tables):
+        pipe = self.client.pipeline(transaction=False)
+        for table in tables:
+            pipe.incr(f'{self.prefix}gen:{table}')
+        pipe.execute()
+
+    def get(self, key):
+        raw = self.client.get(self.prefix + key)
+        return pickle.loads(raw) if raw is not None else None
+
+    def put(self, key, result):
+        self.client.set(self.prefix + key, pickle.dumps(result), ex=self.ttl)
+
+    # drops every result, shared by all workers.
+    def clear(self):
+        for key in self.client.scan_iter(match=self.prefix + '*'):
+            self.client.delete(key)
+
+
+class QueryCache:
+    def __init__(self, backend):
+        self.backend = backend
+        self._lock = Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'invalidations': 0, 'errors': 0}
+
+    def _count(self, stat):
+        with self._lock:
+            self._stats[stat] += 1
+
+    # return the cached result of stmt with val, or call load() and cache what it returns.
+    # if the backend is unavailable the result is loaded every time.
+    # the generations are read before load() runs, so a write committed while it runs
+    # leaves its result under generations no later read will use.
+    def get(self, stmt, val, load):
+        tables = sorted(tablesIn(stmt))
+        try:
+            key = hashlib.sha1(repr((' '.join(stmt.split()), tuple(val), tables,
+                                     self.backend.generations(tables))).encode()).hexdigest()
+            result = self.backend.get(key)
+        except self.backend.errors:
+            self._count('errors')
+            return load()
+
+        if result is not None:
+            self._count('hits')
+            return result
+
+        self._count('misses')
+        result = load()
+        try:
+            self.backend.put(key, result)
+        except self.backend.errors:
+            self._count('errors')
+        return result
+
+    # make every cached result that read one of tables stale.
+    def invalidate(self, tables):
+        try:
+            self.backend.bump(sorted(table.lower() for table in tables))
+        except self.backend.errors:
+            self._count('errors')
+            return
+        self._count('invalidations')
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+
+_cache = None
+_cacheConfigured = False
+_cacheLock = Lock()
+
+
+# the process's query cache, set up from QUERY_CACHE_URL on first use.
+# returns None if caching is off.
+def getCache():
+    global _cache, _cacheConfigured
+    with _cacheLock:
+        if not _cacheConfigured:
+            url = os.environ.get('QUERY_CACHE_URL', '')
+            if url == 'local':
+                _cache = QueryCache(LocalBackend())
+            elif url:
+                _cache = QueryCache(RedisBackend(url))
+            _cacheConfigured = True
+        return _cache
+
+
+# replace the process's query cache. None turns caching off.
+def setCache(cache):
+    global _cache, _cacheConfigured
+    with _cacheLock:
+        _cache = cache
+        _cacheConfigured = True
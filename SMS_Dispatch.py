@@ -0,0 +1,152 @@
+import os
+import time
+from threading import Lock, Semaphore
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from twilio.rest import Client
+from twilio.http.http_client import TwilioHttpClient
+
+SMSFROMNUMBER = "+18665934611"
+TWILIOAPIURL = "https://api.twilio.com"
+SMSMAXPERSECOND = 3  # messages per second our sending number is allowed by the provider
+SMSDISPATCHWORKERS = 8  # threads sending at once
+
+# result of sending one message. sid is the provider's message ID,
+# error is None on success or the reason the send failed.
+SMSResult = namedtuple('SMSResult', ['recip', 'sid', 'error'])
+
+
+# token bucket rate limiter, safe to share between threads.
+# tokens refill at rate per second up to capacity; acquire() takes one token,
+# sleeping until it is available.
+class TokenBucket:
+    def __init__(self, rate=SMSMAXPERSECOND, capacity=1, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.capacity = capacity
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = capacity
+        self._last = clock()
+        self._lock = Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            # take the token now, even if it puts the bucket in debt, so callers queue up
+            # in order and each one sleeps only for its own share.
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+
+        if wait > 0:
+            self._sleep(wait)
+
+    # take a token only if one is available now. returns whether it got one.
+    def tryAcquire(self):
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+# tells the Twilio client to talk to baseUrl instead of api.twilio.com,
+# e.g. the local stand-in from SMS_FakeTwilio.
+class RedirectingHttpClient(TwilioHttpClient):
+    def __init__(self, baseUrl, **kwargs):
+        super().__init__(**kwargs)
+        self.baseUrl = baseUrl.rstrip('/')
+
+    def request(self, method, url, *args, **kwargs):
+        url = url.replace(TWILIOAPIURL, self.baseUrl, 1)
+        return super().request(method, url, *args, **kwargs)
+
+
+### SMS providers ###
+# a provider is any object with send(recip, msg) that sends one text and returns the
+# provider's message sid, raising an exception if the send failed.
+
+# sends through the Twilio Messages API. baseUrl points the client somewhere other
+# than the real API. The client's HTTP session keeps the connection open between
+# messages instead of doing a new TLS handshake for each one.
+class TwilioProvider:
+    def __init__(self, accountSid=None, authToken=None, fromNumber=SMSFROMNUMBER, baseUrl=None):
+        accountSid = accountSid if accountSid else os.environ["TWILIO_ACCOUNT_SID"]
+        authToken = authToken if authToken else os.environ["TWILIO_AUTH_TOKEN"]
+        if baseUrl:
+            httpClient = RedirectingHttpClient(baseUrl, pool_connections=True)
+        else:
+            httpClient = TwilioHttpClient(pool_connections=True)
+        self.client = Client(accountSid, authToken, http_client=httpClient)
+        self.fromNumber = fromNumber
+
+    def send(self, recip="", msg=""):
+        message = self.client.messages.create(
+            body=msg,
+            from_=self.fromNumber,
+            to=recip,
+        )
+        return message.sid
+
+
+_provider = None
+_providerLock = Lock()
+
+
+# the provider used by sendSMS, one per process.
+# Twilio by default; set SMS_PROVIDER_URL to send to a stand-in server instead.
+def getProvider():
+    global _provider
+    with _providerLock:
+        if _provider is None:
+            _provider = TwilioProvider(baseUrl=os.environ.get("SMS_PROVIDER_URL"))
+        return _provider
+
+
+def setProvider(provider):
+    global _provider
+    with _providerLock:
+        _provider = provider
+
+
+# send one text through the process's provider. returns the message sid.
+def sendSMS(recip="", msg=""):
+    return getProvider().send(recip=recip, msg=msg)
+
+
+# sends batches of messages through a bounded pool of threads, never faster than
+# maxPerSecond overall.
+class SMSDispatcher:
+    def __init__(self, send=sendSMS, maxPerSecond=SMSMAXPERSECOND, workers=SMSDISPATCHWORKERS):
+        self.send = send
+        self.workers = workers
+        self.bucket = TokenBucket(rate=maxPerSecond)
+
+    def _sendOne(self, recip, msg):
+        self.bucket.acquire()
+        try:
+            sid = self.send(recip, msg)
+        except Exception as e:
+            return SMSResult(recip, None, f'{type(e).__name__}: {e}')
+        return SMSResult(recip, sid, None)
+
+    # messages is an iterable of (recip, msg). It is read lazily, with at most
+    # two messages per worker queued at a time, so it can be a generator over a large
+    # result set.
+    # returns a list of SMSResult in the same order as messages. A failed send
+    # doesn't stop the others.
+    def dispatch(self, messages):
+        inFlight = Semaphore(self.workers * 2)
+        futures = []
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for (recip, msg) in messages:
+                inFlight.acquire()
+                future = executor.submit(self._sendOne, recip, msg)
+                future.add_done_callback(lambda f: inFlight.release())
+                futures.append(future)
+
+        return [future.result() for future in futures]
@@ -0,0 +1,138 @@
+# A local stand-in for the Twilio Messages API, for load and integration testing
+# without sending real texts.
+# It accepts POST /2010-04-01/Accounts/<sid>/Messages.json like Twilio does and answers
+# with a message resource. It can add latency, fail a share of requests with a 500,
+# and throttle with 429s above a messages-per-second limit. Everything it receives is
+# recorded, and can be read back with GET /received.
+# Point the app at it with SMS_PROVIDER_URL=http://localhost:<port>.
+# usage: python SMS_FakeTwilio.py [--port 8089] [--latency 0.2] [--error-rate 0.01] [--max-per-second 3]
+import json
+import time
+import random
+import argparse
+from uuid import uuid4
+from threading import Lock, Thread
+from urllib.parse import parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from SMS_Dispatch import TokenBucket
+
+MESSAGESPATH = '/2010-04-01/Accounts/{accountSid}/Messages.json'
+
+
+class FakeTwilio:
+    # latency: seconds to wait before answering each message.
+    # errorRate: share of messages (0 to 1) answered with a 500.
+    # maxPerSecond: messages per second accepted before answering with 429s. None for no limit.
+    def __init__(self, port=0, latency=0, errorRate=0, maxPerSecond=None):
+        self.latency = latency
+        self.errorRate = errorRate
+        self.bucket = TokenBucket(rate=maxPerSecond, capacity=maxPerSecond) if maxPerSecond else None
+        self.received = []  # one dict per request: to, from, body, status, sid, time
+        self._lock = Lock()
+        self.server = ThreadingHTTPServer(('localhost', port), self._handlerClass())
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        return f'http://localhost:{self.server.server_address[1]}'
+
+    def start(self):
+        self._thread = Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset(self):
+        with self._lock:
+            self.received = []
+
+    def _record(self, form, status, sid):
+        with self._lock:
+            self.received.append({
+                'to': form.get('To'),
+                'from': form.get('From'),
+                'body': form.get('Body'),
+                'status': status,
+                'sid': sid,
+                'time': time.time()
+            })
+
+    # answer one Messages API request: returns (status code, JSON payload).
+    def handleMessage(self, accountSid, form):
+        if self.latency:
+            time.sleep(self.latency)
+
+        if self.bucket and not self.bucket.tryAcquire():
+            self._record(form, 429, None)
+            return 429, {'code': 20429, 'message': 'Too Many Requests', 'status': 429}
+
+        if random.random() < self.errorRate:
+            self._record(form, 500, None)
+            return 500, {'code': 20500, 'message': 'Internal Server Error', 'status': 500}
+
+        sid = 'SM' + uuid4().hex
+        self._record(form, 201, sid)
+        return 201, {
+            'sid': sid,
+            'account_sid': accountSid,
+            'to': form.get('To'),
+            'from': form.get('From'),
+            'body': form.get('Body'),
+            'status': 'queued',
+            'num_segments': '1',
+            'direction': 'outbound-api',
+            'uri': MESSAGESPATH.format(accountSid=accountSid).replace('.json', f'/{sid}.json')
+        }
+
+    def _handlerClass(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _reply(self, status, payload):
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                parts = self.path.split('/')
+                # ['', '2010-04-01', 'Accounts', <sid>, 'Messages.json']
+                if len(parts) != 5 or parts[4] != 'Messages.json':
+                    return self._reply(404, {'code': 20404, 'message': 'Not Found', 'status': 404})
+
+                length = int(self.headers.get('Content-Length', 0))
+                form = {key: values[0] for (key, values) in
+                        parse_qs(self.rfile.read(length).decode()).items()}
+                self._reply(*fake.handleMessage(parts[3], form))
+
+            def do_GET(self):
+                if self.path != '/received':
+                    return self._reply(404, {'code': 20404, 'message': 'Not Found', 'status': 404})
+                with fake._lock:
+                    self._reply(200, fake.received)
+
+            # keep the console quiet under load.
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='local stand-in for the Twilio Messages API')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--max-per-second', type=float, default=None)
+    args = parser.parse_args()
+
+    fake = FakeTwilio(port=args.port, latency=args.latency, errorRate=args.error_rate,
+                      maxPerSecond=args.max_per_second)
+    print(f'fake Twilio listening on {fake.url}')
+    fake.server.serve_forever()
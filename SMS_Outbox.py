@@ -0,0 +1,166 @@
+# Durable outbox for outgoing text messages.
+# Producers (dailyMaint, notifyAllService) insert rows into smsOutbox with enqueueSMS
+# (or addToOutbox, inside a transaction of their own) and return straight away. Worker processes claim pending rows with
+# SELECT ... FOR UPDATE SKIP LOCKED, send them, and record the outcome, retrying
+# failures with exponential backoff.
+# usage: python SMS_Outbox.py [number of workers]
+import time
+from sys import argv
+from multiprocessing import Process
+import DB_Pool
+import SMS_Dispatch
+
+OUTBOXENQUEUECHUNK = 1000  # rows inserted (and committed) per statement by enqueueSMS
+OUTBOXBATCHSIZE = 50  # rows a worker claims at once
+OUTBOXMAXATTEMPTS = 5  # sends tried before a message is marked failed
+OUTBOXBACKOFFBASE = 30  # seconds to wait before the first retry; doubled for each retry after that
+OUTBOXLEASE = 300  # seconds a claimed row is reserved before another worker may take it over
+OUTBOXPOLLINTERVAL = 2  # seconds an idle worker sleeps before looking for new rows
+OUTBOXWORKERS = 4  # worker processes started by default
+
+
+# insert a list of (recip, msg) into the outbox on cursor. The caller commits, so the
+# messages can be queued in the same transaction as the writes that go with them.
+def addToOutbox(cursor, messages):
+    cursor.executemany('''
+        INSERT INTO smsOutbox (recip, body)
+        VALUES (%s, %s)
+    ''', messages)
+
+
+# add messages to the outbox. messages is an iterable of (recip, msg) and is
+# read lazily, so a chunk can be picked up by the workers while the producer is
+# still building the next one.
+# returns the number of messages added.
+def enqueueSMS(messages):
+    count = 0
+    chunk = []
+    with DB_Pool.getPool().connection() as connection:
+        c1 = connection.cursor()
+
+        def flush():
+            addToOutbox(c1, chunk)
+            connection.commit()
+
+        for (recip, msg) in messages:
+            chunk.append((recip, msg))
+            if len(chunk) >= OUTBOXENQUEUECHUNK:
+                flush()
+                count += len(chunk)
+                chunk = []
+
+        if chunk:
+            flush()
+            count += len(chunk)
+
+        c1.close()
+
+    return count
+
+
+# reserve up to limit messages that are due to be sent.
+# rows another worker has locked are skipped rather than waited on. A claimed row
+# is reserved for OUTBOXLEASE seconds; if the worker dies before recording the
+# outcome the row becomes claimable again after that.
+# returns a list of (outboxID, recip, body, attempts), attempts including this one.
+def claimBatch(limit=OUTBOXBATCHSIZE):
+    with DB_Pool.getPool().connection() as connection:
+        c1 = connection.cursor()
+        c1.execute('''
+            SELECT outboxID, recip, body, attempts FROM smsOutbox
+            WHERE status IN ('pending', 'sending')
+            AND nextAttemptAt <= NOW()
+            ORDER BY nextAttemptAt
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        ''', (limit, ))
+        rows = c1.fetchall()
+
+        if rows:
+            ids = [row[0] for row in rows]
+            c1.execute(f'''
+                UPDATE smsOutbox
+                SET status = 'sending', attempts = attempts + 1,
+                    nextAttemptAt = NOW() + INTERVAL %s SECOND
+                WHERE outboxID IN ({', '.join(['%s'] * len(ids))})
+            ''', (OUTBOXLEASE, *ids))
+
+        connection.commit()
+        c1.close()
+
+    return [(outboxID, recip, body, attempts + 1) for (outboxID, recip, body, attempts) in rows]
+
+
+# seconds to wait before retrying a message that has failed attempts times.
+def backoffSeconds(attempts):
+    return OUTBOXBACKOFFBASE * 2 ** (attempts - 1)
+
+
+# write the outcome of sending a claimed batch.
+# claimed is the list from claimBatch, results the matching SMS_Dispatch.SMSResults.
+def recordResults(claimed, results):
+    sent = []
+    retry = []
+    failed = []
+    for ((outboxID, recip, body, attempts), result) in zip(claimed, results):
+        if not result.error:
+            sent.append((result.sid, outboxID))
+        elif attempts >= OUTBOXMAXATTEMPTS:
+            failed.append((result.error, outboxID))
+        else:
+            retry.append((backoffSeconds(attempts), result.error, outboxID))
+
+    with DB_Pool.getPool().connection() as connection:
+        c1 = connection.cursor()
+        if sent:
+            c1.executemany('''
+                UPDATE smsOutbox
+                SET status = 'sent', providerSid = %s, sentAt = NOW(), lastError = NULL
+                WHERE outboxID = %s
+            ''', sent)
+        if retry:
+            c1.executemany('''
+                UPDATE smsOutbox
+                SET status = 'pending', nextAttemptAt = NOW() + INTERVAL %s SECOND, lastError = %s
+                WHERE outboxID = %s
+            ''', retry)
+        if failed:
+            c1.executemany('''
+                UPDATE smsOutbox
+                SET status = 'failed', lastError = %s
+                WHERE outboxID = %s
+            ''', failed)
+        connection.commit()
+        c1.close()
+
+
+# claim, send and record one batch. returns the number of messages processed.
+def processBatch(dispatcher):
+    claimed = claimBatch()
+    if claimed:
+        results = dispatcher.dispatch((recip, body) for (outboxID, recip, body, attempts) in claimed)
+        recordResults(claimed, results)
+    return len(claimed)
+
+
+# a worker's main loop: keep processing batches, sleeping while the outbox is empty.
+# the provider's rate limit is shared between numWorkers workers.
+def runWorker(numWorkers=1, send=SMS_Dispatch.sendSMS):
+    dispatcher = SMS_Dispatch.SMSDispatcher(send=send,
+        maxPerSecond=SMS_Dispatch.SMSMAXPERSECOND / numWorkers)
+    while True:
+        if processBatch(dispatcher) == 0:
+            time.sleep(OUTBOXPOLLINTERVAL)
+
+
+# start numWorkers worker processes and wait on them.
+def startWorkers(numWorkers=OUTBOXWORKERS):
+    workers = [Process(target=runWorker, args=(numWorkers, )) for i in range(numWorkers)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+if __name__ == "__main__":
+    startWorkers(int(argv[1]) if len(argv) > 1 else OUTBOXWORKERS)
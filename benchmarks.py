@@ -0,0 +1,406 @@
+# Benchmarks for the service reminders app.
+# These need the MySQL database set up for DB_Builder and they REBUILD it with
+# synthetic data, so never point them at a database you care about.
+# usage: python benchmarks.py [benchmark name ...]   (no names runs them all)
+import time
+from sys import argv
+import main
+import DB_Builder
+import DB_Pool
+from DB_Builder import DBConnection
+
+
+### statement counting ###
+# every statement sent through a pooled connection is counted, whichever
+# code path (querySQL, DBConnection, direct pool use) sent it.
+statementCount = 0
+
+
+class CountingCursor:
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, *args, **kwargs):
+        global statementCount
+        statementCount += 1
+        return self._cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        global statementCount
+        statementCount += 1
+        return self._cursor.executemany(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+
+class CountingConnection:
+    def __init__(self, connection):
+        self._connection = connection
+
+    def cursor(self, *args, **kwargs):
+        return CountingCursor(self._connection.cursor(*args, **kwargs))
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
+def useCountingPool():
+    def countingConnect(**kwargs):
+        return CountingConnection(DB_Pool.connect(**kwargs))
+    DB_Pool.setPool(DB_Pool.ConnectionPool(connectFunc=countingConnect))
+
+
+def resetStatementCount():
+    global statementCount
+    statementCount = 0
+
+
+### synthetic data ###
+SEEDUSERSIZE = 5  # vehicles per synthetic user
+
+
+# rebuild the DB with numVehicles vehicles, perUser per user, each with
+# itemsPerVehicle service items. flagged sets servDueFlag on every item.
+def seedFleet(numVehicles, itemsPerVehicle=1, flagged=True, perUser=SEEDUSERSIZE):
+    numUsers = (numVehicles + perUser - 1) // perUser
+    with DBConnection() as db:
+        DB_Builder.dropAllTables(db.connection, db.cursor)
+        DB_Builder.createTables(db.connection, db.cursor)
+
+        db.cursor.executemany('''
+            INSERT INTO users (username, phone) VALUES (%s, %s)
+        ''', [(f'benchUser{u}', f'+1555{u:07d}') for u in range(1, numUsers + 1)])
+
+        db.cursor.executemany('''
+            INSERT INTO vehicles (userID, vehNickname, make, model, year, miles, dateLastODO, milesPerDay)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        ''', [(v // perUser + 1, f'benchVeh{v}', 'Make', 'Model', '2015',
+               10000 + v, '2025-01-01', 30.0) for v in range(numVehicles)])
+
+        DB_Builder.insertServiceItems(db.cursor, [
+            (v + 1, v // perUser + 1, f'Service item {i}', 5000, 5000, flagged)
+            for v in range(numVehicles) for i in range(itemsPerVehicle)])
+
+
+def report(name, columns, rows):
+    print(f'\n## {name}')
+    print(' | '.join(columns))
+    for row in rows:
+        print(' | '.join(str(value) for value in row))
+
+
+### benchmarks ###
+
+# notifyAllService should send the same number of statements no matter how many
+# items are flagged.
+def benchNotifyQueryCount():
+    useCountingPool()
+    rows = []
+    for numVehicles in (10, 100, 1000, 10000):
+        seedFleet(numVehicles, itemsPerVehicle=2)
+        resetStatementCount()
+        start = time.perf_counter()
+        notified = main.notifyAllService()
+        elapsed = time.perf_counter() - start
+        rows.append((notified, statementCount, f'{elapsed:.3f}'))
+    report('notifyAllService statements per run', ('flagged items', 'statements', 'seconds'), rows)
+
+
+# end-to-end: notifyAllService queues a text per flagged item, then outbox workers
+# send them to the local stand-in provider with 200ms of latency per message.
+def benchOutboxThroughput():
+    import SMS_Dispatch
+    import SMS_Outbox
+    import SMS_FakeTwilio
+    from threading import Thread
+
+    fake = SMS_FakeTwilio.FakeTwilio(latency=0.2).start()
+    SMS_Dispatch.setProvider(SMS_Dispatch.TwilioProvider(accountSid='ACbench', authToken='bench',
+                                                         baseUrl=fake.url))
+    rows = []
+    for numWorkers in (1, 4):
+        seedFleet(500)
+        fake.reset()
+        start = time.perf_counter()
+        main.notifyAllService()
+        queued = time.perf_counter() - start
+
+        def drain():
+            dispatcher = SMS_Dispatch.SMSDispatcher(maxPerSecond=1000)
+            while SMS_Outbox.processBatch(dispatcher):
+                pass
+
+        workers = [Thread(target=drain) for i in range(numWorkers)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start
+        rows.append((numWorkers, len(fake.received), f'{queued:.3f}', f'{len(fake.received) / elapsed:.1f}'))
+    fake.stop()
+    report('outbox throughput against the stand-in provider (200ms latency)',
+           ('workers', 'messages', 'seconds to queue', 'messages/s'), rows)
+
+
+def innodbRowsUpdated():
+    with DBConnection() as db:
+        db.cursor.execute("SHOW GLOBAL STATUS LIKE 'Innodb_rows_updated'")
+        return int(db.cursor.fetchall()[0][1])
+
+
+# rows the nightly job writes in the vehicles table, with the old stored estMiles
+# column (two full-table UPDATEs) and with estimates worked out at read time.
+# nothing is flagged due so only the estimate work is measured.
+def benchNightlyWrites():
+    rows = []
+    for numVehicles in (1000, 10000, 100000):
+        seedFleet(numVehicles, itemsPerVehicle=0)
+
+        # before: the stored column and the two UPDATEs dailyMaint used to run.
+        with DBConnection() as db:
+            db.cursor.execute("ALTER TABLE vehicles ADD COLUMN estMiles DOUBLE")
+        before = innodbRowsUpdated()
+        start = time.perf_counter()
+        main.querySQL(stmt="""
+            UPDATE vehicles SET estMiles = 0, milesPerDay = 0
+            WHERE miles IS NULL OR milesPerDay IS NULL
+        """)
+        main.querySQL(stmt=f"""
+            UPDATE vehicles
+            SET estMiles = (vehicles.miles +
+                vehicles.milesPerDay * DATEDIFF('{main.getDateTodayStr()}', vehicles.dateLastODO))
+            WHERE miles IS NOT NULL
+        """)
+        oldSeconds = time.perf_counter() - start
+        oldRows = innodbRowsUpdated() - before
+        with DBConnection() as db:
+            db.cursor.execute("ALTER TABLE vehicles DROP COLUMN estMiles")
+
+        # after: the whole of dailyMaint.
+        before = innodbRowsUpdated()
+        start = time.perf_counter()
+        main.dailyMaint()
+        newSeconds = time.perf_counter() - start
+        newRows = innodbRowsUpdated() - before
+
+        rows.append((numVehicles, oldRows, f'{oldSeconds:.3f}', newRows, f'{newSeconds:.3f}'))
+    report('nightly rows written: stored estMiles vs estimated at read time',
+           ('vehicles', 'rows updated before', 'seconds before', 'rows updated after', 'seconds after (all of dailyMaint)'),
+           rows)
+
+
+# the nightly due-flag pass: the old single correlated-subquery UPDATE against
+# flagDueServices' itemID chunks. The longest transaction is about how long a
+# concurrent /receive_sms write to serviceSchedule could be kept waiting.
+def benchDueFlagChunks():
+    rows = []
+    for numVehicles in (1000, 10000, 100000):
+        seedFleet(numVehicles, itemsPerVehicle=4, flagged=False)
+        start = time.perf_counter()
+        main.querySQL(stmt=f"""
+            UPDATE serviceSchedule
+            SET servDueFlag = TRUE
+            WHERE (serviceSchedule.dueAtMiles - (SELECT {main.estMilesSQL()} FROM vehicles WHERE vehicles.vehicleID = serviceSchedule.vehicleID))
+                 < {main.SERVDUETHRESH}
+        """)
+        oneSeconds = time.perf_counter() - start
+
+        main.querySQL('UPDATE serviceSchedule SET servDueFlag = FALSE')
+        start = time.perf_counter()
+        chunks = main.flagDueServices()
+        chunkedSeconds = time.perf_counter() - start
+        longest = max(seconds for (lastItemID, flagged, seconds) in chunks)
+
+        rows.append((numVehicles * 4, f'{oneSeconds:.3f}', len(chunks), f'{chunkedSeconds:.3f}', f'{longest:.3f}'))
+    report(f'due-flag pass: one transaction vs chunks of {main.SERVDUEBATCHSIZE}',
+           ('service items', 'seconds (one transaction)', 'chunks', 'seconds (chunked)', 'longest chunk'), rows)
+
+
+# statements and latency for one odometer reply to /receive_sms, with the phone
+# number cache warm. Every synthetic vehicle is due a reading.
+def benchReceiveSMS():
+    useCountingPool()
+    numUsers = 1000
+    seedFleet(numUsers * SEEDUSERSIZE, itemsPerVehicle=0)
+    main.phoneUserCache.clear()
+    phones = [f'+1555{u:07d}' for u in range(1, numUsers + 1)]
+    for phone in phones:
+        main.getUserIDByPhone(phone)
+
+    timings = []
+    resetStatementCount()
+    with main.app.test_client() as client:
+        for phone in phones:
+            start = time.perf_counter()
+            client.post('/receive_sms', data={'From': phone, 'Body': '99999'})
+            timings.append(time.perf_counter() - start)
+
+    timings.sort()
+    report('/receive_sms odometer replies',
+           ('replies', 'statements per reply', 'p50 ms', 'p99 ms'),
+           [(numUsers, f'{statementCount / numUsers:.1f}',
+             f'{timings[len(timings) // 2] * 1000:.2f}', f'{timings[int(len(timings) * 0.99)] * 1000:.2f}')])
+
+
+# a fleet customer's bulk odometer upload through the API route: one user with
+# numVehicles vehicles, a week of daily readings for each.
+def benchOdometerImport():
+    rows = []
+    for numVehicles in (1000, 10000):
+        seedFleet(numVehicles, itemsPerVehicle=0, perUser=numVehicles)
+        lines = ['vehicleID,odometer,date']
+        for day in range(1, 8):
+            lines += [f'{v + 1},{10000 + v + day * 40},2025-02-0{day}' for v in range(numVehicles)]
+        upload = ('\n'.join(lines) + '\n').encode()
+
+        with main.app.test_client() as client:
+            start = time.perf_counter()
+            result = client.post('/api/Users/1/Odometers', data=upload, content_type='text/csv').get_json()
+            elapsed = time.perf_counter() - start
+        rows.append((result['rows'], result['applied'], len(result['errors']), f'{elapsed:.3f}',
+                     f'{result["rows"] / elapsed:.0f}'))
+    report('bulk odometer import (CSV through /api/Users/<id>/Odometers)',
+           ('rows', 'applied', 'errors', 'seconds', 'rows/s'), rows)
+
+
+# a sustained telematics stream: every vehicle of a 1000 vehicle fleet reporting 50
+# times, interleaved, as newline-delimited JSON, with different coalescing windows.
+# a window of 0 writes after every reading.
+def benchTelematicsStream():
+    import io
+    import json
+    useCountingPool()
+    numVehicles = 1000
+    body = ''.join(json.dumps({'vehicleID': v + 1, 'odometer': 20000 + v + i, 'date': '2025-02-01'}) + '\n'
+                   for i in range(50) for v in range(numVehicles)).encode()
+
+    rows = []
+    for window in (0, 1, main.TELEMATICSWINDOW):
+        seedFleet(numVehicles, itemsPerVehicle=0, perUser=numVehicles)
+        resetStatementCount()
+        start = time.perf_counter()
+        result = main.ingestOdoStream(1, main.iterNDJSONReadings(io.BytesIO(body)), window=window)
+        elapsed = time.perf_counter() - start
+        rows.append((window, result['rows'], result['batches'], statementCount, f'{elapsed:.3f}',
+                     f'{result["rows"] / elapsed:.0f}'))
+    report('telematics stream (50k readings from 1000 vehicles)',
+           ('window seconds', 'readings', 'writes', 'statements', 'seconds', 'readings/s'), rows)
+
+
+# a 5 item template added to a whole fleet, matched by make and model, in one
+# INSERT ... SELECT, against adding the same items one New-Service form post at a time.
+def benchTemplateApply():
+    rows = []
+    for numVehicles in (1000, 10000, 100000):
+        seedFleet(numVehicles, itemsPerVehicle=0)
+        templateID = main.createServiceTemplate('bench template', [(f'Service item {i}', 5000) for i in range(5)])
+        start = time.perf_counter()
+        added = main.applyServiceTemplate(templateID, make='Make', model='Model')
+        elapsed = time.perf_counter() - start
+        rows.append(('template', numVehicles, added, f'{elapsed:.3f}', f'{added / elapsed:.0f}'))
+
+    # the form posts are slow enough that a small fleet shows the difference.
+    numVehicles = 200
+    seedFleet(numVehicles, itemsPerVehicle=0)
+    with main.app.test_client() as client:
+        start = time.perf_counter()
+        for v in range(1, numVehicles + 1):
+            for i in range(5):
+                client.post(f'/Vehicles/{v}/New-Service',
+                            data={'description': f'Service item {i}', 'interval': '5000', 'milesLastDone': ''})
+        elapsed = time.perf_counter() - start
+    rows.append(('form posts', numVehicles, numVehicles * 5, f'{elapsed:.3f}', f'{numVehicles * 5 / elapsed:.0f}'))
+    report('service template applied to a fleet',
+           ('method', 'vehicles', 'items added', 'seconds', 'items/s'), rows)
+
+
+# vehicle and user page loads with the query cache off and on (in-process backend).
+def benchQueryCache():
+    import Query_Cache
+    useCountingPool()
+    numVehicles = 1000
+    seedFleet(numVehicles, itemsPerVehicle=4)
+    rows = []
+    for (label, cache) in (('off', None), ('local', Query_Cache.QueryCache(Query_Cache.LocalBackend()))):
+        Query_Cache.setCache(cache)
+        resetStatementCount()
+        with main.app.test_client() as client:
+            start = time.perf_counter()
+            for i in range(5):
+                for v in range(1, numVehicles + 1):
+                    client.get(f'/Vehicles/{v}')
+            elapsed = time.perf_counter() - start
+        rows.append((label, numVehicles * 5, statementCount, f'{elapsed:.3f}', f'{numVehicles * 5 / elapsed:.0f}'))
+    Query_Cache.setCache(None)
+    report('vehicle page loads with the query cache',
+           ('cache', 'page loads', 'statements', 'seconds', 'pages/s'), rows)
+
+
+# peak Python memory and time to the first row for a big read, fetched all at once with
+# querySQL against streamed with querySQLIter. Then notifyAllService over the largest
+# fleet, whose flagged items are streamed into the outbox.
+def benchStreamMemory():
+    import tracemalloc
+    stmt = '''
+        SELECT serviceSchedule.itemID, users.userID, vehicles.vehicleID, users.phone,
+            users.username, vehicles.displayName, serviceCatalog.description, serviceSchedule.dueAtMiles
+        FROM serviceSchedule
+        JOIN serviceCatalog ON serviceCatalog.catalogID = serviceSchedule.catalogID
+        JOIN users ON users.userID = serviceSchedule.userID
+        JOIN vehicles ON vehicles.vehicleID = serviceSchedule.vehicleID
+    '''
+
+    def measure(read):
+        tracemalloc.start()
+        start = time.perf_counter()
+        firstRow = None
+        numRows = 0
+        for row in read():
+            if firstRow is None:
+                firstRow = time.perf_counter() - start
+            numRows += 1
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return numRows, f'{peak / 2**20:.1f}', f'{firstRow:.3f}', f'{elapsed:.3f}'
+
+    rows = []
+    for numVehicles in (10000, 100000, 200000):
+        seedFleet(numVehicles, itemsPerVehicle=5)
+        rows.append(('querySQL', *measure(lambda: main.querySQL(stmt))))
+        rows.append(('querySQLIter', *measure(lambda: main.querySQLIter(stmt))))
+    report('reading every service item (5 per vehicle)',
+           ('method', 'rows', 'peak MiB', 'seconds to first row', 'seconds'), rows)
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    notified = main.notifyAllService()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    report('notifyAllService, streamed', ('flagged items', 'peak MiB', 'seconds'),
+           [(notified, f'{peak / 2**20:.1f}', f'{elapsed:.3f}')])
+
+
+BENCHMARKS = {
+    'notify-query-count': benchNotifyQueryCount,
+    'outbox-throughput': benchOutboxThroughput,
+    'nightly-writes': benchNightlyWrites,
+    'due-flag-chunks': benchDueFlagChunks,
+    'receive-sms': benchReceiveSMS,
+    'odometer-import': benchOdometerImport,
+    'telematics': benchTelematicsStream,
+    'template-apply': benchTemplateApply,
+    'query-cache': benchQueryCache,
+    'stream-memory': benchStreamMemory,
+}
+
+
+if __name__ == '__main__':
+    names = argv[1:] if len(argv) > 1 else list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
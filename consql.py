@@ -1,6 +1,8 @@
-from mysql.connector import connect
+import DB_Pool
 
+# borrow a pooled connection for poking at the DB from a REPL.
+# hand it back with DB_Pool.getPool().giveBack(c) when done.
 def con():
-    c = connect(host = "localhost", user = "serv-rem-dev", password = "password", database = "service_reminders_app")
+    c = DB_Pool.getPool().borrow()
     curs = c.cursor()
     return (c, curs)
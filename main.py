@@ -1,15 +1,54 @@
-import os
 from decimal import *
-from datetime import date
+from datetime import date, datetime, timedelta
 # from urllib.parse import parse_qs
-from mysql.connector import connect, Error
-from flask import Flask, request, Response, render_template, redirect, url_for
-from twilio.rest import Client
+from mysql.connector import Error
+from flask import Flask, request, Response, render_template, make_response, redirect, url_for, jsonify, g, has_request_context
 from twilio.twiml.messaging_response import MessagingResponse
-# import DB_Builder
+import DB_Builder
+import DB_Pool
+import SMS_Dispatch
+import SMS_Outbox
+import LRU_Cache
+import Query_Cache
+from DB_Rows import User, Vehicle, ServiceItem
 import traceback
+import time
+import csv
+import json
+import codecs
+import hashlib
+from math import isfinite
+from contextlib import contextmanager
 
 ODOPROMPTINTERVAL = 7  # the number of days to wait before prompting a regular ODO reading
+NOTIFYCHUNKSIZE = 500  # rows read from the cursor at a time when building service notifications
+STREAMBATCHSIZE = 1000  # rows querySQLIter reads from the server at a time
+SMSDIGESTMAXSEGMENTS = 3  # longest a digest message may get before it is split into another message
+NOTIFYDIGESTMODES = ('off', 'user', 'vehicle')  # choices for users.notifyDigest
+# an item that is still due after it has been notified is sent again once either
+# of these has passed since the last notification.
+RENOTIFYAFTERDAYS = 7
+RENOTIFYAFTERMILES = 500  # estimated miles driven
+SERVDUETHRESH = 500  # an item is flagged due when it is this many estimated miles from its deadline
+SERVDUEBATCHSIZE = 1000  # service items flagged per transaction by the nightly due-flag pass
+PHONECACHETTL = 3600  # seconds a phone number's userID is cached for /receive_sms
+PHONECACHENEGATIVETTL = 60  # seconds a number with no user (e.g. spam) is remembered
+PROCESSEDMSGKEEPHOURS = 24  # hours an inbound text's reply is kept to answer webhook retries with
+PROCESSEDMSGCACHESIZE = 10000  # replies kept in memory
+PROCESSEDMSGPURGECHUNK = 1000  # expired replies deleted per statement
+IMPORTCHUNKSIZE = 1000  # uploaded odometer readings checked and applied per transaction
+IMPORTREADSIZE = 65536  # bytes of a JSON upload decoded at a time
+IMPORTCOLUMNS = ('vehicleID', 'odometer', 'date')  # fields of an uploaded odometer reading
+TELEMATICSWINDOW = 5  # seconds of a telematics stream coalesced into one write
+PAGESIZE = 50  # rows per page of the Users and vehicle lists, unless ?limit= asks for another size
+PAGESIZEMAX = 500  # largest ?limit= accepted
+COUNTCACHETTL = 60  # seconds a list's total count is cached
+COUNTEXACTBELOW = 10000  # tables estimated smaller than this are counted exactly
+
+# characters that can be sent in GSM-7 encoding, and the ones that take two characters' space.
+GSM7CHARS = set("@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞÆæßÉ !\"#¤%&'()*+,-./0123456789:;<=>?"
+                "¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà")
+GSM7EXTCHARS = set("^{}\\[~]|€\f")
 
 #error messages
 BELOWZERO = '{what} cannot be negative.'
@@ -27,11 +66,25 @@ NOELIGIBLEVEHICLE = "no eligible vehicle for user {userID}"
 NOTINDB = '{type} {id} not found in DB'
 INVALIDPARAM = 'parameter is not a valid {param}'
 UNCAUGHTEXCEPTION = 'uncaught exception raised'
+IMPORTBADFORMAT = 'upload a .csv or .json file'
+IMPORTBADJSON = 'JSON uploads must be an array of readings'
+IMPORTBADDATE = 'date must be YYYY-MM-DD or an ISO timestamp'
+IMPORTFUTUREDATE = "date can't be in the future"
+IMPORTDATEBEFORELAST = "date is before the vehicle's last odometer reading"
+IMPORTVEHICLENOTFOUND = "vehicle {id} is not one of this user's vehicles"
+TELEMATICSBADFORMAT = 'send readings as newline-delimited JSON (application/x-ndjson)'
+TEMPLATENOITEMS = 'a template needs at least one service item'
+TEMPLATEBADITEM = 'line {line}: expected "description, interval" with a whole number of miles above 0'
+TEMPLATENOFILTER = 'choose a vehicle, user, make, model or year to apply the template to'
 #text messages
 PHONENOTINDBSMS = "your phone number is not associated with Service Reminders."
 SERVICENOTIFICATION = '{username}, {displayName} is due for item: "{desc}" at {dueAt} miles.'
+SERVICEDIGESTUSER = '{username}, service is due:'
+SERVICEDIGESTVEHICLE = '{username}, {displayName} is due for:'
+SERVICEDIGESTLINE = '"{desc}" at {dueAt} miles.'
 NOELIGIBLEVEHICLESMS = "none of your vehicles need an odometer update."
 SUCCESSFULODOUPDATESMS = "Successfully updated the odometer"
+ODOPROMPTSMS = "Hey {username}, Service Reminders here. Please reply with an odometer reading for {displayName}."
 
 app = Flask(__name__)
 
@@ -45,6 +98,22 @@ def getDateTodayStr():
     return getDateToday().strftime('%Y-%m-%d')
 
 
+# the date days before today, as a string.
+# compare a date column against this (dateLastODO < getDateAgoStr(n)) rather than
+# DATEDIFF(today, dateLastODO) > n: wrapping the column in a function stops MySQL
+# using an index on it.
+def getDateAgoStr(days=0):
+    return (getDateToday() - timedelta(days=days)).strftime('%Y-%m-%d')
+
+
+# SQL expression for a vehicle's estimated current miles, worked out when it is read
+# instead of being stored: the last odometer reading plus milesPerDay for every day
+# since then. 0 if the vehicle has no odometer reading; a missing milesPerDay counts as 0.
+def estMilesSQL(table='vehicles'):
+    return f"""IF({table}.miles IS NULL, 0,
+        {table}.miles + COALESCE({table}.milesPerDay * DATEDIFF('{getDateTodayStr()}', {table}.dateLastODO), 0))"""
+
+
 def strIsFloat(str=""):
     try:
         float(str)
@@ -59,19 +128,13 @@ def strIsFloat(str=""):
 # if the data type is a decimal. (flesh this out later to more data types
 # if it serves a purpose.)
 def getMaxTheoValueDecimal(tableName="", columnName=""):
-    result = querySQL(f"""
-        SELECT numeric_precision, numeric_scale
-        FROM information_schema.columns
-        WHERE table_schema = "service_reminders_app"
-        AND table_name = "{tableName}"
-        AND column_name = "{columnName}"
-        AND data_type = "decimal"
-    """)
-    if result == []:
+    # precision and scale come from the schema cache rather than information_schema.
+    column = DB_Builder.getDecimalColumn(tableName=tableName, columnName=columnName)
+    if column is None:
         return "Column is not Decimal type"
     else:
-        digitsLeftDecimal = result[0][0] - 1
-        digitsRightDecimal = result[0][1]
+        digitsLeftDecimal = column[0] - 1
+        digitsRightDecimal = column[1]
         return 10 ** digitsLeftDecimal - 10 ** (-1 * digitsRightDecimal)
 
 ### custom exceptions ###
@@ -91,72 +154,439 @@ class DuplicateItemError(Exception):
     pass
 
 
-# function to execute SQL query in a safe container, opening and closing the connection and checking for errors along the way.
+# run a statement on the given connection and return its result, without committing.
+# returns the last inserted primary key for INSERT and UPDATE statements.
+def executeSQL(connection, stmt="", val="", many=False):
+    c1 = connection.cursor()
+
+    if many:
+        c1.executemany(stmt, val)
+    else:
+        c1.execute(stmt, val)
+
+    result = c1.fetchall()
+
+    # if the statement begins with INSERT (not case sensitive)
+    # get the last inserted primary key to return.
+    # and toss whatever was in the cursor before.
+    if 'INSERT INTO'.lower() in stmt.lower() or \
+            'UPDATE'.lower() in stmt.lower():
+        result = c1.lastrowid
+
+    c1.close()
+
+    return result
+
+
+# function to execute SQL query in a safe container and check for errors along the way.
+# inside an HTTP request, the statement runs on the request's DB session and is committed
+# along with everything else when the request finishes. Outside of a request it borrows a
+# connection from the pool and commits straight away.
+# when the query cache is on (see Query_Cache), reads are served from it, and writes
+# invalidate the tables they name once they are committed.
+# rowType: a row type from DB_Rows to build each row of a read's result as, instead of a
+# plain tuple. The statement must select that type's columns, in order.
 # returns the result of a query if there is one.
-def querySQL(stmt="", val="", many=False):
+def querySQL(stmt="", val="", many=False, rowType=None):
+    cache = Query_Cache.getCache()
+    try:
+        if cache is not None and Query_Cache.isCacheable(stmt) and not requestWroteTables(stmt):
+            result = cache.get(stmt, val, lambda: runSQL(stmt, val, many))
+        else:
+            result = runSQL(stmt, val, many)
+    except Error as e:
+        # breakpoint()
+        raise Exception(e)
+
+    if not Query_Cache.isRead(stmt):
+        invalidateTables(Query_Cache.tablesIn(stmt))
+    elif rowType is not None:
+        # the cache keeps plain tuples; rows are typed on the way out.
+        result = [rowType._make(row) for row in result]
+    return result
+
+
+# run a statement for querySQL, on the request's session or a pooled connection.
+def runSQL(stmt="", val="", many=False):
+    if has_request_context():
+        return executeSQL(getRequestDB(), stmt, val, many)
+
+    with DB_Pool.getPool().connection() as connection:
+        result = executeSQL(connection, stmt, val, many)
+        connection.commit()
+        return result
+
+
+# yields the rows of a read one at a time, for results too big to hold in memory at once.
+# rows are read from the server batchSize at a time on an unbuffered cursor, so only one
+# batch is in memory, and the first rows can be used before the last have been read.
+# the read runs on a pooled connection of its own, even inside a request, so it doesn't
+# see the request's uncommitted writes and it skips the query cache. The connection can't
+# run anything else until the rows have all been read: write through querySQL as you go.
+# the server gives up on the read if the caller goes net_write_timeout seconds (60 by
+# default) without taking a row, so don't wait on anything slow between rows.
+# stopping early (break, or closing the generator) discards the unread rows.
+# rowType: as for querySQL.
+def querySQLIter(stmt="", val="", batchSize=STREAMBATCHSIZE, rowType=None):
     try:
-        with connect(
-            host="localhost",
-            user="serv-rem-dev",
-            password="password",
-            database="service_reminders_app"
-        ) as connection:
+        with DB_Pool.getPool().connection() as connection:
             c1 = connection.cursor()
+            c1.execute(stmt, val)
+            try:
+                rows = c1.fetchmany(batchSize)
+                while rows:
+                    yield from (map(rowType._make, rows) if rowType is not None else rows)
+                    rows = c1.fetchmany(batchSize)
+            finally:
+                # rows left unread would break the connection for its next borrower.
+                connection.consume_results()
+                c1.close()
+                connection.commit()
+    except Error as e:
+        raise Exception(e)
 
-            if many:
-                c1.executemany(stmt, val)
-            else:
-                c1.execute(stmt, val)
 
-            result = c1.fetchall()
+# drop the query cache's results for tables once the current writes are committed,
+# and the request's identity map rows from them straight away.
+# must be called by anything that writes without going through querySQL.
+# within a request, the tables' later reads skip the cache so the request sees its own writes.
+# committed: the writes were committed on a connection of their own, so invalidate now.
+def invalidateTables(tables, committed=False):
+    forgetRows(tables)
+    cache = Query_Cache.getCache()
+    if cache is None or not tables:
+        return
+    if committed:
+        cache.invalidate(tables)
+        return
+    if has_request_context():
+        g.setdefault('writtenTables', set()).update(table.lower() for table in tables)
+    runAfterCommit(lambda: cache.invalidate(tables))
+
+
+# True if the current request has written to a table stmt reads.
+def requestWroteTables(stmt):
+    return has_request_context() and not g.get('writtenTables', set()).isdisjoint(Query_Cache.tablesIn(stmt))
+
+
+### Request-scoped DB session ###
+# each HTTP request uses one pooled connection and one transaction for all of its queries.
+# the transaction is committed once when the request finishes, and rolled back if the
+# request fails.
+
+# get the DB connection for the current request, borrowing one from the pool
+# the first time it is needed.
+def getRequestDB():
+    if 'dbConnection' not in g:
+        g.dbConnection = DB_Pool.getPool().borrow()
+    return g.dbConnection
+
+
+# throw away everything written so far in this request.
+# used when a route catches an error and shows it to the user instead of failing.
+def rollbackDBSession():
+    if 'dbConnection' in g:
+        g.dbConnection.rollback()
+    g.pop('afterCommit', None)
+    g.pop('identityMap', None)
+
+
+# call func once the request's writes are committed, e.g. to drop cached copies of
+# rows it changed. Outside of a request querySQL has already committed, so it's called now.
+def runAfterCommit(func):
+    if has_request_context():
+        g.setdefault('afterCommit', []).append(func)
+    else:
+        func()
+
+
+# a connection to use directly, e.g. when a cursor's rowcount is needed.
+# inside a request it's the request's session, committed with everything else. Outside
+# of a request it's a pooled connection, committed when the with block ends.
+@contextmanager
+def dbSession():
+    if has_request_context():
+        yield getRequestDB()
+        return
+
+    with DB_Pool.getPool().connection() as connection:
+        yield connection
+        connection.commit()
+
+
+@app.after_request
+def commitDBSession(response):
+    committed = response.status_code < 400
+    if 'dbConnection' in g:
+        if committed:
+            g.dbConnection.commit()
+        else:
+            g.dbConnection.rollback()
+    if committed:
+        for func in g.pop('afterCommit', []):
+            func()
+    return response
+
+
+# always runs, even when the route raised. Anything not committed by then is rolled back
+# when the connection goes back to the pool.
+@app.teardown_request
+def closeDBSession(exc=None):
+    connection = g.pop('dbConnection', None)
+    if connection is not None:
+        if exc is not None:
+            connection.rollback()
+        DB_Pool.getPool().giveBack(connection)
+
+
+### Request-scoped identity map ###
+# the user, vehicle and service item rows a request has read, by table and key, so an ID
+# validated from the URL and then shown (or updated) costs one query. Writing to a table
+# drops the request's rows from it (see invalidateTables), as does rolling back.
+# outside of a request every lookup goes to the database.
+
+# returns the row for key from the request's identity map, calling load(key) the first
+# time. A None (no such row) is remembered too.
+def fromIdentityMap(table, key, load):
+    if not has_request_context():
+        return load(key)
+    rows = g.setdefault('identityMap', {}).setdefault(table, {})
+    if key not in rows:
+        rows[key] = load(key)
+    return rows[key]
+
+
+# forget the request's rows from tables, e.g. after writing to them.
+def forgetRows(tables):
+    if has_request_context() and 'identityMap' in g:
+        for table in tables:
+            g.identityMap.pop(table.lower(), None)
+
+
+# the columns of each DB_Rows type, in field order, for SELECTs that build typed rows.
+USERCOLUMNS = 'users.userID, users.username, users.phone, users.notifyDigest'
+SERVICEITEMCOLUMNS = '''serviceSchedule.itemID, serviceSchedule.vehicleID, serviceSchedule.userID,
+    serviceSchedule.catalogID, serviceCatalog.description, serviceSchedule.serviceInterval,
+    serviceSchedule.milesLastDone, serviceSchedule.dueAtMiles, serviceSchedule.servDueFlag'''  # needs the serviceCatalog JOIN
+
+
+# a function because estMiles depends on today's date.
+def vehicleColumns():
+    return f'''vehicles.vehicleID, vehicles.userID, vehicles.vehNickname, vehicles.make, vehicles.model,
+    vehicles.year, vehicles.displayName, vehicles.miles, vehicles.dateLastODO, vehicles.milesPerDay,
+    {estMilesSQL()}'''
+
+
+# returns the user's User row, or None if there's no such user.
+def getUserRow(userID):
+    def load(userID):
+        res = querySQL(stmt=f'''
+            SELECT {USERCOLUMNS} FROM users
+            WHERE userID = %s
+        ''', val=(userID, ), rowType=User)
+        return res[0] if res else None
+
+    return fromIdentityMap('users', userID, load)
+
+
+# returns the vehicle's Vehicle row, or None if there's no such vehicle.
+def getVehicleRow(vehicleID):
+    def load(vehicleID):
+        res = querySQL(stmt=f'''
+            SELECT {vehicleColumns()}
+            FROM vehicles
+            WHERE vehicleID = %s
+        ''', val=(vehicleID, ), rowType=Vehicle)
+        return res[0] if res else None
+
+    return fromIdentityMap('vehicles', vehicleID, load)
+
+
+# returns the item's ServiceItem row, or None if there's no such item.
+def getServiceItemRow(itemID):
+    def load(itemID):
+        res = querySQL(stmt=f'''
+            SELECT {SERVICEITEMCOLUMNS}
+            FROM serviceSchedule
+            JOIN serviceCatalog ON serviceCatalog.catalogID = serviceSchedule.catalogID
+            WHERE serviceSchedule.itemID = %s
+        ''', val=(itemID, ), rowType=ServiceItem)
+        return res[0] if res else None
+
+    return fromIdentityMap('serviceschedule', itemID, load)
+
+
+### phone number -> user cache ###
+# every inbound text is matched to its user by phone number, and those almost never
+# change. Numbers with no user are remembered for a shorter time so repeated texts
+# from unknown numbers don't each reach the database.
+phoneUserCache = LRU_Cache.LRUCache(ttl=PHONECACHETTL, negativeTtl=PHONECACHENEGATIVETTL)
+
+
+# returns the userID with the given phone number, or None if there isn't one.
+def getUserIDByPhone(phone):
+    def load(phone):
+        res = querySQL(stmt="""
+            SELECT userID FROM users
+            WHERE phone = %s
+        """, val=(phone,))
+        return res[0][0] if res else None
+
+    return phoneUserCache.get(phone, load)
+
+
+# must be called by anything that adds a user, changes a user's phone number
+# (for both the old and new numbers) or removes a user.
+def invalidatePhoneUser(phone):
+    runAfterCommit(lambda: phoneUserCache.invalidate(phone))
+
+
+### list total counts ###
+# the totals shown on paginated lists. COUNT(*) over all users reads the whole table,
+# so that total comes from the table statistics instead, and every total is cached
+# for COUNTCACHETTL seconds.
+countCache = LRU_Cache.LRUCache(ttl=COUNTCACHETTL)
+
+
+# returns (number of users, True if it's an estimate).
+# information_schema's row estimate can be off by a lot (and is itself cached by
+# MySQL), so small tables are counted exactly.
+def getUserCount():
+    def load(key):
+        res = querySQL(stmt='''
+            SELECT table_rows FROM information_schema.tables
+            WHERE table_schema = DATABASE()
+            AND table_name = 'users'
+        ''')
+        estimate = (res[0][0] or 0) if res else 0
+        if estimate < COUNTEXACTBELOW:
+            return (querySQL(stmt='SELECT COUNT(*) FROM users')[0][0], False)
+        return (estimate, True)
+
+    return countCache.get('users', load)
+
+
+# returns the number of vehicles userID has. Counted on the vehicles_user_odo index.
+def getVehicleCount(userID):
+    def load(key):
+        res = querySQL(stmt='''
+            SELECT COUNT(*) FROM vehicles
+            WHERE userID = %s
+        ''', val=(userID, ))
+        return res[0][0]
+
+    return countCache.get(('vehicles', userID), load)
+
+
+# must be called by anything that adds or removes users or vehicles.
+def invalidateCounts(userID=None):
+    runAfterCommit(lambda: countCache.invalidate('users'))
+    if userID is not None:
+        runAfterCommit(lambda: countCache.invalidate(('vehicles', userID)))
+
+
+### inbound message idempotency ###
+# Twilio retries a webhook it didn't get an answer to in time, so the same text
+# (same MessageSid) can arrive more than once. The reply to each one is kept in
+# processedMessages, with recent ones also in memory, and a repeat gets the original
+# reply again without anything being re-applied.
+processedMessageCache = LRU_Cache.LRUCache(maxSize=PROCESSEDMSGCACHESIZE, ttl=PROCESSEDMSGKEEPHOURS * 3600)
+
 
-            # if the statement begins with INSERT (not case sensitive)
-            # get the last inserted primary key to return.
-            # and toss whatever was in the cursor before.
-            if 'INSERT INTO'.lower() in stmt.lower() or \
-                    'UPDATE'.lower() in stmt.lower():
-                result = c1.lastrowid
+# returns the reply already sent for messageSid, or None if it hasn't been processed.
+# looked up by primary key before anything else is done for the text, so a retry is
+# answered without locking or writing the vehicle tables.
+def getProcessedReply(messageSid):
+    replay = processedMessageCache.peek(messageSid)
+    if replay is not None:
+        return replay
 
+    res = querySQL(stmt='''
+        SELECT response FROM processedMessages
+        WHERE messageSid = %s
+    ''', val=(messageSid, ))
+    if not res:
+        return None
+    processedMessageCache.put(messageSid, res[0][0])
+    return res[0][0]
+
+
+# record messageSid as processed with the given reply, as part of the request's transaction.
+# if another request has already recorded it, waits for that one to commit. Then
+# everything this request wrote is rolled back and the reply that was stored first
+# is returned.
+# returns None if this request is the one that processed the message.
+def claimProcessedMessage(messageSid, response):
+    c1 = getRequestDB().cursor()
+    c1.execute('''
+        INSERT IGNORE INTO processedMessages (messageSid, response)
+        VALUES (%s, %s)
+    ''', (messageSid, response))
+    claimed = c1.rowcount == 1
+    c1.close()
+
+    if claimed:
+        invalidateTables(['processedMessages'])
+        runAfterCommit(lambda: processedMessageCache.put(messageSid, response))
+        return None
+
+    rollbackDBSession()
+    res = querySQL(stmt='''
+        SELECT response FROM processedMessages
+        WHERE messageSid = %s
+    ''', val=(messageSid, ))
+    processedMessageCache.put(messageSid, res[0][0])
+    return res[0][0]
+
+
+# delete replies older than PROCESSEDMSGKEEPHOURS, a chunk at a time.
+# returns the number deleted.
+def purgeProcessedMessages():
+    deleted = 0
+    with DB_Pool.getPool().connection() as connection:
+        c1 = connection.cursor()
+        while True:
+            c1.execute('''
+                DELETE FROM processedMessages
+                WHERE receivedAt < NOW() - INTERVAL %s HOUR
+                LIMIT %s
+            ''', (PROCESSEDMSGKEEPHOURS, PROCESSEDMSGPURGECHUNK))
             connection.commit()
+            deleted += c1.rowcount
+            if c1.rowcount < PROCESSEDMSGPURGECHUNK:
+                break
+        c1.close()
+    invalidateTables(['processedMessages'], committed=True)
 
-            return result
-    except Error as e:
-        # breakpoint()
-        raise Exception(e)
+    return deleted
 
 
+# send one text. returns the provider's message sid.
 def sendSMS(recip="", msg=""):
-    account_sid = os.environ["TWILIO_ACCOUNT_SID"]
-    auth_token = os.environ["TWILIO_AUTH_TOKEN"]
-    client = Client(account_sid, auth_token)
+    return SMS_Dispatch.sendSMS(recip=recip, msg=msg)
 
-    message = client.messages.create(
-        body=msg,
-        from_="+18665934611",
-        to=recip,
-    )
 
 
 # get eligible vehicle for the user.
 def getUserUpdateVehicle(userID):
-    result = querySQL(f'''
+    result = querySQL('''
         SELECT vehicleID
         FROM vehicles
-        WHERE userID = {userID}
+        WHERE userID = %s
         AND (dateLastODO IS NULL OR miles IS NULL)
         LIMIT 1
-    ''')
+    ''', val=(userID, ))
 
     if result != []:
         return result[0][0]
     else:
-        result = querySQL(f'''
+        result = querySQL('''
             SELECT vehicleID FROM vehicles
-            WHERE userID = {userID}
-            AND DATEDIFF('{getDateToday()}', dateLastODO) > {ODOPROMPTINTERVAL}
+            WHERE userID = %s
+            AND dateLastODO < %s
             ORDER BY dateLastODO ASC
             LIMIT 1
-        ''')
+        ''', val=(userID, getDateAgoStr(ODOPROMPTINTERVAL)))
         if result == []:
             return None
         else:
@@ -174,7 +604,7 @@ def promptUserForOneVeh(usrID=0):
             WHERE vehicleID = {vehID}
     ''')
 
-    displayName = queryResult[0]
+    displayName = queryResult[0][0]
 
     # we need the user name and the phone number from the user.
     queryResult = querySQL(stmt=f'''
@@ -183,11 +613,71 @@ def promptUserForOneVeh(usrID=0):
     ''')
     (username, phone) = queryResult[0]
 
-    msg = f"""Hey {username}, Service Reminders here. Please reply with an odometer reading for {displayName}."""
+    msg = ODOPROMPTSMS.format(username=username, displayName=displayName)
 
     return phone, msg
 
 
+# find and lock the vehicle a user's odometer reply is for, picked the same way as
+# getUserUpdateVehicle, in one query. The row stays locked until the transaction
+# ends, so a second reply arriving at the same time waits and then sees the first
+# reply's reading instead of updating the vehicle from stale values.
+# returns the vehicle's Vehicle row, or None if no vehicle needs a reading.
+def lockUserUpdateVehicle(userID):
+    res = querySQL(stmt=f'''
+        SELECT {vehicleColumns()}
+        FROM vehicles
+        WHERE userID = %s
+        AND (dateLastODO IS NULL OR miles IS NULL OR dateLastODO < %s)
+        ORDER BY (dateLastODO IS NULL OR miles IS NULL) DESC, dateLastODO ASC, vehicleID ASC
+        LIMIT 1
+        FOR UPDATE
+    ''', val=(userID, getDateAgoStr(ODOPROMPTINTERVAL)), rowType=Vehicle)
+
+    return res[0] if res else None
+
+
+# record a reading for a vehicle row from lockUserUpdateVehicle, in one statement.
+# raises TypeError and ValueError like updateODO.
+def recordOdoReading(vehicle, newODO=0):
+    querySQL(stmt='''
+        UPDATE vehicles
+        SET miles = %s, dateLastODO = %s, milesPerDay = %s
+        WHERE vehicleID = %s
+    ''', val=(*computeOdoUpdate(vehicle.miles, vehicle.dateLastODO, vehicle.milesPerDay, newODO=newODO),
+             vehicle.vehicleID))
+
+
+# plan the odometer prompts for every user in one query.
+# picks the same vehicle promptUserForOneVeh would for each user who has a vehicle
+# whose reading is more than ODOPROMPTINTERVAL days old: a vehicle with no odometer
+# reading first, otherwise the one with the oldest reading.
+# yields (phone, msg) ready to send, ordered by userID, as the rows are read.
+def planOdoPrompts():
+    staleBefore = getDateAgoStr(ODOPROMPTINTERVAL)
+    res = querySQLIter(stmt='''
+        SELECT phone, username, displayName FROM (
+            SELECT users.userID, users.phone, users.username, vehicles.displayName,
+                ROW_NUMBER() OVER (
+                    PARTITION BY vehicles.userID
+                    ORDER BY (vehicles.dateLastODO IS NULL OR vehicles.miles IS NULL) DESC,
+                        vehicles.dateLastODO ASC, vehicles.vehicleID ASC
+                ) AS priority,
+                MAX(vehicles.dateLastODO < %s)
+                    OVER (PARTITION BY vehicles.userID) AS userIsStale
+            FROM vehicles
+            JOIN users ON users.userID = vehicles.userID
+            WHERE vehicles.dateLastODO IS NULL OR vehicles.miles IS NULL
+                OR vehicles.dateLastODO < %s
+        ) AS ranked
+        WHERE priority = 1 AND userIsStale
+        ORDER BY userID
+    ''', val=(staleBefore, staleBefore))
+
+    for (phone, username, displayName) in res:
+        yield phone, ODOPROMPTSMS.format(username=username, displayName=displayName)
+
+
 # def:
 # update a vehicle odometer in database with the given odo
 # this should check that the new ODO reading is greater than the previous ODO reading. Should reply to the user confirming the reading or prompting again if the reading contains an error.
@@ -205,14 +695,29 @@ def updateODO(vehID=0, newODO=0):
         SELECT miles, dateLastODO, milesPerDay 
         FROM vehicles
         WHERE vehicleID = %s
+        FOR UPDATE
     ''', val=(vehID, ))
 
     if res == []:
         raise NotInDatabaseError(NOTINDB.format(type='vehicle', id=vehID))
 
-    curMiles, curOdoDate, curMilesPerDay = res[0]
+    querySQL(stmt='''
+        UPDATE vehicles
+        SET miles = %s, dateLastODO = %s, milesPerDay = %s
+        WHERE vehicleID = %s
+    ''', val=(*computeOdoUpdate(*res[0], newODO=newODO, today=today), vehID))
+
 
-    # In updateODO we want to detect if current odo is None. We need to make a sepcial case.
+# the odometer rules shared by everything that records a reading.
+# takes the vehicle's current miles, dateLastODO and milesPerDay and the new reading.
+# returns the (miles, dateLastODO, milesPerDay) to store.
+# raises TypeError if newODO isn't a number.
+# raises ValueError if newODO is negative or less than the current odometer.
+def computeOdoUpdate(curMiles, curOdoDate, curMilesPerDay, newODO=0, today=None):
+    if today is None:
+        today = getDateToday()
+
+    # We want to detect if current odo is None. We need to make a sepcial case.
     # and take a sepcial default action that doesn't blow up the mileage estimates.
     # In that case, let miles per day be 0 to prevent unneccesary service reminders
     # until there is a regular cadence of updates.
@@ -245,11 +750,7 @@ def updateODO(vehID=0, newODO=0):
     except ZeroDivisionError:
         newMilesPerDay = curMilesPerDay
 
-    querySQL(stmt='''
-        UPDATE vehicles
-        SET miles = %s, dateLastODO = %s, milesPerDay = %s
-        WHERE vehicleID = %s
-    ''', val=( round(newODO,1), today, newMilesPerDay, vehID ))
+    return round(newODO, 1), today, newMilesPerDay
 
 
 # def:
@@ -265,19 +766,14 @@ def updateServiceDone(itemID: int, itemODO: float):
     or greater than the max value allowable in the DB - service interval.
     '''
 
-    res = querySQL(stmt='''
-        SELECT serviceInterval, milesLastDone FROM serviceSchedule
-        WHERE itemID = %s
-    ''', val=(itemID, ))
-    if res == []:
-        raise NotInDatabaseError(NOTINDB)
-    interval, lastMiles = res[0]
+    # in a request these usually come from the identity map, already read by validateItemIdInURL.
+    item = getServiceItemRow(itemID)
+    if item is None:
+        raise NotInDatabaseError(NOTINDB.format(type='service item', id=itemID))
+    interval, lastMiles = item.serviceInterval, item.milesLastDone
 
-    res = querySQL(f"""
-        SELECT vehicleID, miles FROM vehicles
-        WHERE vehicles.vehicleID = (SELECT vehicleID FROM serviceSchedule WHERE serviceSchedule.itemID = {itemID})
-    """)
-    vehID, parentMiles = res[0]
+    vehicle = getVehicleRow(item.vehicleID)
+    vehID, parentMiles = vehicle.vehicleID, vehicle.miles
 
     # check for not the right type
     try:
@@ -285,10 +781,11 @@ def updateServiceDone(itemID: int, itemODO: float):
     except ValueError:
         raise TypeError(NOTANUMBER)
     
+    maxItemODO = getMaxTheoValueDecimal(tableName='serviceSchedule', columnName='dueAtMiles') - float(interval)
     if itemODO < 0:
         raise ValueError(BELOWZERO.format(what='itemODO'))
-    elif itemODO > (getMaxTheoValueDecimal(tableName='serviceSchedule', columnName='dueAtMiles') - float(interval)):
-        raise ValueError(ABOVEMAX + str(getMaxTheoValueDecimal(tableName='serviceSchedule', columnName='dueAtMiles') - interval) + ' miles')
+    elif itemODO > maxItemODO:
+        raise ValueError(ABOVEMAX.format(max=maxItemODO) + ' miles')
     elif itemODO < lastMiles:
         raise ValueError(ODODECREASING + lastMiles + 'miles, when this service was last done.')
 
@@ -299,20 +796,30 @@ def updateServiceDone(itemID: int, itemODO: float):
         # update the miles of the parent vehicle.
         updateODO(vehID, itemODO)
 
-    # remove the service flag.
+    # remove the service flag, and start the notification history over for the next time it's due.
     querySQL('''
         UPDATE serviceSchedule
-        SET milesLastDone = %s, servDueFlag = FALSE
+        SET milesLastDone = %s, servDueFlag = FALSE,
+            lastNotifiedAt = NULL, lastNotifiedEstMiles = NULL, notifyCount = 0
         WHERE itemID = %s
     ''', val=(itemODO, itemID))
 
 
+# format the text message for one due service item.
+def formatServiceNotification(username, displayName, desc, dueAt):
+    return SERVICENOTIFICATION.format(username=username,
+        displayName=displayName, desc=desc, dueAt=dueAt)
+
+
 # def:
 # check the database for service that is due and notify the relevant user. The caller of this function sets the frequency of the reminders.
 def notifyOneService(serviceItemID):
     res = querySQL(stmt='''
-        SELECT userID, vehicleID, description, dueAtMiles FROM serviceSchedule
-        WHERE itemID = %s
+        SELECT serviceSchedule.userID, serviceSchedule.vehicleID, serviceCatalog.description,
+            serviceSchedule.dueAtMiles
+        FROM serviceSchedule
+        JOIN serviceCatalog ON serviceCatalog.catalogID = serviceSchedule.catalogID
+        WHERE serviceSchedule.itemID = %s
     ''', val=(serviceItemID, ))
 
     if res == []:
@@ -332,80 +839,653 @@ def notifyOneService(serviceItemID):
 
     displayName = res[0][0]
 
-    msg = SERVICENOTIFICATION.format(username=username, 
-        displayName=displayName, desc=desc, dueAt=dueAt)
+    msg = formatServiceNotification(username, displayName, desc, dueAt)
 
     return phone, msg
 
 
+# yields one row per flagged service item that should be notified:
+# (itemID, userID, vehicleID, phone, username, notifyDigest, displayName, description, dueAtMiles)
+# ordered by user, then vehicle, so digests can be built as the rows stream in.
+# items that have already been notified are left out until they pass the re-notify
+# point: RENOTIFYAFTERDAYS days or RENOTIFYAFTERMILES estimated miles later.
+# everything comes from one JOIN query, streamed chunkSize rows at a time (see
+# querySQLIter), so neither the number of queries nor the memory used grows with the
+# number of flagged items.
+def iterFlaggedItems(chunkSize=NOTIFYCHUNKSIZE):
+    yield from querySQLIter(stmt=f'''
+        SELECT serviceSchedule.itemID, users.userID, vehicles.vehicleID, users.phone,
+            users.username, users.notifyDigest, vehicles.displayName,
+            serviceCatalog.description, serviceSchedule.dueAtMiles
+        FROM serviceSchedule
+        JOIN serviceCatalog ON serviceCatalog.catalogID = serviceSchedule.catalogID
+        JOIN users ON users.userID = serviceSchedule.userID
+        JOIN vehicles ON vehicles.vehicleID = serviceSchedule.vehicleID
+        WHERE serviceSchedule.servDueFlag = TRUE
+        AND (serviceSchedule.lastNotifiedAt IS NULL
+            OR serviceSchedule.lastNotifiedAt <= %s
+            OR {estMilesSQL()} - serviceSchedule.lastNotifiedEstMiles >= %s)
+        ORDER BY users.userID, vehicles.vehicleID, serviceSchedule.itemID
+    ''', val=(getDateAgoStr(RENOTIFYAFTERDAYS), RENOTIFYAFTERMILES), batchSize=chunkSize)
+
+
+# number of segments a text message is billed as.
+# GSM-7 messages fit 160 characters in one segment or 153 per segment when split
+# (characters from the extension table count twice). Anything else is sent as UCS-2:
+# 70 UTF-16 code units in one segment, or 67 per segment.
+def smsSegments(msg=""):
+    if all(char in GSM7CHARS or char in GSM7EXTCHARS for char in msg):
+        length = len(msg) + sum(1 for char in msg if char in GSM7EXTCHARS)
+        single, multi = 160, 153
+    else:
+        length = len(msg.encode('utf-16-le')) // 2
+        single, multi = 70, 67
+
+    if length <= single:
+        return 1
+    return -(-length // multi)
+
+
+# build the message(s) for a group of flagged item rows (from iterFlaggedItems) that
+# go to the same user. A single item gets the usual SERVICENOTIFICATION. Several items
+# are packed into as few messages as possible, each at most SMSDIGESTMAXSEGMENTS long.
+# byVehicle means every row is for the same vehicle.
+# yields (itemIDs, phone, msg).
+def buildServiceDigest(rows, byVehicle=False):
+    (itemID, userID, vehID, phone, username, digest, displayName, desc, dueAt) = rows[0]
+    if len(rows) == 1:
+        yield [itemID], phone, formatServiceNotification(username, displayName, desc, dueAt)
+        return
+
+    if byVehicle:
+        header = SERVICEDIGESTVEHICLE.format(username=username, displayName=displayName)
+    else:
+        header = SERVICEDIGESTUSER.format(username=username)
+
+    msg = header
+    itemIDs = []
+    for (itemID, userID, vehID, phone, username, digest, displayName, desc, dueAt) in rows:
+        line = SERVICEDIGESTLINE.format(desc=desc, dueAt=dueAt)
+        if not byVehicle:
+            line = f'{displayName}: {line}'
+
+        # start a new message if this line would push the current one over the limit.
+        if itemIDs and smsSegments(msg + '\n' + line) > SMSDIGESTMAXSEGMENTS:
+            yield itemIDs, phone, msg
+            msg = header
+            itemIDs = []
+
+        msg += '\n' + line
+        itemIDs.append(itemID)
+
+    yield itemIDs, phone, msg
+
+
+# yields (itemIDs, phone, msg) for every flagged service item, grouping each user's
+# items into digests according to their notifyDigest setting:
+# 'off' for one text per item, 'user' for one per user, 'vehicle' for one per vehicle.
+def iterServiceNotifications(chunkSize=NOTIFYCHUNKSIZE):
+    group = []
+    groupKey = None
+    for row in iterFlaggedItems(chunkSize):
+        (itemID, userID, vehID, phone, username, digest, displayName, desc, dueAt) = row
+        if digest == 'user':
+            key = ('user', userID)
+        elif digest == 'vehicle':
+            key = ('vehicle', userID, vehID)
+        else:
+            key = ('item', itemID)
+
+        if group and key != groupKey:
+            yield from buildServiceDigest(group, byVehicle=(groupKey[0] == 'vehicle'))
+            group = []
+        group.append(row)
+        groupKey = key
+
+    if group:
+        yield from buildServiceDigest(group, byVehicle=(groupKey[0] == 'vehicle'))
+
+
+# record that the given items were notified today, at their vehicle's current estimated miles.
+# runs on cursor; the caller commits.
+def markNotified(cursor, itemIDs):
+    for start in range(0, len(itemIDs), NOTIFYCHUNKSIZE):
+        chunk = itemIDs[start:start + NOTIFYCHUNKSIZE]
+        cursor.execute(f'''
+            UPDATE serviceSchedule
+            JOIN vehicles ON vehicles.vehicleID = serviceSchedule.vehicleID
+            SET serviceSchedule.lastNotifiedAt = %s,
+                serviceSchedule.lastNotifiedEstMiles = {estMilesSQL()},
+                serviceSchedule.notifyCount = serviceSchedule.notifyCount + 1
+            WHERE serviceSchedule.itemID IN ({', '.join(['%s'] * len(chunk))})
+        ''', (getDateTodayStr(), *chunk))
+
+
 # def:
-# check the DB for service that is due and call notifyOneService for each item due.
-# Send the returned message to the returned phone number by calling sendSMS
+# check the DB for service that is due and queue notifications for the items that are
+# newly due or past their re-notify point.
+# the notifications are queued OUTBOXENQUEUECHUNK messages at a time, each chunk in one
+# transaction with marking its items notified, so memory doesn't grow with the number of
+# items, and a run that stops part way leaves nothing queued but unmarked to be sent twice.
+# the SMS_Outbox workers do the sending.
+# returns the number of items notified.
 def notifyAllService():
-    query = """
-        SELECT itemID FROM serviceSchedule
-        WHERE servDueFlag = TRUE
-    """
-    flaggedItems = querySQL(stmt=query)
+    count = 0
+    with DB_Pool.getPool().connection() as connection:
+        c1 = connection.cursor()
 
-    # get the ymm and nick of the vehicle in the item
-    # get the username and phone number of the user
-    # {username}, your {ymm}/{nick} is due for {item} at {x} miles.
-    for item in flaggedItems:
-        phone, msg = notifyOneService(item[0])
+        def flush(chunk):
+            SMS_Outbox.addToOutbox(c1, [(phone, msg) for (itemIDs, phone, msg) in chunk])
+            markNotified(c1, [itemID for (itemIDs, phone, msg) in chunk for itemID in itemIDs])
+            connection.commit()
+            invalidateTables(['serviceSchedule'], committed=True)
+            return sum(len(itemIDs) for (itemIDs, phone, msg) in chunk)
+
+        # {username}, your {ymm}/{nick} is due for {item} at {x} miles.
+        chunk = []
+        for notification in iterServiceNotifications():
+            chunk.append(notification)
+            if len(chunk) >= SMS_Outbox.OUTBOXENQUEUECHUNK:
+                count += flush(chunk)
+                chunk = []
+        if chunk:
+            count += flush(chunk)
 
-        # send the message.
-        sendSMS(recip=phone, msg=msg)
+        c1.close()
 
-    return flaggedItems
+    return count
 
 
 # def:
 # should be called at least every day.
 # check on the vehicle database, update values, and call for sending messages to the user. This should happen at a regular interval determined by the caller.
 def dailyMaint():
-    # get a list of userIDs which are from vehicles which have out of date ODO readings.
-    query = f"""
-        SELECT DISTINCT userID FROM vehicles
-        WHERE DATEDIFF('{getDateTodayStr()}', dateLastODO) > '{ODOPROMPTINTERVAL}'
-    """
-    queryResult = querySQL(stmt=query)
-    # sort the list by userID, then by dateLastODO oldest to newest. This ensures that the highest priority is to query the most out of date vehicle.
-    for usr in queryResult:
-        phone, msg = promptUserForOneVeh(usr[0])
-        sendSMS(recip=phone, msg=msg)
-
-    # calculate a new mileage estimate for all vehicles.
-    # deal with the case in which miles is NULL.
-    # if miles is NULL, estMiles and milesPerDay should be set to 0.
-    # For code robustness, but not really a high-demand case, do the same
-    # when milesPerDay is NULL as well we are setting estMiles so no need for that.
-
-    # THE ORDER OF THESE QUERIES IS IMPORTANT
-    queryForNull = f"""
-        UPDATE vehicles
-        SET estMiles = 0,
-            milesPerDay = 0
-        WHERE miles IS NULL OR milesPerDay IS NULL
-    """
-    querySQL(stmt=queryForNull)
-    # now milesPerDay is never null.
-    queryForNotNull = f"""
-        UPDATE vehicles
-        SET estMiles = (vehicles.miles +
-            vehicles.milesPerDay * DATEDIFF('{getDateTodayStr()}', vehicles.dateLastODO))
-        WHERE miles IS NOT NULL
-    """
-    querySQL(stmt=queryForNotNull)
+    # prompt every user who has vehicles with out of date ODO readings, for their
+    # highest priority vehicle. The whole plan comes from one query, streamed into the
+    # outbox, and the SMS_Outbox workers start sending as soon as the first chunk is queued.
+    SMS_Outbox.enqueueSMS(planOdoPrompts())
+
+    # estimated miles are worked out when they are read (see estMilesSQL),
+    # so nothing needs to be written to the vehicles table here.
 
     # for each service item, if deadline-odoEst < some constant, set the flag.
-    servDueThresh = 500
-    querySQL(stmt=f"""
-        UPDATE serviceSchedule
-        SET servDueFlag = TRUE
-        WHERE (serviceSchedule.dueAtMiles - (SELECT estMiles FROM vehicles WHERE vehicles.vehicleID = serviceSchedule.vehicleID))
-             < {servDueThresh}
-    """)
+    for (lastItemID, rows, seconds) in flagDueServices():
+        print(f'dailyMaint: flagged {rows} service items up to itemID {lastItemID} in {seconds:.3f}s')
+
+    # replies to inbound texts are only needed for as long as Twilio might retry them.
+    purgeProcessedMessages()
+
+
+# set servDueFlag on every item within SERVDUETHRESH estimated miles of its deadline.
+# the table is walked in itemID order, batchSize items per transaction, so the
+# rows locked at any one time (and the wait for /receive_sms writes to them) stay
+# small however big serviceSchedule gets.
+# returns a list of (last itemID in chunk, rows flagged, seconds), one per chunk.
+def flagDueServices(batchSize=SERVDUEBATCHSIZE):
+    chunks = []
+    lastItemID = 0
+    with DB_Pool.getPool().connection() as connection:
+        c1 = connection.cursor()
+        while True:
+            start = time.perf_counter()
+            c1.execute('''
+                SELECT MAX(itemID) FROM (
+                    SELECT itemID FROM serviceSchedule
+                    WHERE itemID > %s
+                    ORDER BY itemID
+                    LIMIT %s
+                ) AS chunk
+            ''', (lastItemID, batchSize))
+            chunkEnd = c1.fetchall()[0][0]
+            if chunkEnd is None:
+                break
+
+            c1.execute(f'''
+                UPDATE serviceSchedule
+                JOIN vehicles ON vehicles.vehicleID = serviceSchedule.vehicleID
+                SET serviceSchedule.servDueFlag = TRUE
+                WHERE serviceSchedule.itemID > %s AND serviceSchedule.itemID <= %s
+                AND serviceSchedule.servDueFlag = FALSE
+                AND serviceSchedule.dueAtMiles - {estMilesSQL()} < %s
+            ''', (lastItemID, chunkEnd, SERVDUETHRESH))
+            rows = c1.rowcount
+            connection.commit()
+
+            chunks.append((chunkEnd, rows, time.perf_counter() - start))
+            lastItemID = chunkEnd
+        c1.close()
+    invalidateTables(['serviceSchedule'], committed=True)
+
+    return chunks
+
+
+### Service catalog and templates ###
+# every service description is stored once in serviceCatalog and referenced from
+# serviceSchedule by catalogID. A template is a named schedule of catalog items and
+# their intervals (e.g. "Toyota 5k synthetic") that can be added to one vehicle, a
+# user's whole garage, or every vehicle of a make/model/year in one INSERT ... SELECT.
+
+# returns the catalogID for a service description, adding it to the catalog if it's new.
+def getCatalogID(description):
+    # LAST_INSERT_ID(catalogID) makes lastrowid the existing row's ID when the description is already there.
+    return querySQL(stmt='''
+        INSERT INTO serviceCatalog (description) VALUES (%s)
+        ON DUPLICATE KEY UPDATE catalogID = LAST_INSERT_ID(catalogID)
+    ''', val=(description, ))
+
+
+# parse a template's items as typed in the form: one "description, interval" per line.
+# returns [(description, interval), ...].
+# raises FormInputError
+def parseTemplateItems(text):
+    items = []
+    for (lineNum, line) in enumerate(text.splitlines(), start=1):
+        if line.strip() == '':
+            continue
+        (description, sep, interval) = line.rpartition(',')
+        description = description.strip()
+        try:
+            interval = int(interval)
+        except ValueError:
+            raise FormInputError(TEMPLATEBADITEM.format(line=lineNum))
+        if not sep or description == '' or interval <= 0:
+            raise FormInputError(TEMPLATEBADITEM.format(line=lineNum))
+        items.append((description, interval))
+
+    return items
+
+
+# add a template called name with items [(description, serviceInterval), ...].
+# a description listed twice keeps the last interval given.
+# returns the new templateID.
+# raises FormInputError, DuplicateItemError
+def createServiceTemplate(name, items):
+    if name == '':
+        raise FormInputError(FORMFIELDBLANK.format(field='name'))
+    if not items:
+        raise FormInputError(TEMPLATENOITEMS)
+
+    result = querySQL(stmt='''
+        SELECT templateID FROM serviceTemplates
+        WHERE name = %s
+    ''', val=(name, ))
+    if result != []:
+        raise DuplicateItemError(ILLEGALDUPLICATE.format(param=f'Template "{name}"'))
+
+    templateID = querySQL(stmt='''
+        INSERT INTO serviceTemplates (name) VALUES (%s)
+    ''', val=(name, ))
+
+    catalogItems = {}
+    for (description, interval) in items:
+        catalogItems[getCatalogID(description)] = interval
+    querySQL(stmt='''
+        INSERT INTO serviceTemplateItems (templateID, catalogID, serviceInterval)
+        VALUES (%s, %s, %s)
+    ''', val=[(templateID, catalogID, interval) for (catalogID, interval) in catalogItems.items()], many=True)
+
+    return templateID
+
+
+# returns {'id', 'name', 'items': [{'catalogID', 'description', 'serviceInterval'}, ...]}
+# raises NotInDatabaseError
+def getServiceTemplate(templateID):
+    res = querySQL(stmt='''
+        SELECT templateID, name FROM serviceTemplates
+        WHERE templateID = %s
+    ''', val=(templateID, ))
+    if res == []:
+        raise NotInDatabaseError(NOTINDB.format(type='template', id=templateID))
+    template = {'id': res[0][0], 'name': res[0][1], 'items': []}
+
+    res = querySQL(stmt='''
+        SELECT serviceTemplateItems.catalogID, serviceCatalog.description,
+            serviceTemplateItems.serviceInterval
+        FROM serviceTemplateItems
+        JOIN serviceCatalog ON serviceCatalog.catalogID = serviceTemplateItems.catalogID
+        WHERE serviceTemplateItems.templateID = %s
+        ORDER BY serviceCatalog.description
+    ''', val=(templateID, ))
+    for (catalogID, description, interval) in res:
+        template['items'].append({'catalogID': catalogID, 'description': description,
+                                  'serviceInterval': interval})
+
+    return template
+
+
+# add templateID's items to every vehicle matching the filters, in one statement.
+# filters are vehicleID, userID, make, model and year; they combine with AND and at
+# least one is required, so a template is never applied to every vehicle by accident.
+# items a vehicle already has are skipped, so applying a template again adds nothing.
+# new items count as last done at the vehicle's current odometer reading.
+# returns the number of service items added.
+# raises NotInDatabaseError, FormInputError
+def applyServiceTemplate(templateID, vehicleID=None, userID=None, make=None, model=None, year=None):
+    filters = {'vehicleID': vehicleID, 'userID': userID, 'make': make, 'model': model, 'year': year}
+    filters = {column: value for (column, value) in filters.items() if value not in (None, '')}
+    if not filters:
+        raise FormInputError(TEMPLATENOFILTER)
+
+    res = querySQL(stmt='''
+        SELECT templateID FROM serviceTemplates
+        WHERE templateID = %s
+    ''', val=(templateID, ))
+    if res == []:
+        raise NotInDatabaseError(NOTINDB.format(type='template', id=templateID))
+
+    with dbSession() as connection:
+        c1 = connection.cursor()
+        c1.execute(f'''
+            INSERT INTO serviceSchedule (vehicleID, userID, catalogID, serviceInterval, milesLastDone)
+            SELECT vehicles.vehicleID, vehicles.userID, serviceTemplateItems.catalogID,
+                serviceTemplateItems.serviceInterval, COALESCE(vehicles.miles, 0)
+            FROM vehicles
+            JOIN serviceTemplateItems ON serviceTemplateItems.templateID = %s
+            WHERE {' AND '.join(f'vehicles.{column} = %s' for column in filters)}
+            AND NOT EXISTS (
+                SELECT 1 FROM serviceSchedule AS existing
+                WHERE existing.vehicleID = vehicles.vehicleID
+                AND existing.catalogID = serviceTemplateItems.catalogID
+            )
+        ''', (templateID, *filters.values()))
+        added = c1.rowcount
+        c1.close()
+    invalidateTables(['serviceSchedule'])
+
+    return added
+
+
+### Bulk odometer import ###
+# fleet customers upload many readings at once instead of one form per vehicle.
+#   CSV: vehicleID,odometer,date with an optional header row.
+#   JSON: an array of {"vehicleID": 12, "odometer": 34567.8, "date": "2025-09-15"}.
+# the date is YYYY-MM-DD, or left out for today.
+# uploads are parsed as they are read and applied IMPORTCHUNKSIZE rows at a time:
+# one query checks the chunk's vehicles and one UPDATE writes them, in one transaction.
+
+# yields each item of a top-level JSON array, decoding the bytes from stream
+# readSize at a time rather than loading the whole document.
+# raises ValueError if the document isn't a JSON array.
+def iterJSONArray(stream, readSize=IMPORTREADSIZE):
+    decoder = json.JSONDecoder()
+    textDecoder = codecs.getincrementaldecoder('utf-8-sig')()
+    buf = ''
+    pos = 0
+    eof = False
+
+    # read the next block onto the end of the buffer, dropping what has been used.
+    def readMore():
+        nonlocal buf, pos, eof
+        data = stream.read(readSize)
+        eof = not data
+        buf = buf[pos:] + textDecoder.decode(data, final=eof)
+        pos = 0
+
+    # the next character that isn't whitespace, reading more as needed. '' at the end.
+    def peek():
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos].isspace():
+                pos += 1
+            if pos < len(buf) or eof:
+                return buf[pos:pos + 1]
+            readMore()
+
+    if peek() != '[':
+        raise ValueError(IMPORTBADJSON)
+    pos += 1
+    if peek() == ']':
+        return
+
+    while True:
+        peek()
+        try:
+            (item, end) = decoder.raw_decode(buf, pos)
+            # a number right at the end of the buffer may carry on in the next block.
+            complete = end < len(buf) or eof
+        except json.JSONDecodeError:
+            if eof:
+                raise ValueError(IMPORTBADJSON)
+            complete = False
+        if not complete:
+            readMore()
+            continue
+        yield item
+        pos = end
+
+        separator = peek()
+        if separator == ']':
+            return
+        if separator != ',':
+            raise ValueError(IMPORTBADJSON)
+        pos += 1
+
+
+# yields (row number, vehicleID, odometer, date) for each reading in a CSV upload.
+# stream is read a line at a time.
+def iterCSVReadings(stream):
+    reader = csv.reader(codecs.iterdecode(stream, 'utf-8-sig'))
+    for (rowNum, fields) in enumerate(reader, start=1):
+        if not any(field.strip() for field in fields):
+            continue
+        if rowNum == 1 and fields[0].strip().lower() == 'vehicleid':
+            continue
+        fields = [field.strip() for field in fields] + [''] * (len(IMPORTCOLUMNS) - len(fields))
+        yield (rowNum, *fields[:len(IMPORTCOLUMNS)])
+
+
+# yields (row number, vehicleID, odometer, date) for each reading in a JSON upload.
+def iterJSONReadings(stream):
+    for (rowNum, item) in enumerate(iterJSONArray(stream), start=1):
+        if not isinstance(item, dict):
+            item = {}
+        yield (rowNum, *(item.get(column) for column in IMPORTCOLUMNS))
+
+
+# check one uploaded reading and convert its fields.
+# returns (vehicleID, odometer, date).
+# raises FormInputError saying what is wrong with it.
+def parseOdoReading(vehicleID, odometer, readingDate, maxODO, today):
+    for (field, value) in zip(IMPORTCOLUMNS[:2], (vehicleID, odometer)):
+        if value is None or value == '':
+            raise FormInputError(FORMFIELDBLANK.format(field=field))
+    try:
+        vehicleID = int(vehicleID)
+    except (TypeError, ValueError):
+        raise FormInputError(INVALIDPARAM.format(param='vehicleID'))
+    try:
+        if isinstance(odometer, bool):
+            raise ValueError()
+        odometer = float(odometer)
+    except (TypeError, ValueError):
+        raise FormInputError(ODONOTANUMBER)
+    if not isfinite(odometer):
+        raise FormInputError(ODONOTANUMBER)
+    if odometer < 0:
+        raise FormInputError(ODOBELOWZERO)
+    if odometer > maxODO:
+        raise FormInputError(ABOVEMAX.format(max=maxODO))
+
+    if readingDate is None or readingDate == '':
+        readingDate = today
+    else:
+        # a full timestamp (as telematics units send) counts for its date.
+        readingDate = str(readingDate)
+        try:
+            if len(readingDate) > 10:
+                readingDate = datetime.fromisoformat(readingDate.replace('Z', '+00:00')).date()
+            else:
+                readingDate = date.fromisoformat(readingDate)
+        except ValueError:
+            raise FormInputError(IMPORTBADDATE)
+        if readingDate > today:
+            raise FormInputError(IMPORTFUTUREDATE)
+
+    return vehicleID, odometer, readingDate
+
+
+# check and apply one chunk of readings for userID's vehicles in one transaction.
+# readings for the same vehicle are applied in the order given, so a chunk can
+# carry a vehicle's history. Rows with a problem are added to errors and skipped.
+# returns the number of readings applied.
+def applyOdoReadingChunk(connection, userID, chunk, errors, maxODO, today):
+    parsed = []
+    for (rowNum, vehicleID, odometer, readingDate) in chunk:
+        try:
+            parsed.append((rowNum, *parseOdoReading(vehicleID, odometer, readingDate, maxODO, today)))
+        except FormInputError as e:
+            errors.append({'row': rowNum, 'vehicleID': vehicleID, 'error': str(e)})
+
+    if not parsed:
+        return 0
+
+    c1 = connection.cursor()
+    vehicleIDs = sorted({row[1] for row in parsed})
+    c1.execute(f'''
+        SELECT vehicleID, miles, dateLastODO, milesPerDay FROM vehicles
+        WHERE userID = %s
+        AND vehicleID IN ({', '.join(['%s'] * len(vehicleIDs))})
+        FOR UPDATE
+    ''', (userID, *vehicleIDs))
+    current = {row[0]: row[1:] for row in c1.fetchall()}
+
+    applied = 0
+    updates = {}
+    for (rowNum, vehicleID, odometer, readingDate) in parsed:
+        if vehicleID not in current:
+            errors.append({'row': rowNum, 'vehicleID': vehicleID,
+                           'error': IMPORTVEHICLENOTFOUND.format(id=vehicleID)})
+            continue
+        (curMiles, curOdoDate, curMilesPerDay) = current[vehicleID]
+        if curOdoDate and readingDate < curOdoDate:
+            errors.append({'row': rowNum, 'vehicleID': vehicleID, 'error': IMPORTDATEBEFORELAST})
+            continue
+        try:
+            current[vehicleID] = computeOdoUpdate(curMiles, curOdoDate, curMilesPerDay,
+                                                  newODO=odometer, today=readingDate)
+        except (TypeError, ValueError) as e:
+            errors.append({'row': rowNum, 'vehicleID': vehicleID, 'error': str(e)})
+            continue
+        updates[vehicleID] = current[vehicleID]
+        applied += 1
+
+    # every vehicle's final reading in one statement.
+    if updates:
+        c1.execute(f'''
+            UPDATE vehicles
+            JOIN ({' UNION ALL '.join(['SELECT %s AS vehicleID, %s AS miles, %s AS dateLastODO, %s AS milesPerDay'] * len(updates))}
+            ) AS readings ON readings.vehicleID = vehicles.vehicleID
+            SET vehicles.miles = readings.miles, vehicles.dateLastODO = readings.dateLastODO,
+                vehicles.milesPerDay = readings.milesPerDay
+        ''', [value for (vehicleID, update) in updates.items() for value in (vehicleID, *update)])
+
+    connection.commit()
+    c1.close()
+    invalidateTables(['vehicles'], committed=True)
+    return applied
+
+
+# apply readings (from iterCSVReadings or iterJSONReadings) to userID's vehicles,
+# chunkSize rows per transaction.
+# returns a report: {'rows': readings read, 'applied': readings applied,
+# 'errors': [{'row', 'vehicleID', 'error'}, ...], 'seconds': time taken}.
+# raises ValueError if the upload can't be parsed at all; chunks already applied stay applied.
+def importOdoReadings(userID, readings, chunkSize=IMPORTCHUNKSIZE):
+    start = time.perf_counter()
+    maxODO = getMaxTheoValueDecimal(tableName="vehicles", columnName="miles")
+    today = getDateToday()
+    report = {'rows': 0, 'applied': 0, 'errors': []}
+
+    with DB_Pool.getPool().connection() as connection:
+        chunk = []
+        for reading in readings:
+            chunk.append(reading)
+            if len(chunk) >= chunkSize:
+                report['applied'] += applyOdoReadingChunk(connection, userID, chunk, report['errors'], maxODO, today)
+                report['rows'] += len(chunk)
+                chunk = []
+        if chunk:
+            report['applied'] += applyOdoReadingChunk(connection, userID, chunk, report['errors'], maxODO, today)
+            report['rows'] += len(chunk)
+
+    report['seconds'] = round(time.perf_counter() - start, 3)
+    return report
+
+
+# yields (line number, vehicleID, odometer, date) for each reading in a newline-delimited
+# JSON stream, one line at a time as the lines arrive.
+def iterNDJSONReadings(stream):
+    for (lineNum, line) in enumerate(stream, start=1):
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError:
+            item = {}
+        if not isinstance(item, dict):
+            item = {}
+        yield (lineNum, *(item.get(column) for column in IMPORTCOLUMNS))
+
+
+# apply a continuous stream of readings for userID's vehicles, e.g. from telematics units.
+# only the latest reading (by date, then odometer) for each vehicle is kept from each
+# window seconds of the stream, or until maxPending vehicles have readings waiting.
+# These are then written together with applyOdoReadingChunk, so a vehicle reporting
+# every few seconds costs one write per window rather than one per reading.
+# a window is only written once the next reading arrives after it ends, or the stream ends.
+# a pooled connection is borrowed for each write and given back straight after, so a
+# stream that runs for hours doesn't keep one out of the pool.
+# returns a report like importOdoReadings, plus 'coalesced' (readings dropped for a
+# later one of the same vehicle in the same window) and 'batches' (writes made).
+def ingestOdoStream(userID, readings, window=TELEMATICSWINDOW, maxPending=IMPORTCHUNKSIZE, clock=time.monotonic):
+    start = time.perf_counter()
+    maxODO = getMaxTheoValueDecimal(tableName="vehicles", columnName="miles")
+    today = getDateToday()
+    report = {'rows': 0, 'applied': 0, 'coalesced': 0, 'batches': 0, 'errors': []}
+    pending = {}  # vehicleID -> (row number, vehicleID, odometer, date)
+
+    def flush():
+        with DB_Pool.getPool().connection() as connection:
+            report['applied'] += applyOdoReadingChunk(connection, userID, list(pending.values()),
+                                                      report['errors'], maxODO, today)
+        report['batches'] += 1
+        pending.clear()
+
+    windowEnd = clock() + window
+    for (rowNum, vehicleID, odometer, readingDate) in readings:
+        report['rows'] += 1
+        try:
+            (vehicleID, odometer, readingDate) = parseOdoReading(vehicleID, odometer, readingDate, maxODO, today)
+        except FormInputError as e:
+            report['errors'].append({'row': rowNum, 'vehicleID': vehicleID, 'error': str(e)})
+            continue
+
+        kept = pending.get(vehicleID)
+        if kept is not None:
+            report['coalesced'] += 1
+        if kept is None or (readingDate, odometer) >= (kept[3], kept[2]):
+            pending[vehicleID] = (rowNum, vehicleID, odometer, readingDate)
+
+        if len(pending) >= maxPending or clock() >= windowEnd:
+            flush()
+            today = getDateToday()
+            windowEnd = clock() + window
+
+    if pending:
+        flush()
+
+    report['seconds'] = round(time.perf_counter() - start, 3)
+    return report
+
+
+# the readings in an upload, by format.
+# raises FormInputError for a format other than csv or json.
+def iterUploadedReadings(stream, fileFormat):
+    if fileFormat == 'csv':
+        return iterCSVReadings(stream)
+    if fileFormat == 'json':
+        return iterJSONReadings(stream)
+    raise FormInputError(IMPORTBADFORMAT)
 
 
 ### API Routes ###
@@ -416,34 +1496,38 @@ def receiveOdoMsg():
     # don't worry about any input handling except avoiding
     # SQL injection using %s and checking if the user is
     # not in the DB.
+    # the user comes from phoneUserCache, then their vehicle is found and locked in one
+    # query and updated in one more, all in the request's transaction.
     # raises NotInDatabaseError
     def parseRequest():
         # we only care about POSTs from TWILIO so anything else can go ahead and throw some sort of exception
         # just no SQL injection, so use %s
         phone = request.form['From']
-        res = querySQL(stmt="""
-            SELECT userID FROM users
-            WHERE phone = %s
-        """, val=(phone,))
-        if res == []:
+        userID = getUserIDByPhone(phone)
+        if userID is None:
             raise NotInDatabaseError(NOTINDB.format(type='user', id=phone))
 
-        userID = res[0][0]
-
-        vehID = getUserUpdateVehicle(userID)
+        vehicle = lockUserUpdateVehicle(userID)
         odo = request.form['Body']
 
-        return vehID, odo
+        return vehicle, odo
+
+    # a webhook retry of a text already answered gets the same answer again.
+    messageSid = request.form.get('MessageSid')
+    if messageSid:
+        replay = getProcessedReply(messageSid)
+        if replay is not None:
+            return Response(replay, mimetype='text/xml')
 
     resp = MessagingResponse()
     maxODO = getMaxTheoValueDecimal(tableName="vehicles", columnName="miles")
 
     try:
-        vehID, odo = parseRequest()
+        vehicle, odo = parseRequest()
     except NotInDatabaseError:
         errStr = PHONENOTINDBSMS
     else:
-        if not vehID:
+        if not vehicle:
             errStr = NOELIGIBLEVEHICLESMS
         elif not strIsFloat(odo):
             errStr = ODONOTANUMBER
@@ -454,7 +1538,7 @@ def receiveOdoMsg():
         else:
             # lastly, try to update vehicle's ODO and check for a valueerror
             try:
-                updateODO(vehID=vehID, newODO=odo)
+                recordOdoReading(vehicle, newODO=odo)
             except ValueError:
                 errStr = ODODECREASING
             else:
@@ -463,17 +1547,82 @@ def receiveOdoMsg():
     if errStr:
         resp.message(f"Error updating Odometer: {errStr}")
     else:
-        res = querySQL(
-            stmt="""
-                SELECT displayName FROM vehicles
-                WHERE vehicleID = %s
-            """,
-            val=(vehID,)
-        )
-        displayName = res[0][0]
+        displayName = vehicle.displayName
         resp.message(SUCCESSFULODOUPDATESMS + f' for {displayName}')
 
-    return Response(str(resp), mimetype='text/xml')
+    response = str(resp)
+    if messageSid:
+        # a retry handled by another worker (or another process) before this one finished.
+        replay = claimProcessedMessage(messageSid, response)
+        if replay is not None:
+            response = replay
+
+    return Response(response, mimetype='text/xml')
+
+
+# bulk odometer import for a user's vehicles, for scripts and fleet systems.
+# the request body is the upload itself, sent as text/csv or application/json.
+# returns the import report as JSON.
+@app.route("/api/Users/<userID>/Odometers", methods=['POST'])
+def importOdometersAPI(userID):
+    try:
+        userID = validateUserIdInURL(userID).userID
+    except Exception:
+        return jsonify({'error': NOTINDB.format(type='user', id=userID)}), 404
+
+    # give the request's DB connection back; the import borrows its own.
+    closeDBSession()
+
+    fileFormat = {'text/csv': 'csv', 'application/json': 'json'}.get(request.mimetype)
+    try:
+        report = importOdoReadings(userID, iterUploadedReadings(request.stream, fileFormat))
+    except FormInputError as f:
+        return jsonify({'error': str(f)}), 415
+    except ValueError as v:
+        return jsonify({'error': str(v)}), 400
+
+    return jsonify(report)
+
+
+# streaming odometer readings for a user's vehicles, e.g. from OBD/telematics units.
+# the body is newline-delimited JSON (application/x-ndjson), one reading per line, and
+# may be sent chunked for as long as the unit keeps reporting. Lines are handled as
+# they arrive; see ingestOdoStream.
+# returns the ingest report as JSON once the body ends.
+@app.route("/api/Users/<userID>/Telematics", methods=['POST'])
+def ingestTelematicsAPI(userID):
+    try:
+        userID = validateUserIdInURL(userID).userID
+    except Exception:
+        return jsonify({'error': NOTINDB.format(type='user', id=userID)}), 404
+
+    if request.mimetype not in ('application/x-ndjson', 'application/jsonl'):
+        return jsonify({'error': TELEMATICSBADFORMAT}), 415
+
+    # give the request's DB connection back rather than holding it while the stream runs.
+    closeDBSession()
+
+    return jsonify(ingestOdoStream(userID, iterNDJSONReadings(request.stream)))
+
+
+# apply a service template to the vehicles picked by the JSON body's filters:
+# {"vehicleID": 3}, {"userID": 2}, {"make": "Toyota", "model": "Rav4", "year": 2011}, ...
+# returns {"added": number of service items added}.
+@app.route("/api/Templates/<templateID>/Apply", methods=['POST'])
+def applyTemplateAPI(templateID):
+    filters = request.get_json(silent=True)
+    if not isinstance(filters, dict):
+        return jsonify({'error': TEMPLATENOFILTER}), 400
+
+    try:
+        added = applyServiceTemplate(templateID, **{column: filters.get(column) for column in
+                                                   ('vehicleID', 'userID', 'make', 'model', 'year')})
+    except NotInDatabaseError as n:
+        return jsonify({'error': str(n)}), 404
+    except FormInputError as f:
+        return jsonify({'error': str(f)}), 400
+
+    return jsonify({'added': added})
 
 
 ### WEB UI handler functions ###
@@ -481,10 +1630,14 @@ def receiveOdoMsg():
 def handleNewUserPOST():
     username = request.form['username']
     phone = request.form['phone']
+    # how service reminders are grouped. optional, one text per item by default.
+    notifyDigest = request.form.get('notifyDigest', 'off')
 
     # input handling and cleaning up here.
     if 'f-you' in phone or 'whatever' in username:
         raise FormInputError('you messed up, ya doof!')
+    if notifyDigest not in NOTIFYDIGESTMODES:
+        raise FormInputError(INVALIDPARAM.format(param='reminder grouping'))
 
     # now check if the username or phone number already exists and raise an error for each. Can't have any duplicate phone numbers.
     res = querySQL('''
@@ -504,65 +1657,61 @@ def handleNewUserPOST():
     # finally, with the cleaned and validated data, add it to the database and return the cleaned data.
     try:
         newUserID = querySQL(stmt='''
-            INSERT INTO users (username, phone)
-            VALUES (%s, %s)
-        ''', val=(username, phone))
+            INSERT INTO users (username, phone, notifyDigest)
+            VALUES (%s, %s, %s)
+        ''', val=(username, phone, notifyDigest))
     except Exception as e:
         # DEBUG
         raise e
+    invalidatePhoneUser(phone)
+    invalidateCounts()
 
     return {'userID': newUserID, 'username': username, 'phone': phone}
 
 
 # in these cases, we want to check that it is a valid ID and that
 # it exists in the DB.
+# returns the user's row (see getUserRow), kept for the rest of the request.
 def validateUserIdInURL(userID):
     try:
         userID = int(userID)
     except ValueError:
         raise ValueError(INVALIDPARAM.format(param='userID'))
 
-    res = querySQL(stmt='''
-        SELECT userID FROM users
-        WHERE userID = %s
-    ''', val=(userID,))
-    if res == []:
-        raise NotInDatabaseError(NOTINDB.format(user=userID))
+    user = getUserRow(userID)
+    if user is None:
+        raise NotInDatabaseError(NOTINDB.format(type='user', id=userID))
 
-    return userID
+    return user
 
 
 # in these cases, we want to check that it is a valid ID and that
 # it exists in the DB.
+# returns the vehicle's row (see getVehicleRow), kept for the rest of the request.
 def validateVehIdInURL(vehID):
     try:
         vehID = int(vehID)
     except ValueError:
         raise ValueError(INVALIDPARAM.format(param='vehID'))
 
-    res = querySQL(stmt='''
-        SELECT vehicleID FROM vehicles
-        WHERE vehicleID = %s
-    ''', val=(vehID,))
-    if res == []:
+    vehicle = getVehicleRow(vehID)
+    if vehicle is None:
         raise NotInDatabaseError(NOTINDB.format(type='vehicle', id=vehID))
 
-    return vehID
+    return vehicle
 
+# returns the item's row (see getServiceItemRow), kept for the rest of the request.
 def validateItemIdInURL(itemID: int):
     try:
         itemID = int(itemID)
     except ValueError:
-        raise ValueError(INVALIDPARAM.formt())
+        raise ValueError(INVALIDPARAM.format(param='itemID'))
 
-    res = querySQL(stmt='''
-        SELECT itemID FROM serviceSchedule
-        WHERE itemID = %s
-    ''', val=(itemID, ))
-    if res == []:
+    item = getServiceItemRow(itemID)
+    if item is None:
         raise NotInDatabaseError(NOTINDB.format(type='service item', id=itemID))
     
-    return itemID
+    return item
 
 
 # validates the post request, adds data to DB,
@@ -574,7 +1723,7 @@ def handleNewVehiclePOST(userID):
     if userID == 6:
         breakpoint()
     try:
-        userID = validateUserIdInURL(userID)
+        userID = validateUserIdInURL(userID).userID
     except Exception as e:
         raise e
 
@@ -660,6 +1809,7 @@ def handleNewVehiclePOST(userID):
             raise e
 
     # for now dont check for duplicate vehicles.
+    invalidateCounts(userID)
 
     return {'id': newVehID, 'displayName': dispName, 'miles': miles}
 
@@ -672,9 +1822,10 @@ def handleNewServicePOST(vehicleID: int):
     print(request.form)
 
     try:
-        vehicleID = validateVehIdInURL(vehicleID)
+        vehicle = validateVehIdInURL(vehicleID)
     except Exception as e:
         raise e
+    vehicleID = vehicle.vehicleID
 
     # description
     # check that it is present
@@ -718,27 +1869,24 @@ def handleNewServicePOST(vehicleID: int):
 
     # check if an item whose description matches, is already in the DB.
     # if so, raise the duplicate item error.
+    catalogID = getCatalogID(description)
     result = querySQL(stmt='''
-        SELECT description FROM serviceSchedule
-        WHERE description = %s
-        AND vehicleID = %s
-    ''', val=(description, vehicleID))
+        SELECT itemID FROM serviceSchedule
+        WHERE vehicleID = %s
+        AND catalogID = %s
+    ''', val=(vehicleID, catalogID))
 
     # if there is more than an empty array in the result,
     if result != []:
-        raise DuplicateItemError(ILLEGALDUPLICATESERVICE(desc=description))
+        raise DuplicateItemError(ILLEGALDUPLICATESERVICE.format(desc=description))
     
-    result = querySQL(stmt='''
-        SELECT userID FROM vehicles
-        WHERE vehicleID = %s
-    ''', val=(vehicleID, ))
-    userID = result[0][0]
+    userID = vehicle.userID
 
     result = querySQL(stmt='''
         INSERT INTO serviceSchedule
-        (vehicleID, userID, description, serviceInterval, milesLastDone)
+        (vehicleID, userID, catalogID, serviceInterval, milesLastDone)
         VALUES (%s, %s, %s, %s, %s)
-    ''', val=(vehicleID, userID, description, interval, milesLastDone))
+    ''', val=(vehicleID, userID, catalogID, interval, milesLastDone))
 
     return {'description': description, 'interval': interval}
 
@@ -748,7 +1896,7 @@ def handleUpdateOdoPOST(vehicleID: int):
     print(request.form)
 
     try:
-        vehicleID = validateVehIdInURL(vehicleID)
+        vehicleID = validateVehIdInURL(vehicleID).vehicleID
     except Exception as e:
         raise e
     
@@ -780,7 +1928,7 @@ def handleUpdateServDonePOST(itemID: int):
     print(request.form)
 
     try:
-        itemID = validateItemIdInURL(itemID)
+        itemID = validateItemIdInURL(itemID).itemID
     except Exception as e:
         raise e
     
@@ -804,6 +1952,119 @@ def handleUpdateServDonePOST(itemID: int):
     
     return miles
 
+### Paginated lists ###
+# lists are paged by key (e.g. WHERE userID > <last one shown> ORDER BY userID LIMIT n)
+# rather than OFFSET, so a page deep in the list costs the same as the first one.
+# pages are picked with ?after=<key> or ?before=<key>, and sized with ?limit=.
+
+# returns {'after', 'before', 'limit'} from the request's query string.
+# anything missing or not a number is left at its default.
+def getPageArgs():
+    return {
+        'after': request.args.get('after', 0, type=int),
+        'before': request.args.get('before', None, type=int),
+        'limit': min(max(request.args.get('limit', PAGESIZE, type=int), 1), PAGESIZEMAX)
+    }
+
+
+# a LIKE pattern matching strings that start with prefix.
+def likePrefix(prefix):
+    return prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+
+# one page of "{select} WHERE {conditions}" ordered by keyColumn, which must be unique
+# and the first column selected.
+# after/before: the keyColumn value the page starts after, or ends before.
+# rowType: as for querySQL.
+# returns {'rows', 'prev', 'next'}: prev and next are the before/after values for the
+# neighbouring pages, or None if there isn't one.
+def queryPage(select, conditions, val, keyColumn, after=0, before=None, limit=PAGESIZE, rowType=None):
+    if before is not None:
+        (comparison, order, key) = ('<', 'DESC', before)
+    else:
+        (comparison, order, key) = ('>', 'ASC', after)
+
+    rows = querySQL(stmt=f'''
+        {select}
+        WHERE {' AND '.join([*conditions, f'{keyColumn} {comparison} %s'])}
+        ORDER BY {keyColumn} {order}
+        LIMIT %s
+    ''', val=(*val, key, limit + 1), rowType=rowType)
+
+    # one more row than the page is read to tell whether there's another page after it.
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if before is not None:
+        rows.reverse()
+        (hasPrev, hasNext) = (more, True)
+    else:
+        (hasPrev, hasNext) = (after > 0, more)
+
+    return {
+        'rows': rows,
+        'prev': rows[0][0] if rows and hasPrev else None,
+        'next': rows[-1][0] if rows and hasNext else None
+    }
+
+
+### Conditional GET ###
+# users, vehicles and serviceSchedule rows have an updatedAt that MySQL moves on every
+# change to the row. A page's version is read from those in one query, and a browser
+# that already has that version (If-None-Match) gets a 304 without the page's queries
+# or template being run.
+
+# returns the vehicle page's version: (vehicle updatedAt, newest service item updatedAt,
+# number of service items), or None if there's no such vehicle.
+def getVehiclePageVersion(vehicleID):
+    res = querySQL(stmt='''
+        SELECT vehicles.updatedAt, MAX(serviceSchedule.updatedAt), COUNT(serviceSchedule.itemID)
+        FROM vehicles
+        LEFT JOIN serviceSchedule ON serviceSchedule.vehicleID = vehicles.vehicleID
+        WHERE vehicles.vehicleID = %s
+        GROUP BY vehicles.vehicleID, vehicles.updatedAt
+    ''', val=(vehicleID, ))
+    return res[0] if res else None
+
+
+# returns the user page's version: (user updatedAt, newest vehicle updatedAt,
+# number of vehicles), or None if there's no such user.
+def getUserPageVersion(userID):
+    res = querySQL(stmt='''
+        SELECT users.updatedAt, MAX(vehicles.updatedAt), COUNT(vehicles.vehicleID)
+        FROM users
+        LEFT JOIN vehicles ON vehicles.userID = users.userID
+        WHERE users.userID = %s
+        GROUP BY users.userID, users.updatedAt
+    ''', val=(userID, ))
+    return res[0] if res else None
+
+
+# an ETag for a page built from parts, e.g. a version and the query string.
+def makeETag(*parts):
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+# True if the request's If-None-Match already names etag.
+def clientHasCurrent(etag):
+    return request.if_none_match.contains(etag)
+
+
+# the page rendered from template, tagged with etag. no-cache makes the browser check
+# the ETag with us before reusing its copy.
+def renderTagged(etag, template, **context):
+    response = make_response(render_template(template, **context))
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+def notModified(etag):
+    response = Response(status=304)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
 ### WEB UI ROUTES ###
 
 # Serves the homepage, which consists of a welcome message
@@ -813,6 +2074,18 @@ def serveHome():
     return render_template('index.html')
 
 
+# runtime counters for the database connection pool, as JSON.
+@app.route("/Stats", methods=['GET'])
+def serveStats():
+    return jsonify({
+        'dbPool': DB_Pool.getPool().stats(),
+        'phoneUserCache': phoneUserCache.stats(),
+        'processedMessageCache': processedMessageCache.stats(),
+        'countCache': countCache.stats(),
+        'queryCache': Query_Cache.getCache().stats() if Query_Cache.getCache() is not None else None
+    })
+
+
 # USERS #
 
 # serves the Users main page
@@ -821,15 +2094,22 @@ def serveHome():
 # and a link called "New User" which links to /Users/New
 @app.route("/Users", methods=['GET'])
 def serveUsersList():
-    # retrieve a list of usernames
-    res = querySQL('SELECT userID, username FROM users')
-    users = []
+    # one page of users, optionally only those whose username starts with ?q=.
+    pageArgs = getPageArgs()
+    search = request.args.get('q', '').strip()
+    conditions, val = [], []
+    if search:
+        conditions.append("username LIKE %s")
+        val.append(likePrefix(search))
+
+    page = queryPage(f'SELECT {USERCOLUMNS} FROM users', conditions, val,
+                     keyColumn='userID', rowType=User, **pageArgs)
 
-    for item in res:
-        user = {'userID': item[0], 'username': item[1]}
-        users.append(user)
+    # a search's matches aren't counted; only the whole list has a total.
+    (total, totalIsEstimate) = getUserCount() if not search else (None, False)
 
-    return render_template('users.html', users=users)
+    return render_template('users.html', users=page['rows'], search=search, limit=pageArgs['limit'],
+                           prev=page['prev'], next=page['next'], total=total, totalIsEstimate=totalIsEstimate)
 
 
 # handles two functions in one:
@@ -843,8 +2123,10 @@ def newUserUI():
         try:
             userInfo = handleNewUserPOST()  
         except FormInputError as f:
+            rollbackDBSession()
             return render_template(newUserForm, errorMessage=str(f))
         except DuplicateItemError as d:
+            rollbackDBSession()
             return render_template(newUserForm, errorMessage=str(d))
 
         print(request.form)
@@ -857,8 +2139,7 @@ def newUserUI():
 # Should show a list of vehicles by nickname,
 # year, make model. Clicking on a vehicle takes
 # you to the page for that vehicle.
-# get the list of vehicles for that user,
-# where each veh is a dictionary of id, nickname, make, model, year, miles.
+# get the list of vehicles for that user, as Vehicle rows.
 @app.route("/Users/<userID>", methods=['GET'])
 def serveSingleUserPage(userID):
     # retrieve the user given by userID, meaning a list of veh for that user.
@@ -866,38 +2147,25 @@ def serveSingleUserPage(userID):
     # get the username of the user to put in the header. Note that the userID param
     # is a user-entered value through the URL.
     try:
-        userID = validateUserIdInURL(userID)
-    except Exception as e:
-        # if there is any issue with the input here, return page not found.
+        userID = int(userID)
+    except ValueError:
         return Response(status=404)
 
-    res = querySQL('''
-        SELECT username FROM users
-        WHERE userID = %s
-    ''', val=(userID, ))
-    username = res[0][0]
-
-    res = querySQL('''
-        SELECT vehicleID, vehNickname, make,
-            model, year, miles, dateLastOdo
-        FROM vehicles
-        WHERE userID = %s
-    ''', val=(userID, ))
-    vehicles = []
+    # the version lookup also checks the user exists.
+    version = getUserPageVersion(userID)
+    if version is None:
+        return Response(status=404)
+    etag = makeETag('user', userID, *version, request.query_string)
+    if clientHasCurrent(etag):
+        return notModified(etag)
 
-    for item in res:
-        veh = {
-            'id': item[0],
-            'nick': item[1],
-            'make': item[2],
-            'model': item[3],
-            'year': item[4],
-            'miles': item[5],
-            'dateLastOdo': item[6]
-        }
-        vehicles.append(veh)
+    pageArgs = getPageArgs()
+    page = queryPage(f'SELECT {vehicleColumns()} FROM vehicles', ['userID = %s'], [userID],
+                     keyColumn='vehicleID', rowType=Vehicle, **pageArgs)
 
-    return render_template('single_user.html', user={'id': userID, 'name': username}, vehicles=vehicles)
+    return renderTagged(etag, 'single_user.html', user=getUserRow(userID), vehicles=page['rows'],
+                        limit=pageArgs['limit'], prev=page['prev'], next=page['next'],
+                        total=getVehicleCount(userID))
 
 
 # VEHICLES #
@@ -908,40 +2176,27 @@ def serveSingleUserPage(userID):
 @app.route('/Vehicles/<vehicleID>', methods=['GET'])
 def serveSingleVehiclePage(vehicleID):
     try:
-        vehicleID = validateVehIdInURL(vehicleID)
-    except:
+        vehicleID = int(vehicleID)
+    except ValueError:
         return Response(status=404)
-    
-    res = querySQL(f'''
-        SELECT vehicleID, displayName, miles, dateLastODO, estMiles
-        FROM vehicles
-        WHERE vehicleID = {vehicleID}
-    ''')
-    res = res[0]
-    vehicle = {
-        'id': res[0],
-        'displayName': res[1], 
-        'miles': res[2], 
-        'dateLastODO': res[3],
-        'estMiles': res[4]
-    }
 
-    res = querySQL(f'''
-        SELECT itemID, description, serviceInterval, dueAtMiles
+    # the version lookup also checks the vehicle exists.
+    # the estimated miles move with the date, so today is part of the ETag.
+    version = getVehiclePageVersion(vehicleID)
+    if version is None:
+        return Response(status=404)
+    etag = makeETag('vehicle', vehicleID, *version, getDateTodayStr())
+    if clientHasCurrent(etag):
+        return notModified(etag)
+
+    serviceSched = querySQL(f'''
+        SELECT {SERVICEITEMCOLUMNS}
         FROM serviceSchedule
-        WHERE vehicleID = {vehicleID}
-    ''')
+        JOIN serviceCatalog ON serviceCatalog.catalogID = serviceSchedule.catalogID
+        WHERE serviceSchedule.vehicleID = %s
+    ''', val=(vehicleID, ), rowType=ServiceItem)
 
-    serviceSched = []
-    for result in res:
-        serviceSched.append({
-            'id': result[0],
-            'description': result[1],
-            'serviceInterval': result[2],
-            'dueAtMiles': result[3]
-        }) 
-    
-    return render_template('single_vehicle.html', vehicle=vehicle, serviceSched=serviceSched)
+    return renderTagged(etag, 'single_vehicle.html', vehicle=getVehicleRow(vehicleID), serviceSched=serviceSched)
 
 
 @app.route('/Users/<userID>/New-Vehicle', methods=['GET', 'POST'])
@@ -949,15 +2204,10 @@ def newVehicleUI(userID):
     newVehForm = 'new_vehicle_form.html'
     newVehConf = 'new_vehicle_conf.html'
     try:
-        userID = validateUserIdInURL(userID)
+        user = validateUserIdInURL(userID)
     except:
         return Response(status=404)
-    
-    res = querySQL('''
-        SELECT userID, username FROM users
-        WHERE userID = %s
-    ''', val=(userID,))
-    user = {'id': res[0][0], 'username': res[0][1]}
+    userID = user.userID
 
     if request.method == 'GET':
         return render_template(newVehForm, user=user)
@@ -966,8 +2216,10 @@ def newVehicleUI(userID):
         try:
             vehicle = handleNewVehiclePOST(userID)
         except FormInputError as f:
+            rollbackDBSession()
             return render_template(newVehForm, user=user, errorMessage=str(f))
         except DuplicateItemError as d:
+            rollbackDBSession()
             return render_template(newVehForm, user=user, errorMessage=str(d))
         except Exception as e:
             print(e)
@@ -983,7 +2235,7 @@ def newServiceUI(vehicleID):
     newServForm = 'new_service_form.html'
     newServConf = 'new_service_submitted.html'
     try:
-        vehicleID = validateVehIdInURL(vehicleID)
+        vehicleID = validateVehIdInURL(vehicleID).vehicleID
     except:
         return Response(status=404)
 
@@ -994,8 +2246,10 @@ def newServiceUI(vehicleID):
         try:
             newService = handleNewServicePOST(vehicleID)
         except FormInputError as f:
+            rollbackDBSession()
             return render_template(newServForm, vehicleID=vehicleID, error=True, errorMessage=str(f))
         except DuplicateItemError as d:
+            rollbackDBSession()
             return render_template(newServForm, vehicleID=vehicleID, error=True, errorMessage=str(d))
         except Exception as e:
             print(e)
@@ -1011,25 +2265,22 @@ def updateOdoUI(vehicleID):
     updateODOForm = 'update_odo_form.html'
     updateODOConf = 'update_odo_confirmation.html'
     try:
-        vehicleID = validateVehIdInURL(vehicleID)
+        vehicle = validateVehIdInURL(vehicleID)
     except:
         return Response(status=404)
-    
-    res = querySQL(stmt='''
-        SELECT vehicleID, displayName, miles FROM vehicles
-        WHERE vehicleID = %s
-    ''', val=(vehicleID, ))
-    vehicle = {'id': res[0][0], 'displayName': res[0][1], 'miles': res[0][2]}
+    vehicleID = vehicle.vehicleID
     
     if request.method == 'GET':
         return render_template(updateODOForm, vehicle=vehicle)
 
     elif request.method == 'POST':
         try:
-            vehicle['miles'] =  handleUpdateOdoPOST(vehicleID)
+            vehicle = vehicle._replace(miles=handleUpdateOdoPOST(vehicleID))
         except FormInputError as f:
+            rollbackDBSession()
             return render_template(updateODOForm, vehicle=vehicle, errorMessage=str(f))
         except DuplicateItemError as d:
+            rollbackDBSession()
             return render_template(updateODOForm, vehicle=vehicle, errorMessage=str(d))
         except Exception as e:
             print(e)
@@ -1040,22 +2291,50 @@ def updateOdoUI(vehicleID):
         pass
 
 
+@app.route('/Users/<userID>/Import-Odometers', methods=['GET', 'POST'])
+def importOdometersUI(userID):
+    importForm = 'import_odo_form.html'
+    importReport = 'import_odo_report.html'
+    try:
+        user = validateUserIdInURL(userID)
+    except:
+        return Response(status=404)
+    userID = user.userID
+
+    if request.method == 'GET':
+        return render_template(importForm, user=user)
+
+    elif request.method == 'POST':
+        upload = request.files.get('file')
+        if not upload or upload.filename == '':
+            return render_template(importForm, user=user, errorMessage=FORMFIELDBLANK.format(field='file'))
+
+        # give the request's DB connection back; the import borrows its own.
+        closeDBSession()
+
+        fileFormat = upload.filename.rsplit('.', 1)[-1].lower()
+        try:
+            report = importOdoReadings(userID, iterUploadedReadings(upload.stream, fileFormat))
+        except (FormInputError, ValueError) as e:
+            return render_template(importForm, user=user, errorMessage=str(e))
+
+        return render_template(importReport, user=user, report=report)
+    else:
+        pass
+
+
 @app.route('/Service/<itemID>/Update-Service-Done', methods=['GET', 'POST'])
 def updateServiceDoneUI(itemID):
     servDoneForm = 'service_done_form.html'
     servDoneConf = 'service_done_confirmation.html'
     try:
-        itemID = validateItemIdInURL(itemID)
+        row = validateItemIdInURL(itemID)
     except:
         return Response(status=404)
-    
-    res = querySQL(stmt='''
-        SELECT itemID, vehicleID, description FROM serviceSchedule
-        WHERE itemID = %s
-    ''', val=(itemID, ))
-    serviceItem = {'id': res[0][0],
-                   'vehicleID': res[0][1],
-                   'description': res[0][2],
+    itemID = row.itemID
+    serviceItem = {'id': itemID,
+                   'vehicleID': row.vehicleID,
+                   'description': row.description,
                    'milesDoneAt': 0}
     
     if request.method == 'GET':
@@ -1065,9 +2344,11 @@ def updateServiceDoneUI(itemID):
         try:
             serviceItem['milesDoneAt'] = handleUpdateServDonePOST(itemID)
         except FormInputError as f:
+            rollbackDBSession()
             traceback.print_exc()
             return render_template(servDoneForm, serviceItem=serviceItem, errorMessage=str(f))
         except DuplicateItemError as d:
+            rollbackDBSession()
             traceback.print_exc()
             return render_template(servDoneForm, serviceItem=serviceItem, errorMessage=str(d))
         except Exception as e:
@@ -1080,6 +2361,73 @@ def updateServiceDoneUI(itemID):
         pass
 
 
+# TEMPLATES #
+
+# list the service templates, with how many items each one has.
+@app.route('/Templates', methods=['GET'])
+def serveTemplatesList():
+    res = querySQL('''
+        SELECT serviceTemplates.templateID, serviceTemplates.name, COUNT(serviceTemplateItems.catalogID)
+        FROM serviceTemplates
+        LEFT JOIN serviceTemplateItems ON serviceTemplateItems.templateID = serviceTemplates.templateID
+        GROUP BY serviceTemplates.templateID, serviceTemplates.name
+        ORDER BY serviceTemplates.name
+    ''')
+    templates = []
+    for (templateID, name, numItems) in res:
+        templates.append({'id': templateID, 'name': name, 'numItems': numItems})
+
+    return render_template('templates.html', templates=templates)
+
+
+@app.route('/Templates/New', methods=['GET', 'POST'])
+def newTemplateUI():
+    newTemplateForm = 'new_template_form.html'
+    if request.method == 'GET':
+        return render_template(newTemplateForm)
+
+    elif request.method == 'POST':
+        try:
+            templateID = createServiceTemplate(request.form.get('name', '').strip(),
+                                               parseTemplateItems(request.form.get('items', '')))
+        except FormInputError as f:
+            rollbackDBSession()
+            return render_template(newTemplateForm, errorMessage=str(f))
+        except DuplicateItemError as d:
+            rollbackDBSession()
+            return render_template(newTemplateForm, errorMessage=str(d))
+
+        return redirect(url_for('singleTemplateUI', templateID=templateID))
+    else:
+        pass
+
+
+# show a template's items, and a form to apply it to a vehicle, a user's vehicles,
+# or every vehicle of a make/model/year.
+@app.route('/Templates/<templateID>', methods=['GET', 'POST'])
+def singleTemplateUI(templateID):
+    singleTemplate = 'single_template.html'
+    try:
+        template = getServiceTemplate(int(templateID))
+    except (ValueError, NotInDatabaseError):
+        return Response(status=404)
+
+    if request.method == 'GET':
+        return render_template(singleTemplate, template=template)
+
+    elif request.method == 'POST':
+        try:
+            added = applyServiceTemplate(template['id'], **{column: request.form.get(column, '').strip()
+                                                           for column in ('vehicleID', 'userID', 'make', 'model', 'year')})
+        except FormInputError as f:
+            rollbackDBSession()
+            return render_template(singleTemplate, template=template, errorMessage=str(f))
+
+        return render_template(singleTemplate, template=template, added=added)
+    else:
+        pass
+
+
 ### Running the server ###
 
 
@@ -1092,4 +2440,5 @@ def configHTMLAutoReload():
 if __name__ == '__main__':
     from sys import argv
     configHTMLAutoReload()
+    DB_Builder.loadSchemaCache()
     app.run(port=3000, debug=True)
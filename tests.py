@@ -24,9 +24,15 @@ def client():
 ### HELPERS ###
 def buildSampleDB():
     DB_Builder.newDBWithData()
+    main.phoneUserCache.clear()
+    main.processedMessageCache.clear()
+    main.countCache.clear()
 
 
 def buildBlankDB():
+    main.phoneUserCache.clear()
+    main.processedMessageCache.clear()
+    main.countCache.clear()
     with DBConnection() as db:
         con = db.connection
         curs = db.cursor
@@ -289,11 +295,6 @@ def test_updateServiceDone():
             ]
             cur.executemany(sampleVehiclesStatement, sampleVehicles)
 
-            sampleServSchedStmt = """
-                INSERT INTO serviceSchedule (vehicleID, userID, description, serviceInterval, milesLastDone, servDueFlag)
-                VALUES ( %s, %s, %s, %s, %s, %s )
-            """
-
             sampleServiceSched = [
                 (1, 1, "Change Eng. Oil and Filter", 5000, 6030, True),
                 (1, 1, "Rotate and Inspect Tires", 5000, 95300, True),
@@ -306,7 +307,7 @@ def test_updateServiceDone():
                 (6, 4, "set alignmnet", 10, 1028990, False)
             ]
 
-            cur.executemany(sampleServSchedStmt, sampleServiceSched)
+            DB_Builder.insertServiceItems(cur, sampleServiceSched)
 
     buildBlankDB()
     populateDB()
@@ -359,7 +360,8 @@ def test_notifyOneService():
                 raise
 
             curs.execute(f"""
-                SELECT userID, vehicleID, description, dueAtMiles FROM serviceSchedule
+                SELECT userID, vehicleID, serviceCatalog.description, dueAtMiles FROM serviceSchedule
+                JOIN serviceCatalog ON serviceCatalog.catalogID = serviceSchedule.catalogID
                 WHERE itemID = {id}
             """)
             res = curs.fetchall()
@@ -418,7 +420,8 @@ def test_notifyAllService():
         cur.execute(operation=query)
         res = cur.fetchall()
 
-    assert res == main.notifyAllService()
+    assert main.notifyAllService() == len(res)
+    assert main.querySQL('SELECT itemID FROM serviceSchedule WHERE notifyCount = 1') == res
 
 # dailyMaint:
 # run dailyMaint and gather some data using mock functions:
@@ -429,13 +432,6 @@ def test_notifyAllService():
 
 
 def test_dailyMaint(mocker):
-    # a list of users that will be populated by dailyMaint when it calls the (mocked) promptUser function
-    promptedUsersIntrospect = []
-
-    def promptUserSideEffect(usr):
-        promptedUsersIntrospect.append(usr)
-        return ("not_a_phone", "not_a_message")
-
     def runTest(simulatedTodayDate):
         main.dailyMaint()
 
@@ -443,74 +439,73 @@ def test_dailyMaint(mocker):
         # get a list from the db of the users that should be called.
         with DBConnection() as db:
             c = db.cursor
+
+            # the prompts are queued in the outbox rather than sent.
+            c.execute("SELECT recip FROM smsOutbox")
+            promptedPhonesIntrospect = [item[0] for item in c.fetchall()]
+            c.execute("DELETE FROM smsOutbox")
+
             c.execute(f"""
-                SELECT DISTINCT userID FROM vehicles
-                WHERE DATEDIFF('{testDate}', dateLastODO) > '{main.ODOPROMPTINTERVAL}'
+                SELECT phone FROM users
+                WHERE userID IN (
+                    SELECT DISTINCT userID FROM vehicles
+                    WHERE DATEDIFF('{testDate}', dateLastODO) > '{main.ODOPROMPTINTERVAL}'
+                )
+                ORDER BY userID
             """)
             result = c.fetchall()
 
-            refUsersList = []
+            refPhonesList = []
             for item in result:
-                refUsersList.append(item[0])
+                refPhonesList.append(item[0])
 
-            assert refUsersList == promptedUsersIntrospect
+            assert sorted(refPhonesList) == sorted(promptedPhonesIntrospect)
 
-            # check that the vehicles table has been updated correctly.
-            # TEST: estMiles should be updated to miles + milesperday * days elapsed when miles not null.
-            # TEST: IF Miles is NULL. then estMiles and milesPerDay should be set to 0.
-            # TEST: milesPerDay should not be null anywhere. do this as a separate test.
+            # check that the vehicles table has NOT been written to: estimated miles
+            # are worked out when read instead.
+            c.execute("SELECT * FROM vehicles ORDER BY vehicleID")
+            assert c.fetchall() == vehiclesBefore
 
+            # TEST: the estimate should be miles + milesperday * days elapsed when miles and milesPerDay are not null.
+            # TEST: IF Miles is NULL. then the estimate should be 0.
+            # TEST: IF milesPerDay is NULL, the estimate should be miles.
             c.execute(f"""
-                SELECT estMiles = (miles + milesPerDay * DATEDIFF('{testDate}', dateLastODO))
+                SELECT {main.estMilesSQL()} = (miles + milesPerDay * DATEDIFF('{testDate}', dateLastODO))
                 FROM vehicles
-                WHERE miles IS NOT NULL
+                WHERE miles IS NOT NULL AND milesPerDay IS NOT NULL
             """)
             result1 = c.fetchall()
             for assertion in result1:
-                if assertion[0] != 1:
-                    breakpoint()
                 assert assertion[0]
 
-            c.execute("""
-                SELECT estMiles = 0 AND milesPerDay = 0
+            c.execute(f"""
+                SELECT {main.estMilesSQL()} = 0
                 FROM vehicles
                 WHERE miles IS NULL
             """)
             result2 = c.fetchall()
             for assertion in result2:
-                if assertion[0] != 1:
-                    breakpoint()
                 assert assertion[0]
 
-            c.execute("""
-                SELECT milesPerDay IS NOT NULL
+            c.execute(f"""
+                SELECT {main.estMilesSQL()} = miles
                 FROM vehicles
+                WHERE miles IS NOT NULL AND milesPerDay IS NULL
             """)
             result3 = c.fetchall()
             for assertion in result3:
-                if assertion[0] != 1:
-                    breakpoint()
                 assert assertion[0]
 
     # mock the today's date function.
     testDate = date(2025, 9, 15)
     mocker.patch('main.getDateToday', return_value=testDate)
 
-    # mock the promptUserForoneveh function such that we can read out params for all calls to it.
-    mockPromptUser = mocker.patch('main.promptUserForOneVeh')
-    mockPromptUser.side_effect = promptUserSideEffect
-    mockPromptUser.return_value = ("not_a_phone", "not_a_message")
-
-    # mock sendSMS to avoid calls to it. doesn't need to do anything
-    mocker.patch('main.sendSMS')
-
     buildSampleDB()
+    vehiclesBefore = main.querySQL("SELECT * FROM vehicles ORDER BY vehicleID")
 
     # run the test 10 times to simulate 10 days of maintenance.
     for days in range(0, 9):
         runTest(testDate + timedelta(days=days))
-        # reset for the next test.
-        promptedUsersIntrospect = []
 
 
 # def test_receiveOdoMsg
@@ -526,36 +521,11 @@ def test_dailyMaint(mocker):
 # using print statements.
 # then if there is a failure I first can check my function calls that I am asserting the right outputs.
 def test_receiveOdoMsg(client, mocker):
-    updatedVehIntrospect = None
-
-    def updateOdoMockFunc(vehID, newODO):
-        # if updateOdo would return an error this will remain
-        # None
-        nonlocal updatedVehIntrospect
-        updatedVehIntrospect = None
-
-        result = main.querySQL(f"""
-            SELECT miles FROM vehicles
-            WHERE vehicleID = {vehID}
-        """)
-
-        if result == []:
-            raise main.NotInDatabaseError("MOCK: veh not in DB")
-
-        vehODO = result[0][0]
-        if vehODO is not None:
-            if float(vehODO) > float(newODO):
-                raise ValueError("MOCK: new ODO less than vehicle odo.")
-
-        # since the function would work, set the variable to the vehID
-        updatedVehIntrospect = vehID
-
     todaySample = date(2025, 9, 15)
 
     # mock things:
-    mockUpdateODO = mocker.patch('main.updateODO')
-    mockUpdateODO.side_effect = updateOdoMockFunc
     mocker.patch('main.getDateToday', return_value=todaySample)
+    buildSampleDB()
 
     def runTest(fromPhone, smsBody):
         print(
@@ -665,6 +635,81 @@ def test_receiveOdoMsg(client, mocker):
     assert main.SUCCESSFULODOUPDATESMS in runTest(
         fromPhone="+100", smsBody="6")
 
+    # the readings were stored, and a second reply finds nothing left to update.
+    res = main.querySQL("SELECT miles, dateLastODO FROM vehicles WHERE vehicleID = 13")
+    assert res == [(Decimal('6.0'), todaySample)]
+    assert main.NOELIGIBLEVEHICLESMS in runTest(
+        fromPhone="+100", smsBody="7")
+
+
+# a webhook retry (same MessageSid) gets the original reply and changes nothing,
+# whether this process remembers the message or only the database does.
+def test_receiveOdoMsgRetry(client, mocker):
+    mocker.patch('main.getDateToday', return_value=getSampleToday())
+    buildSampleDB()
+    with main.app.test_request_context():
+        route = url_for('receiveOdoMsg')
+
+    def post(sid, odo):
+        response = client.post(path=route, data={'From': '+18006969008', 'Body': odo, 'MessageSid': sid})
+        return response.get_data(as_text=True)
+
+    def vehicle8():
+        return main.querySQL("SELECT miles, milesPerDay FROM vehicles WHERE vehicleID = 8")
+
+    first = post('SMretry1', '300')
+    assert main.SUCCESSFULODOUPDATESMS in first
+    updated = vehicle8()
+
+    assert post('SMretry1', '300') == first
+    assert main.processedMessageCache.stats()['hits'] == 1
+
+    # a retry reaching a worker that hasn't seen it is answered from processedMessages,
+    # without the vehicle being looked up or locked.
+    main.processedMessageCache.clear()
+    lockSpy = mocker.spy(main, 'lockUserUpdateVehicle')
+    assert post('SMretry1', '300') == first
+    assert lockSpy.call_count == 0
+    assert vehicle8() == updated
+
+    # a different message is processed as normal.
+    assert main.NOELIGIBLEVEHICLESMS in post('SMretry2', '310')
+
+    # old replies are purged.
+    main.querySQL("UPDATE processedMessages SET receivedAt = NOW() - INTERVAL 2 DAY WHERE messageSid = 'SMretry1'")
+    assert main.purgeProcessedMessages() == 1
+    assert main.querySQL("SELECT messageSid FROM processedMessages") == [('SMretry2', )]
+
+
+# two replies for the same vehicle arriving together: the second waits for the first
+# to commit, then sees that the vehicle no longer needs a reading.
+def test_receiveOdoMsgConcurrent(mocker):
+    from threading import Thread, Barrier
+    mocker.patch('main.getDateToday', return_value=getSampleToday())
+    buildSampleDB()
+    with main.app.test_request_context():
+        route = url_for('receiveOdoMsg')
+
+    replies = []
+    barrier = Barrier(2)
+
+    def reply(odo):
+        with main.app.test_client() as client:
+            barrier.wait()
+            response = client.post(path=route, data={'From': '+18006969008', 'Body': odo})
+            replies.append(ET.fromstring(response.get_data()).find('Message').text)
+
+    threads = [Thread(target=reply, args=(odo, )) for odo in ('300', '400')]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sum(main.SUCCESSFULODOUPDATESMS in msg for msg in replies) == 1
+    assert sum(main.NOELIGIBLEVEHICLESMS in msg for msg in replies) == 1
+    res = main.querySQL("SELECT miles FROM vehicles WHERE vehicleID = 8")
+    assert res[0][0] in (Decimal('300.0'), Decimal('400.0'))
+
 
 # test all GET web routes
 def test_webUserRoutes(client):
@@ -1004,6 +1049,8 @@ def test_newVehicleUIPOST(client, mocker):
 
 # empty
 def test_UpdateODOUIPOST(client, mocker):
+    spiedVehID = spiedDispName = spiedMiles = spiedErrMsg = None
+
     def mock_render_template(unusedTemplateFile="",
             user={'id': None, 'username': None},
             vehicle={'id': None, 'displayName': None, 'miles': None},
@@ -1061,4 +1108,1004 @@ def test_newServiceUIPOST(client, mocker):
 
 # empty
 def test_UpdateServiceDoneUIPOST(client, mocker):
-    return
\ No newline at end of file
+    return
+
+# the pool should reuse idle connections, let borrowers wait when it is full,
+# recycle connections after recycleAfter borrows, and replace connections that fail
+# the health check. Uses stand-in connections so no database is needed.
+def test_connectionPool():
+    import DB_Pool
+
+    class FakeConnection:
+        def __init__(self, **kwargs):
+            self.open = True
+            self.in_transaction = False
+
+        def is_connected(self):
+            return self.open
+
+        def rollback(self):
+            self.in_transaction = False
+
+        def close(self):
+            self.open = False
+
+    pool = DB_Pool.ConnectionPool(size=1, maxOverflow=1, recycleAfter=3,
+        borrowTimeout=0.1, connectFunc=FakeConnection)
+
+    # a returned connection is handed out again rather than opening a new one.
+    c1 = pool.borrow()
+    pool.giveBack(c1)
+    assert pool.borrow() is c1
+    assert pool.stats()['created'] == 1
+    assert pool.stats()['borrowed'] == 1
+
+    # one overflow connection is allowed, then borrowers wait and time out.
+    c2 = pool.borrow()
+    assert c2 is not c1
+    with raises(DB_Pool.PoolExhaustedError):
+        pool.borrow()
+
+    # the overflow connection is closed when given back since the pool is full.
+    pool.giveBack(c1)
+    pool.giveBack(c2)
+    assert not c2.open
+    assert pool.stats()['idle'] == 1
+
+    # an uncommitted transaction is rolled back on return.
+    c1 = pool.borrow()
+    c1.in_transaction = True
+    pool.giveBack(c1)
+    assert not c1.in_transaction
+
+    # c1 has now been borrowed 3 times so it is recycled on the next borrow.
+    c3 = pool.borrow()
+    assert c3 is not c1 and not c1.open
+    assert pool.stats()['recycled'] == 1
+
+    # a connection the server dropped is replaced on borrow.
+    c3.open = False
+    pool.giveBack(c3)
+    c4 = pool.borrow()
+    assert c4 is not c3 and c4.open
+    assert pool.stats()['recycled'] == 2
+    pool.giveBack(c4)
+
+
+# a borrower stuck connecting to the server shouldn't hold up anyone else: other
+# connections are still given back and borrowed, and the slot is freed if the connect fails.
+def test_connectionPoolSlowConnect():
+    import DB_Pool
+    from threading import Event, Thread
+
+    connecting = Event()
+    release = Event()
+
+    class FakeConnection:
+        opened = 0
+
+        def __init__(self, **kwargs):
+            FakeConnection.opened += 1
+            if FakeConnection.opened == 2:
+                connecting.set()
+                release.wait(5)
+                raise DB_Pool.Error('connect failed')
+            self.in_transaction = False
+
+        def is_connected(self):
+            return True
+
+        def close(self):
+            pass
+
+    pool = DB_Pool.ConnectionPool(size=1, maxOverflow=1, borrowTimeout=0.1, connectFunc=FakeConnection)
+    c1 = pool.borrow()
+
+    failed = []
+
+    def slowBorrow():
+        try:
+            pool.borrow()
+        except DB_Pool.Error:
+            failed.append(True)
+
+    slow = Thread(target=slowBorrow)
+    slow.start()
+    assert connecting.wait(5)
+
+    # the pool is full while the slow connect runs, but its lock is free.
+    pool.giveBack(c1)
+    assert pool.borrow() is c1
+    with raises(DB_Pool.PoolExhaustedError):
+        pool.borrow()
+
+    release.set()
+    slow.join(5)
+    assert failed == [True]
+    c2 = pool.borrow()
+    assert c2 is not c1
+    pool.giveBack(c1)
+    pool.giveBack(c2)
+    assert pool.stats()['borrowed'] == 0
+
+
+# every query in a request shares one transaction: a route that fails part way through
+# (here, the vehicle INSERT succeeds but the odometer is bad) leaves nothing behind,
+# and a route that succeeds commits everything.
+def test_requestDBSession(client):
+    buildSampleDB()
+
+    def countVehicles():
+        return main.querySQL('SELECT COUNT(*) FROM vehicles')[0][0]
+
+    before = countVehicles()
+    vehicle = {'nickname': 'atomic', 'year': '2000', 'make': 'make', 'model': 'model', 'miles': 'word'}
+    response = client.post('/Users/1/New-Vehicle', data=vehicle)
+    assert response.status_code == 200
+    assert countVehicles() == before
+
+    vehicle['miles'] = '100'
+    response = client.post('/Users/1/New-Vehicle', data=vehicle)
+    assert response.status_code == 200
+    assert countVehicles() == before + 1
+
+    # the request's connection has gone back to the pool.
+    assert main.DB_Pool.getPool().stats()['borrowed'] == 0
+
+
+# DECIMAL column bounds should match information_schema, be loaded only once,
+# and be reloaded after the tables are rebuilt.
+def test_schemaCache(mocker):
+    buildSampleDB()
+    loadSpy = mocker.spy(DB_Builder, 'loadSchemaCache')
+
+    for (table, column) in [('vehicles', 'miles'), ('serviceSchedule', 'dueAtMiles'),
+                            ('serviceSchedule', 'milesLastDone')]:
+        assert main.getMaxTheoValueDecimal(table, column) == getMaxTheoValueDecimal(table, column)
+    assert main.getMaxTheoValueDecimal('vehicles', 'make') == "Column is not Decimal type"
+    assert loadSpy.call_count == 1
+
+    buildBlankDB()
+    main.getMaxTheoValueDecimal('vehicles', 'miles')
+    assert loadSpy.call_count == 2
+
+
+# the batched notifications should queue exactly what notifyOneService builds
+# for each flagged item.
+def test_notifyAllServiceMessages(mocker):
+    buildSampleDB()
+    main.querySQL('UPDATE serviceSchedule SET servDueFlag = TRUE WHERE itemID <= 5')
+
+    assert main.notifyAllService() == 5
+    queued = main.querySQL('SELECT recip, body FROM smsOutbox ORDER BY outboxID')
+    assert queued == [main.notifyOneService(itemID) for itemID in range(1, 6)]
+
+    # the outbox rows and the items' notified marks are committed together, chunk by chunk.
+    main.querySQL('UPDATE serviceSchedule SET servDueFlag = TRUE')
+    mocker.patch('SMS_Outbox.OUTBOXENQUEUECHUNK', 2)
+    markNotified = main.markNotified
+    calls = []
+    def stopAtSecondChunk(cursor, itemIDs):
+        calls.append(itemIDs)
+        if len(calls) == 2:
+            raise RuntimeError('stopped part way')
+        markNotified(cursor, itemIDs)
+    mocker.patch('main.markNotified', side_effect=stopAtSecondChunk)
+    with raises(RuntimeError):
+        main.notifyAllService()
+    res = main.querySQL('SELECT COUNT(*) FROM smsOutbox')
+    assert res == [(7, )]
+    res = main.querySQL('SELECT COUNT(*) FROM serviceSchedule WHERE notifyCount = 1')
+    assert res == [(7, )]
+
+
+# the planner should produce the same prompt, for the same vehicle, that
+# promptUserForOneVeh produces for each stale user.
+def test_planOdoPrompts(mocker):
+    mocker.patch('main.getDateToday', return_value=getSampleToday())
+    buildSampleDB()
+
+    staleUsers = main.querySQL(f"""
+        SELECT DISTINCT userID FROM vehicles
+        WHERE DATEDIFF('{getSampleTodayStr()}', dateLastODO) > {main.ODOPROMPTINTERVAL}
+        ORDER BY userID
+    """)
+
+    assert list(main.planOdoPrompts()) == [main.promptUserForOneVeh(usr[0]) for usr in staleUsers]
+
+
+# the bucket should let the first message through and space the rest 1/rate apart.
+def test_tokenBucket():
+    import SMS_Dispatch
+    now = 0.0
+    slept = []
+
+    def fakeSleep(seconds):
+        nonlocal now
+        slept.append(seconds)
+        now += seconds
+
+    bucket = SMS_Dispatch.TokenBucket(rate=4, clock=lambda: now, sleep=fakeSleep)
+    for i in range(5):
+        bucket.acquire()
+
+    assert slept == [0.25, 0.25, 0.25, 0.25]
+    assert now == 1.0
+
+
+# every message gets a result in the order given, and one failed send
+# doesn't stop the others.
+def test_SMSDispatcher():
+    import SMS_Dispatch
+
+    def fakeSend(recip, msg):
+        if recip == 'bad':
+            raise ValueError('bad number')
+        return 'SM' + recip
+
+    dispatcher = SMS_Dispatch.SMSDispatcher(send=fakeSend, maxPerSecond=1000, workers=4)
+    recips = [str(i) for i in range(20)] + ['bad']
+    results = dispatcher.dispatch((recip, 'hello') for recip in recips)
+
+    assert [result.recip for result in results] == recips
+    assert all(result.sid == 'SM' + result.recip for result in results[:-1])
+    assert results[-1].sid is None and 'bad number' in results[-1].error
+
+
+# workers should send queued messages, record the provider sid, and back off
+# and eventually give up on messages that keep failing.
+def test_smsOutbox(mocker):
+    import SMS_Outbox, SMS_Dispatch
+    buildBlankDB()
+    mocker.patch('SMS_Outbox.OUTBOXMAXATTEMPTS', 2)
+
+    def fakeSend(recip, msg):
+        if recip == 'bad':
+            raise ValueError('bad number')
+        return 'SM' + recip
+
+    dispatcher = SMS_Dispatch.SMSDispatcher(send=fakeSend, maxPerSecond=1000)
+    assert SMS_Outbox.enqueueSMS([('1', 'one'), ('bad', 'two'), ('3', 'three')]) == 3
+
+    assert SMS_Outbox.processBatch(dispatcher) == 3
+    rows = main.querySQL("""
+        SELECT recip, status, attempts, providerSid
+        FROM smsOutbox ORDER BY outboxID
+    """)
+    assert rows == [('1', 'sent', 1, 'SM1'),
+                    ('bad', 'pending', 1, None),
+                    ('3', 'sent', 1, 'SM3')]
+
+    # nothing is due until the backoff has passed.
+    assert SMS_Outbox.processBatch(dispatcher) == 0
+    main.querySQL("UPDATE smsOutbox SET nextAttemptAt = NOW() WHERE recip = 'bad'")
+    assert SMS_Outbox.processBatch(dispatcher) == 1
+
+    res = main.querySQL("SELECT status, attempts, lastError FROM smsOutbox WHERE recip = 'bad'")
+    assert res[0][0] == 'failed' and res[0][1] == 2 and 'bad number' in res[0][2]
+
+
+# the Twilio provider should be able to send through the local stand-in, which
+# records what it gets and fails or throttles when told to.
+def test_fakeTwilio():
+    import SMS_Dispatch, SMS_FakeTwilio
+    from twilio.base.exceptions import TwilioRestException
+
+    fake = SMS_FakeTwilio.FakeTwilio(maxPerSecond=1).start()
+    try:
+        provider = SMS_Dispatch.TwilioProvider(accountSid='ACtest', authToken='token', baseUrl=fake.url)
+
+        sid = provider.send(recip='+15550001111', msg='hello')
+        assert sid.startswith('SM')
+        assert fake.received[0]['to'] == '+15550001111' and fake.received[0]['body'] == 'hello'
+        assert fake.received[0]['sid'] == sid
+
+        # the second message in the same second is over the limit.
+        with raises(TwilioRestException) as e:
+            provider.send(recip='+15550001111', msg='again')
+        assert e.value.status == 429
+
+        fake.bucket = None
+        fake.errorRate = 1
+        with raises(TwilioRestException) as e:
+            provider.send(recip='+15550001111', msg='fails')
+        assert e.value.status == 500
+        assert [message['status'] for message in fake.received] == [201, 429, 500]
+    finally:
+        fake.stop()
+
+
+# users with a digest setting get their due items grouped into one text
+# (per user or per vehicle); everyone else still gets one text per item.
+def test_notifyAllServiceDigest():
+    buildSampleDB()
+    main.querySQL("UPDATE users SET notifyDigest = 'user' WHERE userID = 1")
+    main.querySQL("UPDATE users SET notifyDigest = 'vehicle' WHERE userID = 4")
+    main.querySQL('UPDATE serviceSchedule SET servDueFlag = TRUE')
+
+    assert main.notifyAllService() == 9
+    res = main.querySQL('SELECT COUNT(*) FROM serviceSchedule WHERE notifyCount = 1')
+    assert res == [(9, )]
+    queued = main.querySQL('SELECT recip, body FROM smsOutbox ORDER BY outboxID')
+
+    # user 1: five items over two vehicles in one text.
+    assert queued[0][0] == '+18777804236'
+    assert queued[0][1].startswith(main.SERVICEDIGESTUSER.format(username='ryanhess'))
+    assert 'Moose: ' in queued[0][1] and 'Yoda: ' in queued[0][1]
+    assert queued[0][1].count(' miles.') == 5
+    # users 2 and 3: one item each, as usual.
+    assert queued[1] == main.notifyOneService(6)
+    assert queued[2] == main.notifyOneService(7)
+    # user 4: one item on each of two vehicles, so one text each.
+    assert queued[3] == main.notifyOneService(8)
+    assert queued[4] == main.notifyOneService(9)
+    assert len(queued) == 5
+
+
+def test_smsSegments():
+    assert main.smsSegments('a' * 160) == 1
+    assert main.smsSegments('a' * 161) == 2
+    assert main.smsSegments('a' * 306) == 2
+    # extension characters take two characters' space.
+    assert main.smsSegments('{' * 81) == 2
+    # anything outside GSM-7 is sent as UCS-2.
+    assert main.smsSegments('ę' * 70) == 1
+    assert main.smsSegments('ę' * 71) == 2
+
+
+# an item is notified once when it becomes due, then again only after
+# RENOTIFYAFTERDAYS days or RENOTIFYAFTERMILES more estimated miles, and its
+# history starts over once the service is done.
+def test_notifyAllServiceRenotify(mocker):
+    mockToday = mocker.patch('main.getDateToday', return_value=getSampleToday())
+    buildSampleDB()
+    main.querySQL('UPDATE serviceSchedule SET servDueFlag = TRUE WHERE itemID IN (1, 6)')
+
+    # the items whose texts a run queued.
+    def notifyRun():
+        lastID = main.querySQL('SELECT COALESCE(MAX(outboxID), 0) FROM smsOutbox')[0][0]
+        count = main.notifyAllService()
+        queued = main.querySQL('SELECT recip, body FROM smsOutbox WHERE outboxID > %s ORDER BY outboxID', (lastID, ))
+        assert len(queued) == count
+        return [itemID for itemID in (1, 6) if main.notifyOneService(itemID) in queued]
+
+    assert notifyRun() == [1, 6]
+    assert notifyRun() == []
+
+    # another 500 estimated miles on vehicle 1.
+    main.querySQL(f'UPDATE vehicles SET miles = miles + {main.RENOTIFYAFTERMILES} WHERE vehicleID = 1')
+    assert notifyRun() == [1]
+
+    # a week later, both are due a reminder again.
+    mockToday.return_value = getSampleToday() + timedelta(days=main.RENOTIFYAFTERDAYS)
+    assert notifyRun() == [1, 6]
+    res = main.querySQL('SELECT notifyCount, lastNotifiedAt FROM serviceSchedule WHERE itemID = 1')
+    assert res == [(3, mockToday.return_value)]
+
+    main.updateServiceDone(itemID=1, itemODO=120000)
+    res = main.querySQL('SELECT servDueFlag, notifyCount, lastNotifiedAt FROM serviceSchedule WHERE itemID = 1')
+    assert res == [(0, 0, None)]
+
+
+def test_flagDueServices(mocker):
+    mocker.patch('main.getDateToday', return_value=getSampleToday())
+    buildSampleDB()
+    main.querySQL('UPDATE serviceSchedule SET servDueFlag = FALSE')
+
+    # the items the old single-statement update would have flagged.
+    expected = main.querySQL(f"""
+        SELECT itemID FROM serviceSchedule
+        WHERE (serviceSchedule.dueAtMiles - (SELECT {main.estMilesSQL()} FROM vehicles WHERE vehicles.vehicleID = serviceSchedule.vehicleID))
+             < {main.SERVDUETHRESH}
+        ORDER BY itemID
+    """)
+    numItems = main.querySQL('SELECT COUNT(*) FROM serviceSchedule')[0][0]
+
+    chunks = main.flagDueServices(batchSize=2)
+    assert len(chunks) == (numItems + 1) // 2
+    assert sum(rows for (lastItemID, rows, seconds) in chunks) == len(expected)
+    assert main.querySQL('SELECT itemID FROM serviceSchedule WHERE servDueFlag ORDER BY itemID') == expected
+
+    # nothing left to flag the second time round.
+    assert sum(rows for (lastItemID, rows, seconds) in main.flagDueServices(batchSize=2)) == 0
+
+
+def test_migrations():
+    import DB_Migrations
+    buildSampleDB()
+
+    # a new database gets every migration.
+    res = main.querySQL('SELECT version FROM schemaVersion ORDER BY version')
+    assert res == [(migration[0], ) for migration in DB_Migrations.MIGRATIONS]
+
+    # running again changes nothing.
+    assert DB_Migrations.migrateDB() == []
+
+    # the baseline tables from DB_Builder.createTables are brought up to the current schema.
+    res = main.querySQL("""
+        SELECT table_name, column_name FROM information_schema.columns
+        WHERE table_schema = DATABASE()
+        AND (table_name, column_name) IN (('users', 'notifyDigest'), ('vehicles', 'estMiles'),
+            ('serviceSchedule', 'notifyCount'), ('smsOutbox', 'outboxID'))
+        ORDER BY table_name
+    """)
+    assert [tuple(row) for row in res] == [('serviceSchedule', 'notifyCount'), ('smsOutbox', 'outboxID'),
+                                           ('users', 'notifyDigest')]
+
+    # a live database is brought up to date without losing its data.
+    main.querySQL('DELETE FROM schemaVersion WHERE version = 2')
+    main.querySQL('DROP INDEX users_phone ON users')
+    main.querySQL('DROP INDEX servsched_due ON serviceSchedule')
+    main.querySQL('DROP INDEX vehicles_user_odo ON vehicles')
+    numVehicles = main.querySQL('SELECT COUNT(*) FROM vehicles')[0][0]
+    assert 2 in DB_Migrations.migrateDB()
+    assert main.querySQL('SELECT COUNT(*) FROM vehicles')[0][0] == numVehicles
+    res = main.querySQL("""
+        SELECT DISTINCT index_name FROM information_schema.statistics
+        WHERE table_schema = DATABASE()
+        AND index_name IN ('users_phone', 'vehicles_user_odo', 'servsched_due')
+        ORDER BY index_name
+    """)
+    assert res == [('servsched_due', ), ('users_phone', ), ('vehicles_user_odo', )]
+
+
+### query plans ###
+# every statement sent through the pool is recorded so its plan can be checked.
+class RecordingCursor:
+    def __init__(self, cursor, recorded):
+        self._cursor = cursor
+        self._recorded = recorded
+
+    def execute(self, stmt, params=None, *args, **kwargs):
+        self._recorded.append((stmt, params))
+        return self._cursor.execute(stmt, params, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class RecordingConnection:
+    def __init__(self, connection, recorded):
+        self._connection = connection
+        self._recorded = recorded
+
+    def cursor(self, *args, **kwargs):
+        return RecordingCursor(self._connection.cursor(*args, **kwargs), self._recorded)
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
+# tables a statement reads with a full scan, whether or not it had an index to use instead.
+# derived tables (<derived2> etc.) are built in memory by the query itself and are skipped.
+def fullScans(stmt, params):
+    with DBConnection() as db:
+        c = db.connection.cursor(dictionary=True)
+        c.execute('EXPLAIN ' + stmt, params)
+        plan = c.fetchall()
+        c.close()
+    return [row['table'] for row in plan
+            if row['type'] == 'ALL' and not row['table'].startswith('<')]
+
+
+# add numUsers users with a vehicle and two service items each, none of them due, so the
+# tables are big enough that the optimizer uses an index where it has one rather than
+# scanning a table of a few rows.
+def seedFillerRows(numUsers=2000):
+    with DBConnection() as db:
+        db.cursor.execute("SELECT MAX(userID) FROM users")
+        firstUserID = db.cursor.fetchall()[0][0] + 1
+        db.cursor.executemany("""
+            INSERT INTO users (username, phone) VALUES (%s, %s)
+        """, [(f'filler{u}', f'+1999{u:07d}') for u in range(numUsers)])
+        db.cursor.executemany("""
+            INSERT INTO vehicles (userID, make, model, year, miles, dateLastODO, milesPerDay)
+            VALUES (%s, 'Make', 'Model', '2015', 100, %s, 0)
+        """, [(firstUserID + u, getSampleTodayStr()) for u in range(numUsers)])
+        db.cursor.execute("SELECT vehicleID, userID FROM vehicles WHERE userID >= %s", (firstUserID, ))
+        DB_Builder.insertServiceItems(db.cursor, [
+            (vehicleID, userID, f'Filler service {i}', 5000, 0, False)
+            for (vehicleID, userID) in db.cursor.fetchall() for i in range(2)])
+        for table in ('users', 'vehicles', 'serviceCatalog', 'serviceSchedule'):
+            db.cursor.execute(f"ANALYZE TABLE {table}")
+            db.cursor.fetchall()
+
+
+# run the webhook and the notification paths, then EXPLAIN every SELECT and UPDATE
+# they sent. None of them may scan a whole table.
+# planOdoPrompts reads every vehicle by design and isn't included.
+def test_hotQueryPlans(client, mocker):
+    import DB_Pool
+    mocker.patch('main.getDateToday', return_value=getSampleToday())
+    buildSampleDB()
+    seedFillerRows()
+    DB_Builder.loadSchemaCache()
+    main.querySQL('UPDATE serviceSchedule SET servDueFlag = TRUE WHERE itemID IN (1, 6)')
+
+    recorded = []
+    DB_Pool.setPool(DB_Pool.ConnectionPool(
+        connectFunc=lambda **kwargs: RecordingConnection(DB_Pool.connect(**kwargs), recorded)))
+    try:
+        with main.app.test_request_context():
+            route = url_for('receiveOdoMsg')
+        client.post(path=route, data={'From': '+16469576453', 'Body': '12000'})
+        main.getUserUpdateVehicle(1)
+        main.getUserUpdateVehicle(2)
+        main.updateODO(vehID=1, newODO=111000)
+        main.updateServiceDone(itemID=2, itemODO=111000)
+        main.notifyAllService()
+        main.flagDueServices()
+        client.get('/Users?after=2&limit=3')
+        client.get('/Users?q=s')
+        client.get('/Users/1?limit=1')
+    finally:
+        DB_Pool.getPool().closeAll()
+        DB_Pool.setPool(None)
+
+    hotQueries = [(stmt, params) for (stmt, params) in recorded
+                  if stmt.lstrip().upper().startswith(('SELECT', 'UPDATE'))
+                  and 'information_schema' not in stmt]
+    assert hotQueries
+
+    scans = []
+    for (stmt, params) in hotQueries:
+        tables = fullScans(stmt, params)
+        if tables:
+            scans.append((stmt, tables))
+    assert scans == []
+
+
+def test_LRUCache():
+    import LRU_Cache
+    now = [0]
+    loads = []
+
+    def load(key):
+        loads.append(key)
+        return None if key.startswith('missing') else key.upper()
+
+    cache = LRU_Cache.LRUCache(maxSize=2, ttl=10, negativeTtl=1, clock=lambda: now[0])
+
+    assert cache.get('a', load) == 'A'
+    assert cache.get('a', load) == 'A'
+    assert loads == ['a']
+
+    # a "not found" is cached, but only for negativeTtl.
+    assert cache.get('missing', load) is None
+    assert cache.get('missing', load) is None
+    now[0] = 2
+    assert cache.get('missing', load) is None
+    assert loads == ['a', 'missing', 'missing']
+
+    # 'a' was used more recently than 'missing', so adding 'b' evicts 'missing'.
+    cache.get('a', load)
+    cache.get('b', load)
+    cache.get('a', load)
+    assert loads == ['a', 'missing', 'missing', 'b']
+    cache.get('missing', load)
+    assert loads[-1] == 'missing'
+
+    # values expire after ttl, and can be dropped early.
+    now[0] = 20
+    cache.get('a', load)
+    assert loads[-1] == 'a'
+    cache.invalidate('a')
+    cache.get('a', load)
+    assert loads[-2:] == ['a', 'a']
+
+    stats = cache.stats()
+    assert stats['hits'] == 3 and stats['negativeHits'] == 1
+    assert stats['misses'] == len(loads) and stats['evictions'] >= 1
+    assert stats['size'] <= 2
+
+
+# repeat texts from the same number are matched to the user without a query,
+# and a new user's number is picked up as soon as they sign up.
+def test_phoneUserCache(client, mocker):
+    mocker.patch('main.getDateToday', return_value=getSampleToday())
+    mocker.patch('main.render_template', return_value='')
+    buildSampleDB()
+    with main.app.test_request_context():
+        receiveRoute = url_for('receiveOdoMsg')
+        newUserRoute = url_for('newUserUI')
+
+    def text(phone):
+        response = client.post(path=receiveRoute, data={'From': phone, 'Body': 'not a number'})
+        return ET.fromstring(response.get_data()).find('Message').text
+
+    text('+16469576453')
+    text('+16469576453')
+    assert main.phoneUserCache.stats()['hits'] == 1
+
+    assert text('+15550001111') == main.PHONENOTINDBSMS
+    assert text('+15550001111') == main.PHONENOTINDBSMS
+    assert main.phoneUserCache.stats()['negativeHits'] == 1
+
+    client.post(path=newUserRoute, data={'username': 'newTexter', 'phone': '+15550001111'})
+    assert text('+15550001111') != main.PHONENOTINDBSMS
+
+    res = client.get('/Stats').get_json()
+    assert res['phoneUserCache']['misses'] == 3
+
+
+def test_importOdoReadings(client, mocker):
+    import io
+    import json
+    mocker.patch('main.getDateToday', return_value=getSampleToday())
+    buildSampleDB()
+
+    upload = b"""vehicleID,odometer,date
+1,110100,2025-09-14
+1,110300,2025-09-15
+2,125000,2025-09-15
+3,20,2025-09-15
+2,abc,
+2,126000,2025-09-20
+2,126000,2025-09-01
+2,126000,
+"""
+    response = client.post('/api/Users/1/Odometers', data=upload, content_type='text/csv')
+    report = response.get_json()
+    assert report['rows'] == 8 and report['applied'] == 3
+    assert [(error['row'], error['error']) for error in report['errors']] == [
+        (4, main.ODODECREASING),
+        (5, main.IMPORTVEHICLENOTFOUND.format(id=3)),
+        (6, main.ODONOTANUMBER),
+        (7, main.IMPORTFUTUREDATE),
+        (8, main.IMPORTDATEBEFORELAST),
+    ]
+    res = main.querySQL("SELECT vehicleID, miles, dateLastODO, milesPerDay FROM vehicles WHERE userID = 1 ORDER BY vehicleID")
+    assert res == [(1, Decimal('110300.0'), getSampleToday(), 200.0),
+                   (2, Decimal('126000.0'), getSampleToday(), 80.0)]
+    assert main.querySQL("SELECT miles FROM vehicles WHERE vehicleID = 3") == [(Decimal('10.0'), )]
+
+    # JSON, applied a couple of rows per transaction.
+    readings = [{'vehicleID': 6, 'odometer': 140100 + i, 'date': '2025-09-15'} for i in range(5)]
+    readings.append({'vehicleID': 7})
+    report = main.importOdoReadings(4, main.iterJSONReadings(io.BytesIO(json.dumps(readings).encode())), chunkSize=2)
+    assert report['rows'] == 6 and report['applied'] == 5
+    assert report['errors'] == [{'row': 6, 'vehicleID': 7, 'error': main.FORMFIELDBLANK.format(field='odometer')}]
+    assert main.querySQL("SELECT miles FROM vehicles WHERE vehicleID = 6") == [(Decimal('140104.0'), )]
+
+    assert client.post('/api/Users/1/Odometers', data=b'{"not": "a list"}', content_type='application/json').status_code == 400
+    assert client.post('/api/Users/1/Odometers', data=upload, content_type='text/plain').status_code == 415
+    assert client.post('/api/Users/1000/Odometers', data=upload, content_type='text/csv').status_code == 404
+
+    # the same through the upload form.
+    renderMock = mocker.patch('main.render_template', return_value='')
+    client.post('/Users/5/Import-Odometers', content_type='multipart/form-data',
+                data={'file': (io.BytesIO(b'8,300,2025-09-15\n'), 'readings.csv')})
+    assert renderMock.call_args.args[0] == 'import_odo_report.html'
+    assert renderMock.call_args.kwargs['report']['applied'] == 1
+
+    # an upload holds one connection at a time: with a pool of one it still goes through
+    # rather than waiting on itself.
+    main.DB_Pool.setPool(main.DB_Pool.ConnectionPool(size=1, maxOverflow=0, borrowTimeout=2))
+    try:
+        response = client.post('/api/Users/1/Odometers', data=b'1,110400,2025-09-15\n', content_type='text/csv')
+        assert response.get_json()['applied'] == 1
+        client.post('/Users/5/Import-Odometers', content_type='multipart/form-data',
+                    data={'file': (io.BytesIO(b'8,310,2025-09-15\n'), 'readings.csv')})
+        assert renderMock.call_args.kwargs['report']['applied'] == 1
+    finally:
+        main.DB_Pool.getPool().closeAll()
+        main.DB_Pool.setPool(None)
+
+
+def test_ingestOdoStream(client, mocker):
+    import json
+    mocker.patch('main.getDateToday', return_value=getSampleToday())
+    buildSampleDB()
+
+    # a minute of readings every 10 seconds from both of user 1's vehicles,
+    # coalesced into 30 second windows.
+    now = [0]
+    def readings():
+        for i in range(6):
+            now[0] = i * 10
+            yield (2 * i + 1, 1, 110000 + i, '2025-09-15T10:00:00Z')
+            yield (2 * i + 2, 2, 125920 + i, '2025-09-15')
+        yield (13, 2, 125000, '2025-09-15')  # out of order: older than what's waiting.
+        yield (14, 'x', 1, None)
+        # no connection is held between writes.
+        assert main.DB_Pool.getPool().stats()['borrowed'] == 0
+
+    writes = []
+    applyChunk = main.applyOdoReadingChunk
+    def spyApply(connection, userID, chunk, *args):
+        writes.append(sorted(chunk, key=lambda row: row[1]))
+        return applyChunk(connection, userID, chunk, *args)
+    mocker.patch('main.applyOdoReadingChunk', side_effect=spyApply)
+
+    report = main.ingestOdoStream(1, readings(), window=30, clock=lambda: now[0])
+    assert report['rows'] == 14 and report['batches'] == 2
+    assert report['applied'] == 4 and report['coalesced'] == 9
+    assert [error['row'] for error in report['errors']] == [14]
+    # the first window ends with the reading at 30 seconds; the rest are written at the end.
+    assert [[(row[1], row[2]) for row in chunk] for chunk in writes] == [
+        [(1, 110003.0), (2, 125922.0)],
+        [(1, 110005.0), (2, 125925.0)],
+    ]
+    res = main.querySQL("SELECT miles FROM vehicles WHERE userID = 1 ORDER BY vehicleID")
+    assert res == [(Decimal('110005.0'), ), (Decimal('125925.0'), )]
+
+    # through the route, as newline-delimited JSON.
+    body = '\n'.join(json.dumps({'vehicleID': 8, 'odometer': 300 + i, 'date': '2025-09-15'}) for i in range(50))
+    response = client.post('/api/Users/5/Telematics', data=body, content_type='application/x-ndjson')
+    report = response.get_json()
+    assert report['rows'] == 50 and report['applied'] == 1 and report['coalesced'] == 49
+    assert main.querySQL("SELECT miles FROM vehicles WHERE vehicleID = 8") == [(Decimal('349.0'), )]
+    assert client.post('/api/Users/5/Telematics', data=body, content_type='text/plain').status_code == 415
+
+
+# a template should be added to every vehicle its filters pick, skip items a vehicle
+# already has, and store each description once in the catalog.
+def test_serviceTemplates(client, mocker):
+    buildSampleDB()
+
+    templateID = main.createServiceTemplate('Toyota 5k synthetic', main.parseTemplateItems(
+        'Change Eng. Oil and Filter, 5000\n\nRotate and Inspect Tires, 5000\nCabin air filter, 15000\n'))
+    template = main.getServiceTemplate(templateID)
+    assert [(item['description'], item['serviceInterval']) for item in template['items']] == [
+        ('Cabin air filter', 15000), ('Change Eng. Oil and Filter', 5000), ('Rotate and Inspect Tires', 5000)]
+    # the sample data's descriptions are reused rather than stored again.
+    res = main.querySQL("SELECT COUNT(*) FROM serviceCatalog WHERE description = 'Change Eng. Oil and Filter'")
+    assert res == [(1, )]
+
+    with raises(main.DuplicateItemError):
+        main.createServiceTemplate('Toyota 5k synthetic', [('Wiper blades', 10000)])
+    with raises(main.FormInputError):
+        main.parseTemplateItems('Wiper blades')
+    with raises(main.FormInputError):
+        main.parseTemplateItems('Wiper blades, -10')
+    with raises(main.FormInputError):
+        main.applyServiceTemplate(templateID)
+    with raises(main.NotInDatabaseError):
+        main.applyServiceTemplate(1000, userID=1)
+
+    # user 1's garage: vehicle 1 already has the oil change and tire rotation, vehicle 2 the oil change.
+    assert main.applyServiceTemplate(templateID, userID=1) == 3
+    assert main.applyServiceTemplate(templateID, userID=1) == 0
+    res = main.querySQL("""
+        SELECT serviceSchedule.serviceInterval, serviceSchedule.milesLastDone FROM serviceSchedule
+        JOIN serviceCatalog ON serviceCatalog.catalogID = serviceSchedule.catalogID
+        WHERE serviceSchedule.vehicleID = 2 AND serviceCatalog.description = 'Cabin air filter'
+    """)
+    assert res == [(15000, Decimal('125920.0'))]
+
+    # a vehicle without an odometer reading starts from 0.
+    assert main.applyServiceTemplate(templateID, vehicleID=4) == 3
+    assert main.querySQL("SELECT DISTINCT milesLastDone FROM serviceSchedule WHERE vehicleID = 4") == [(Decimal('0.0'), )]
+
+    # a fleet picked by make and model, through the API.
+    response = client.post(f'/api/Templates/{templateID}/Apply', json={'make': 'Hess', 'model': 'Truck'})
+    assert response.get_json() == {'added': 12}
+    assert client.post(f'/api/Templates/{templateID}/Apply', json={}).status_code == 400
+    assert client.post('/api/Templates/1000/Apply', json={'userID': 1}).status_code == 404
+
+    # the web UI.
+    response = client.post('/Templates/New', data={'name': 'Subaru basics', 'items': 'change oil, 3000'})
+    assert response.status_code == 302
+    renderMock = mocker.patch('main.render_template', return_value='')
+    newTemplateID = main.querySQL("SELECT templateID FROM serviceTemplates WHERE name = 'Subaru basics'")[0][0]
+    client.post(f'/Templates/{newTemplateID}', data={'make': 'Subaru', 'model': '', 'year': ''})
+    assert renderMock.call_args.args[0] == 'single_template.html'
+    # vehicle 4 already has "change oil".
+    assert renderMock.call_args.kwargs['added'] == 3
+
+
+# the Users list and a user's vehicles should page by key, search usernames by prefix,
+# and serve their totals from countCache.
+def test_paginatedLists(client, mocker):
+    buildSampleDB()
+    renderMock = mocker.patch('main.render_template', return_value='')
+
+    def getUsersPage(query):
+        client.get('/Users' + query)
+        kwargs = renderMock.call_args.kwargs
+        return [user.userID for user in kwargs['users']], kwargs['prev'], kwargs['next']
+
+    assert getUsersPage('?limit=3') == ([1, 2, 3], None, 3)
+    assert getUsersPage('?limit=3&after=3') == ([4, 5, 6], 4, 6)
+    assert getUsersPage('?limit=3&after=6') == ([7, 8], 7, None)
+    assert getUsersPage('?limit=3&before=4') == ([1, 2, 3], None, 3)
+    assert getUsersPage('?limit=abc')[0] == [1, 2, 3, 4, 5, 6, 7, 8]
+    assert renderMock.call_args.kwargs['total'] == 8
+    assert renderMock.call_args.kwargs['totalIsEstimate'] is False
+
+    # prefix search, with LIKE wildcards in the search taken literally.
+    assert getUsersPage('?q=s')[0] == [2, 4]
+    assert renderMock.call_args.kwargs['total'] is None
+    assert getUsersPage('?q=%25')[0] == []
+    assert getUsersPage('?q=detective_')[0] == []
+
+    # the cached total is dropped when a user is added.
+    client.post('/Users/New', data={'username': 'newUser', 'phone': '+15555550123'})
+    assert main.getUserCount() == (9, False)
+
+    # user 1's two vehicles, one per page.
+    client.get('/Users/1?limit=1')
+    kwargs = renderMock.call_args.kwargs
+    assert [veh.vehicleID for veh in kwargs['vehicles']] == [1]
+    assert (kwargs['prev'], kwargs['next'], kwargs['total']) == (None, 1, 2)
+    client.get('/Users/1?limit=1&after=1')
+    kwargs = renderMock.call_args.kwargs
+    assert [veh.vehicleID for veh in kwargs['vehicles']] == [2]
+    assert (kwargs['prev'], kwargs['next']) == (2, None)
+
+
+# the vehicle and user pages should answer a request for the version the browser
+# already has with a 304, without rendering, and change their ETag when the data does.
+def test_conditionalGET(client, mocker):
+    mocker.patch('main.getDateToday', return_value=getSampleToday())
+    buildSampleDB()
+
+    response = client.get('/Vehicles/1')
+    assert response.status_code == 200
+    etag = response.headers['ETag']
+
+    renderSpy = mocker.spy(main, 'render_template')
+    response = client.get('/Vehicles/1', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag
+    assert renderSpy.call_count == 0
+
+    # each kind of change gives the page a new version.
+    etags = {etag}
+    main.updateODO(vehID=1, newODO=111000)
+    etags.add(client.get('/Vehicles/1').headers['ETag'])
+    main.updateServiceDone(itemID=2, itemODO=111000)
+    etags.add(client.get('/Vehicles/1').headers['ETag'])
+    client.post('/Vehicles/1/New-Service', data={'description': 'Wiper blades', 'interval': '10000', 'milesLastDone': ''})
+    etags.add(client.get('/Vehicles/1').headers['ETag'])
+    assert len(etags) == 4
+    assert client.get('/Vehicles/1', headers={'If-None-Match': etag}).status_code == 200
+
+    # the estimate moves with the date.
+    mocker.patch('main.getDateToday', return_value=getSampleToday() + timedelta(days=1))
+    assert client.get('/Vehicles/1').headers['ETag'] not in etags
+
+    # a user's page changes with their vehicles, and each page of it has its own ETag.
+    etag = client.get('/Users/1').headers['ETag']
+    assert client.get('/Users/1', headers={'If-None-Match': etag}).status_code == 304
+    assert client.get('/Users/1?limit=1', headers={'If-None-Match': etag}).status_code == 200
+    main.updateODO(vehID=2, newODO=130000)
+    assert client.get('/Users/1', headers={'If-None-Match': etag}).status_code == 200
+
+
+# with the query cache on, repeated reads should come from it, and every kind of write
+# should make the results of the tables it wrote stale.
+def test_queryCache(client):
+    import Query_Cache
+    buildSampleDB()
+    cache = Query_Cache.QueryCache(Query_Cache.LocalBackend())
+    Query_Cache.setCache(cache)
+    try:
+        stmt = 'SELECT miles FROM vehicles WHERE vehicleID = %s'
+        assert main.querySQL(stmt, (1, )) == [(Decimal('110000.0'), )]
+        assert main.querySQL(stmt, (1, )) == [(Decimal('110000.0'), )]
+        assert main.querySQL(stmt, (2, )) == [(Decimal('125920.0'), )]
+        assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 2
+
+        # a write through querySQL.
+        main.updateODO(vehID=1, newODO=111000)
+        assert main.querySQL(stmt, (1, )) == [(Decimal('111000.0'), )]
+
+        # a request sees its own uncommitted write, and nothing is cached or
+        # invalidated when it's rolled back.
+        with main.app.test_request_context():
+            main.querySQL('UPDATE vehicles SET miles = 112000 WHERE vehicleID = 1')
+            assert main.querySQL(stmt, (1, )) == [(Decimal('112000.0'), )]
+            main.rollbackDBSession()
+        hits = cache.stats()['hits']
+        assert main.querySQL(stmt, (1, )) == [(Decimal('111000.0'), )]
+        assert cache.stats()['hits'] == hits + 1
+
+        # a write that doesn't go through querySQL.
+        countStmt = 'SELECT COUNT(*) FROM serviceSchedule WHERE vehicleID = %s'
+        assert main.querySQL(countStmt, (3, )) == [(1, )]
+        templateID = main.createServiceTemplate('cache test', [('Wiper blades', 10000)])
+        main.applyServiceTemplate(templateID, vehicleID=3)
+        assert main.querySQL(countStmt, (3, )) == [(2, )]
+
+        # locking reads are never cached.
+        assert not Query_Cache.isCacheable('SELECT miles FROM vehicles WHERE vehicleID = 1 FOR UPDATE')
+    finally:
+        Query_Cache.setCache(None)
+
+
+# a row validated from the URL should be kept for the rest of the request, so a page
+# reads each user, vehicle or service item once, and a write should drop the stale copy.
+def test_identityMap(client, mocker):
+    buildSampleDB()
+    runSpy = mocker.spy(main, 'runSQL')
+
+    with main.app.test_request_context():
+        vehicle = main.validateVehIdInURL('1')
+        assert (vehicle.vehicleID, vehicle.userID, vehicle.displayName) == (1, 1, 'Moose')
+        assert main.getVehicleRow(1) is vehicle
+        with raises(main.NotInDatabaseError):
+            main.validateVehIdInURL('0')
+        with raises(main.NotInDatabaseError):
+            main.validateVehIdInURL('0')
+        assert runSpy.call_count == 2
+
+        main.updateODO(vehID=1, newODO=111000)
+        assert main.getVehicleRow(1).miles == Decimal('111000.0')
+        main.rollbackDBSession()
+
+    # outside of a request nothing is kept.
+    runSpy.reset_mock()
+    main.getUserRow(1)
+    main.getUserRow(1)
+    assert runSpy.call_count == 2
+
+    # the service done page: one query for the item, then the POST reads the item once
+    # and its vehicle once before updating both.
+    mocker.patch('main.render_template', return_value='')
+    runSpy.reset_mock()
+    client.get('/Service/2/Update-Service-Done')
+    assert runSpy.call_count == 1
+    runSpy.reset_mock()
+    client.post('/Service/2/Update-Service-Done', data={'miles': '110500'})
+    assert runSpy.call_count == 5
+    assert main.querySQL('SELECT milesLastDone FROM serviceSchedule WHERE itemID = 2') == [(Decimal('110500.0'), )]
+
+
+# rows should come back as the DB_Rows types, field for field, and the pages should
+# hand them straight to their templates.
+def test_typedRows(client, mocker):
+    import DB_Rows
+    buildSampleDB()
+
+    user = main.getUserRow(1)
+    assert isinstance(user, DB_Rows.User)
+    assert (user.userID, user.username) == (1, 'ryanhess')
+    vehicle = main.getVehicleRow(1)
+    assert isinstance(vehicle, DB_Rows.Vehicle)
+    assert (vehicle.vehicleID, vehicle.userID, vehicle.displayName) == (1, 1, 'Moose')
+    item = main.getServiceItemRow(2)
+    assert isinstance(item, DB_Rows.ServiceItem)
+    assert item.vehicleID == 1 and item.description
+    assert main.getUserRow(0) is None
+
+    # plain tuples unless a rowType is asked for, cached or not.
+    assert main.querySQL('SELECT userID FROM users WHERE userID = 1') == [(1, )]
+
+    renderMock = mocker.patch('main.render_template', return_value='')
+    client.get('/Vehicles/1')
+    kwargs = renderMock.call_args.kwargs
+    assert kwargs['vehicle'] == vehicle
+    assert all(isinstance(item, DB_Rows.ServiceItem) and item.vehicleID == 1 for item in kwargs['serviceSched'])
+
+    client.get('/Users/1')
+    kwargs = renderMock.call_args.kwargs
+    assert kwargs['user'] == user
+    assert all(isinstance(veh, DB_Rows.Vehicle) and veh.userID == 1 for veh in kwargs['vehicles'])
+
+
+# the streamed rows should match querySQL's, batch boundaries included, and a caller
+# that stops early should leave its connection fit for the next borrower.
+def test_querySQLIter():
+    import DB_Pool
+    import DB_Rows
+    buildSampleDB()
+    stmt = 'SELECT userID, username FROM users ORDER BY userID'
+
+    expected = main.querySQL(stmt)
+    for batchSize in (1, 3, len(expected), 1000):
+        assert list(main.querySQLIter(stmt, batchSize=batchSize)) == expected
+    assert list(main.querySQLIter('SELECT userID FROM users WHERE userID = 0')) == []
+
+    users = list(main.querySQLIter(f'SELECT {main.USERCOLUMNS} FROM users ORDER BY userID', rowType=DB_Rows.User))
+    assert users[0] == main.getUserRow(1)
+
+    DB_Pool.setPool(DB_Pool.ConnectionPool(size=1, maxOverflow=0))
+    try:
+        rows = main.querySQLIter(stmt, batchSize=2)
+        assert next(rows) == expected[0]
+        rows.close()
+        assert main.querySQL(stmt) == expected
+    finally:
+        DB_Pool.getPool().closeAll()
+        DB_Pool.setPool(None)